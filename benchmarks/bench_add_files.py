@@ -0,0 +1,41 @@
+"""Keys/sec registered by `add_files`, including the duplicate name checks
+
+    python -m benchmarks.bench_add_files --count 1000000
+"""
+import json
+import time
+import argparse
+from s3_tar import S3Tar
+from .fake_s3 import FakeSession
+
+
+def run(count, allow_dups):
+    session = FakeSession()
+    for i in range(count):
+        session.s3.add_object('bench', 'data/{:08d}.bin'.format(i), b'')
+
+    job = S3Tar('bench', 'archive.tar', allow_dups=allow_dups,
+                session=session)
+    start = time.perf_counter()
+    job.add_files('data/')
+    elapsed = time.perf_counter() - start
+
+    return {
+        'benchmark': 'add_files',
+        'keys': count,
+        'allow_dups': allow_dups,
+        'seconds': round(elapsed, 3),
+        'keys_per_sec': round(count / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--allow-dups', action='store_true')
+    args = parser.parse_args()
+    print(json.dumps(run(args.count, args.allow_dups)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Objects/sec through the file cache for many small objects
+
+    python -m benchmarks.bench_cache --count 100000 --size 1024
+"""
+import json
+import time
+import argparse
+from s3_tar import S3Tar
+from .fake_s3 import FakeSession
+
+
+def run(count, size, cache_size):
+    session = FakeSession()
+    body = b'x' * size
+    for i in range(count):
+        session.s3.add_object('bench', 'data/{:08d}.bin'.format(i), body)
+
+    job = S3Tar('bench', 'archive.tar', allow_dups=True,
+                cache_size=cache_size, session=session)
+    job.add_files('data/')
+    start = time.perf_counter()
+    job.tar()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'benchmark': 'cache',
+        'objects': count,
+        'object_size': size,
+        'cache_size': cache_size,
+        'seconds': round(elapsed, 3),
+        'objects_per_sec': round(count / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--cache-size', type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.count, args.size, args.cache_size)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Compression throughput in MB/s for a single large object
+
+    python -m benchmarks.bench_compression --size 64 --workers 4
+    python -m benchmarks.bench_compression --size 64 --format tar.zst
+    python -m benchmarks.bench_compression --size 64 --scaling bz2
+"""
+import os
+import json
+import time
+import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from s3_tar import S3Tar
+from s3_tar.compression import ParallelGzipCompressor, ParallelBz2Compressor
+from .fake_s3 import FakeSession
+
+MB = 1024**2
+
+
+def _body(size):
+    # Text that compresses about as well as logs do
+    words = [b'INFO', b'DEBUG', b'request', b'user', b'200', b'404', b'\n']
+    rand = random.Random(0)
+    return b' '.join(rand.choice(words) for _ in range(size // 5))[:size]
+
+
+def run(size, workers, target_key='archive.tar.gz', **kwargs):
+    session = FakeSession()
+    session.s3.add_object('bench', 'data/big.log', _body(size * MB))
+
+    # Small parts so the object is streamed, which is what gets the workers
+    job = S3Tar('bench', target_key, compression_workers=workers,
+                part_size_multiplier=1, session=session, **kwargs)
+    job.add_files('data/')
+    start = time.perf_counter()
+    job.tar()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'benchmark': 'compression',
+        'target_key': target_key,
+        'size_mb': size,
+        'workers': workers,
+        'output_bytes': len(session.s3.objects[('bench', target_key)][0]),
+        'seconds': round(elapsed, 3),
+        'mb_per_sec': round(size / elapsed, 1),
+    }
+
+
+def run_scaling(size, compression_type):
+    """MB/s of the parallel compressor alone, from 1 worker up to the
+    number of cores
+    """
+    parallel_compressor = {
+        'gz': ParallelGzipCompressor,
+        'bz2': ParallelBz2Compressor,
+    }[compression_type]
+    body = _body(size * MB)
+
+    results = []
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            compressor = parallel_compressor(executor,
+                                             max_pending=workers * 2)
+            start = time.perf_counter()
+            for i in range(0, len(body), MB):
+                compressor.compress(body[i:i + MB])
+            compressor.flush()
+            elapsed = time.perf_counter() - start
+
+        results.append({
+            'benchmark': 'compression_scaling',
+            'compression_type': compression_type,
+            'size_mb': size,
+            'workers': workers,
+            'seconds': round(elapsed, 3),
+            'mb_per_sec': round(size / elapsed, 1),
+        })
+        workers *= 2
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=64, help="Size in MB")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--format', default='tar.gz',
+                        help="tar.gz, tar.bz2, tar.xz, tar.zst or tar.lz4")
+    parser.add_argument('--scaling', choices=['gz', 'bz2'], default=None,
+                        help="Time the parallel compressor on 1 worker up"
+                             " to the number of cores")
+    args = parser.parse_args()
+    if args.scaling is not None:
+        for result in run_scaling(args.size, args.scaling):
+            print(json.dumps(result))
+        return
+
+    target_key = 'archive.' + args.format
+    print(json.dumps(run(args.size, args.workers, target_key=target_key)))
+
+
+if __name__ == '__main__':
+    main()
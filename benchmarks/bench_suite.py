@@ -0,0 +1,284 @@
+"""End to end runs of S3Tar across object sizes and settings, as json
+
+    python -m benchmarks.bench_suite --output results.json
+    python -m benchmarks.bench_suite --scale 0.01 --format tar tar.gz
+    python -m benchmarks.bench_suite --distribution 1MBx10k \\
+        --cache-size 5 20 --part-size-multiplier 1 10
+    python -m benchmarks.bench_suite --compare before.json after.json
+
+Every combination of the distributions, formats, cache sizes and part size
+multipliers is run in its own process, so the peak RSS is for that run
+alone. `--scale` shrinks the number of objects (and the size of each one
+once there would be less then one), keeping the runs comparable while
+taking less time.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import itertools
+import subprocess
+from s3_tar import S3Tar
+from s3_tar.utils import _check_compression_type, _get_compression_type
+from .bench_compression import _body
+from .fake_s3 import FakeS3, FakeSession
+
+KB = 1024
+MB = 1024**2
+GB = 1024**3
+
+# Name -> (size of each object, number of objects)
+DISTRIBUTIONS = {
+    '1KBx100k': (KB, 100000),
+    '1MBx10k': (MB, 10000),
+    '1GBx4': (GB, 4),
+}
+FORMATS = ['tar', 'tar.gz', 'tar.bz2', 'tar.xz', 'tar.zst', 'tar.lz4']
+
+
+def _scaled(distribution, scale):
+    """Get the size & number of objects of a distribution after scaling it
+
+    Args:
+        distribution (str): Key of `DISTRIBUTIONS`
+        scale (float): Multiplied by the total size of the objects
+
+    Returns:
+        tuple: Size of each object in bytes, number of objects
+    """
+    size, count = DISTRIBUTIONS[distribution]
+    if count * scale >= 1:
+        return size, int(count * scale)
+    # Less then one object, so make the one object smaller
+    return max(int(size * count * scale), 1), 1
+
+
+def _peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # In bytes on mac, KB everywhere else
+        peak_rss /= 1024
+    return round(peak_rss / 1024, 1)
+
+
+def _source_data(size):
+    # Repeat a MB of log like text, rather then generating all of it
+    pattern = _body(min(size, MB))
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+def run(distribution, target_key, cache_size, part_size_multiplier,
+        scale=1.0):
+    """Tar the objects of a distribution using the fake s3 client
+
+    Args:
+        distribution (str): Key of `DISTRIBUTIONS`
+        target_key (str): Key of the tar file, its extension sets the
+            compression
+        cache_size (int): `cache_size` of the job
+        part_size_multiplier (int): `part_size_multiplier` of the job
+        scale (float, optional): Multiplied by the total size of the
+            objects. Defaults to 1.0.
+
+    Returns:
+        dict: Settings of the run and what was measured
+    """
+    size, count = _scaled(distribution, scale)
+    session = FakeSession(FakeS3(keep_uploads=False))
+    # Every object shares the same data, so they take up little memory
+    data = _source_data(size)
+    for i in range(count):
+        session.s3.add_object('bench', 'data/{:08d}.log'.format(i), data)
+    baseline_rss_mb = _peak_rss_mb()
+
+    start = time.perf_counter()
+    job = S3Tar('bench', target_key, allow_dups=True, cache_size=cache_size,
+                part_size_multiplier=part_size_multiplier, session=session)
+    job.add_files('data/')
+    job.tar()
+    elapsed = time.perf_counter() - start
+
+    total_mb = size * count / MB
+    return {
+        'benchmark': 'suite',
+        'distribution': distribution,
+        'target_key': target_key,
+        'cache_size': cache_size,
+        'part_size_multiplier': part_size_multiplier,
+        'scale': scale,
+        'objects': count,
+        'object_size': size,
+        'total_mb': round(total_mb, 3),
+        'output_mb': round(len(session.s3.objects[('bench', target_key)][0])
+                           / MB, 3),
+        'seconds': round(elapsed, 3),
+        'objects_per_sec': round(count / elapsed, 1),
+        'mb_per_sec': round(total_mb / elapsed, 1),
+        'requests': dict(sorted(session.s3.call_counts.items())),
+        'baseline_rss_mb': baseline_rss_mb,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def _available_formats(formats):
+    """Drop the formats whose compression library is not installed"""
+    available = []
+    for file_format in formats:
+        try:
+            _check_compression_type(
+                _get_compression_type('archive.' + file_format)
+            )
+        except ImportError:
+            print("Skipping {}, it is not installed".format(file_format),
+                  file=sys.stderr)
+            continue
+        available.append(file_format)
+    return available
+
+
+def _run_in_process(scenario):
+    """Run a scenario in a new process, so its peak RSS is its own"""
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.bench_suite',
+         '--scenario', json.dumps(scenario)],
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+    return json.loads(output)
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        ).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(distributions, formats, cache_sizes, part_size_multipliers,
+              scale=1.0):
+    """Run every combination of the settings
+
+    Returns:
+        dict: Where it ran, and the result of each run (see `run`)
+    """
+    results = []
+    scenarios = itertools.product(distributions, _available_formats(formats),
+                                  cache_sizes, part_size_multipliers)
+    for distribution, file_format, cache_size, multiplier in scenarios:
+        result = _run_in_process({
+            'distribution': distribution,
+            'target_key': 'archive.' + file_format,
+            'cache_size': cache_size,
+            'part_size_multiplier': multiplier,
+            'scale': scale,
+        })
+        print("{distribution} {target_key} cache_size={cache_size}"
+              " part_size_multiplier={part_size_multiplier}:"
+              " {mb_per_sec} MB/s, {peak_rss_mb} MB peak RSS".format(
+                  **result),
+              file=sys.stderr)
+        results.append(result)
+
+    return {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+
+
+def _scenario_key(result):
+    return (result['distribution'], result['target_key'],
+            result['cache_size'], result['part_size_multiplier'],
+            result['scale'])
+
+
+def compare(before, after):
+    """Change in speed and memory of each run that is in both reports
+
+    Args:
+        before (dict): Report from `run_suite`, e.g. of the last release
+        after (dict): Report from `run_suite` to compare to it
+
+    Returns:
+        list: Dict of the settings and the change of each run, as a ratio
+            of after/before
+    """
+    before_results = {_scenario_key(r): r for r in before['results']}
+    changes = []
+    for result in after['results']:
+        previous = before_results.get(_scenario_key(result))
+        if previous is None:
+            continue
+        changes.append({
+            'distribution': result['distribution'],
+            'target_key': result['target_key'],
+            'cache_size': result['cache_size'],
+            'part_size_multiplier': result['part_size_multiplier'],
+            'mb_per_sec': round(result['mb_per_sec']
+                                / max(previous['mb_per_sec'], 0.1), 3),
+            'peak_rss_mb': round(result['peak_rss_mb']
+                                 / max(previous['peak_rss_mb'], 0.1), 3),
+            'requests': round(sum(result['requests'].values())
+                              / max(sum(previous['requests'].values()), 1),
+                              3),
+        })
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--distribution', nargs='+',
+                        choices=list(DISTRIBUTIONS),
+                        default=list(DISTRIBUTIONS))
+    parser.add_argument('--format', nargs='+', default=FORMATS,
+                        help="tar, tar.gz, tar.bz2, tar.xz, tar.zst"
+                             " and/or tar.lz4")
+    parser.add_argument('--cache-size', type=int, nargs='+', default=[5])
+    parser.add_argument('--part-size-multiplier', type=int, nargs='+',
+                        default=[10])
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="Multiplied by the total size of the objects")
+    parser.add_argument('--output', default=None,
+                        help="File to save the json to. Default: stdout")
+    parser.add_argument('--compare', nargs=2, default=None,
+                        metavar=('BEFORE', 'AFTER'),
+                        help="Compare two saved results")
+    # Used to run each scenario in its own process
+    parser.add_argument('--scenario', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario is not None:
+        print(json.dumps(run(**json.loads(args.scenario))))
+        return
+
+    if args.compare is not None:
+        with open(args.compare[0]) as f_before, \
+                open(args.compare[1]) as f_after:
+            report = compare(json.load(f_before), json.load(f_after))
+    else:
+        report = run_suite(args.distribution, args.format, args.cache_size,
+                           args.part_size_multiplier, scale=args.scale)
+
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
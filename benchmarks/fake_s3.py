@@ -0,0 +1,267 @@
+"""In-process stand-in for the parts of the boto3 s3 client s3-tar uses
+
+Objects are kept in memory and nothing goes over the network, so the
+benchmarks measure the overhead of s3-tar itself. Calls take the same
+keyword arguments as boto3 does.
+"""
+import io
+import bisect
+import datetime
+import threading
+import collections
+
+# Same as s3, every part but the last must be at least 5MB
+MIN_PART_SIZE = 5 * 1024**2
+
+
+def _parse_range(value):
+    start, end = value.split('=')[1].split('-')
+    return int(start), int(end) + 1
+
+
+class FakeBody:
+
+    def __init__(self, data):
+        self._io = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self._io.read(amt)
+
+    def iter_chunks(self, chunk_size=1024):
+        data = self._io.read(chunk_size)
+        while data:
+            yield data
+            data = self._io.read(chunk_size)
+
+    def close(self):
+        self._io.close()
+
+
+class DiscardedData:
+    """Stands in for uploaded data that was not kept, only its size"""
+
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class FakeS3:
+
+    def __init__(self, keep_uploads=True):
+        """
+        Args:
+            keep_uploads (bool, optional): Keep the data of the uploaded
+                parts. If False only their sizes are kept, so the memory
+                used is s3-tar's own. Defaults to True.
+        """
+        self.keep_uploads = keep_uploads
+        self.objects = {}  # (bucket, key) -> (data, metadata)
+        self.uploads = {}  # upload_id -> {part_number: data}
+        self.call_counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._upload_id = 0
+        self._sorted_keys = None
+        self._last_modified = datetime.datetime(
+            2020, 7, 1, tzinfo=datetime.timezone.utc
+        )
+
+    def _count(self, name):
+        with self._lock:
+            self.call_counts[name] += 1
+
+    def add_object(self, bucket, key, data, metadata=None):
+        """Add an object without counting it as a request"""
+        self.objects[(bucket, key)] = (data, metadata or {})
+        self._sorted_keys = None
+
+    def _object_info(self, key, data):
+        return {
+            'Key': key,
+            'Size': len(data),
+            'LastModified': self._last_modified,
+            'ETag': '"{:032x}"'.format(hash(key) & (2**128 - 1)),
+        }
+
+    def _list(self, bucket, prefix, start_after, max_keys):
+        with self._lock:
+            if self._sorted_keys is None:
+                self._sorted_keys = sorted(self.objects)
+            sorted_keys = self._sorted_keys
+
+        idx = bisect.bisect_right(sorted_keys, (bucket, start_after or prefix))
+        page = []
+        is_truncated = False
+        for obj_bucket, key in sorted_keys[idx:]:
+            if obj_bucket != bucket or not key.startswith(prefix):
+                break
+            if len(page) == max_keys:
+                is_truncated = True
+                break
+            page.append(key)
+
+        resp = {
+            'KeyCount': len(page),
+            'IsTruncated': is_truncated,
+            'Contents': [self._object_info(k, self.objects[(bucket, k)][0])
+                         for k in page],
+        }
+        if is_truncated:
+            resp['NextContinuationToken'] = page[-1]
+        return resp
+
+    def put_object(self, **kwargs):
+        self._count('put_object')
+        body = kwargs.get('Body', b'')
+        if hasattr(body, 'read'):
+            body = body.read()
+        self.add_object(kwargs['Bucket'], kwargs['Key'], bytes(body),
+                        kwargs.get('Metadata'))
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def list_objects_v2(self, **kwargs):
+        self._count('list_objects_v2')
+        start_after = (kwargs.get('ContinuationToken')
+                       or kwargs.get('StartAfter'))
+        return self._list(kwargs['Bucket'], kwargs.get('Prefix', ''),
+                          start_after, kwargs.get('MaxKeys', 1000))
+
+    def list_objects(self, **kwargs):
+        self._count('list_objects')
+        return self._list(kwargs['Bucket'], kwargs.get('Prefix', ''),
+                          kwargs.get('Marker'), kwargs.get('MaxKeys', 1000))
+
+    def head_object(self, **kwargs):
+        self._count('head_object')
+        data, metadata = self.objects[(kwargs['Bucket'], kwargs['Key'])]
+        info = self._object_info(kwargs['Key'], data)
+        return {
+            'ContentLength': info['Size'],
+            'LastModified': info['LastModified'],
+            'ETag': info['ETag'],
+            'Metadata': metadata,
+            'ResponseMetadata': {'HTTPStatusCode': 200},
+        }
+
+    def get_object(self, **kwargs):
+        self._count('get_object')
+        data, metadata = self.objects[(kwargs['Bucket'], kwargs['Key'])]
+        info = self._object_info(kwargs['Key'], data)
+        if 'Range' in kwargs:
+            start, end = _parse_range(kwargs['Range'])
+            data = data[start:end]
+        return {
+            'Body': FakeBody(data),
+            'ContentLength': len(data),
+            'LastModified': info['LastModified'],
+            'ETag': info['ETag'],
+            'Metadata': metadata,
+            'ResponseMetadata': {'HTTPStatusCode': 200},
+        }
+
+    def download_fileobj(self, bucket, key, fileobj, **kwargs):
+        self._count('download_fileobj')
+        fileobj.write(self.objects[(bucket, key)][0])
+
+    def create_multipart_upload(self, **kwargs):
+        self._count('create_multipart_upload')
+        with self._lock:
+            self._upload_id += 1
+            upload_id = str(self._upload_id)
+        self.uploads[upload_id] = {}
+        return {
+            'UploadId': upload_id,
+            'Bucket': kwargs['Bucket'],
+            'Key': kwargs['Key'],
+        }
+
+    def _part_resp(self, upload_id, part_number):
+        return '"{}-{}"'.format(upload_id, part_number)
+
+    def upload_part(self, **kwargs):
+        self._count('upload_part')
+        body = kwargs['Body']
+        if hasattr(body, 'read'):
+            body = body.read()
+        upload_id = kwargs['UploadId']
+        if self.keep_uploads is True:
+            body = bytes(body)
+        else:
+            body = DiscardedData(len(body))
+        self.uploads[upload_id][kwargs['PartNumber']] = body
+        return {
+            'ETag': self._part_resp(upload_id, kwargs['PartNumber']),
+            'ResponseMetadata': {'HTTPStatusCode': 200},
+        }
+
+    def upload_part_copy(self, **kwargs):
+        self._count('upload_part_copy')
+        source = kwargs['CopySource']
+        data = self.objects[(source['Bucket'], source['Key'])][0]
+        if 'CopySourceRange' in kwargs:
+            start, end = _parse_range(kwargs['CopySourceRange'])
+            data = data[start:end]
+        if self.keep_uploads is False:
+            data = DiscardedData(len(data))
+        upload_id = kwargs['UploadId']
+        self.uploads[upload_id][kwargs['PartNumber']] = data
+        return {
+            'CopyPartResult': {
+                'ETag': self._part_resp(upload_id, kwargs['PartNumber']),
+            },
+            'ResponseMetadata': {'HTTPStatusCode': 200},
+        }
+
+    def list_parts(self, **kwargs):
+        self._count('list_parts')
+        upload_id = kwargs['UploadId']
+        return {
+            'Parts': [{'PartNumber': num,
+                       'ETag': self._part_resp(upload_id, num),
+                       'Size': len(data)}
+                      for num, data in sorted(self.uploads[upload_id].items())],
+            'IsTruncated': False,
+            'ResponseMetadata': {'HTTPStatusCode': 200},
+        }
+
+    def complete_multipart_upload(self, **kwargs):
+        self._count('complete_multipart_upload')
+        parts = self.uploads.pop(kwargs['UploadId'])
+        part_list = [parts[p['PartNumber']]
+                     for p in kwargs['MultipartUpload']['Parts']]
+        if any(len(part) < MIN_PART_SIZE for part in part_list[:-1]):
+            raise ValueError("EntityTooSmall")
+        if self.keep_uploads is True:
+            data = b''.join(part_list)
+        else:
+            data = DiscardedData(sum(len(part) for part in part_list))
+        self.add_object(kwargs['Bucket'], kwargs['Key'], data)
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def abort_multipart_upload(self, **kwargs):
+        self._count('abort_multipart_upload')
+        self.uploads.pop(kwargs['UploadId'], None)
+        return {'ResponseMetadata': {'HTTPStatusCode': 204}}
+
+    def delete_objects(self, **kwargs):
+        self._count('delete_objects')
+        bucket = kwargs['Bucket']
+        for obj in kwargs['Delete']['Objects']:
+            self.objects.pop((bucket, obj['Key']), None)
+        self._sorted_keys = None
+        return {
+            'Deleted': [{'Key': obj['Key']}
+                        for obj in kwargs['Delete']['Objects']],
+            'ResponseMetadata': {'HTTPStatusCode': 200},
+        }
+
+
+class FakeSession:
+    """Pass as the `session` to S3Tar so it uses the fake client"""
+
+    def __init__(self, s3=None):
+        self.s3 = s3 or FakeS3()
+
+    def client(self, *args, **kwargs):
+        return self.s3
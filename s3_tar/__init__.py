@@ -1 +1,2 @@
 from .s3_tar import S3Tar  # noqa:F401
+from .s3_untar import S3Untar  # noqa:F401
@@ -0,0 +1,607 @@
+import io
+import os
+import json
+import time
+import asyncio
+import logging
+import tarfile
+import contextlib
+import collections
+from .part_buffer import PartBuffer
+from .utils import _get_delete_errors, DELETE_BATCH_SIZE, DELETE_RETRY_DELAY
+
+try:
+    import aiobotocore.config
+    import aiobotocore.session
+except ImportError:
+    aiobotocore = None
+
+logger = logging.getLogger(__name__)
+
+# Added to the file cache once every file has been added to it
+_END_OF_CACHE = object()
+
+# A file larger then a part, that is downloaded in ranges as it is added
+_LargeFile = collections.namedtuple(
+    '_LargeFile', ['tar_member_name', 'key', 'size', 'mtime']
+)
+
+# Options of `S3Tar` that only the threaded engine supports
+_UNSUPPORTED_OPTIONS = {
+    'journal_path': None,
+    'server_side_copy': False,
+    'max_file_size': None,
+    'archive_concurrency': 1,
+    'max_memory': None,
+    'spill_size': None,
+    'member_index': False,
+    'verify': False,
+    'incremental_remove': False,
+    'progress_callback': None,
+}
+
+
+def _source_item(source):
+    """Get the `(tar_member_name, key)` of a file from the file cache
+
+    Args:
+        source (io.BytesIO|_LargeFile): The file
+
+    Returns:
+        tuple|None: The item, None for metadata files
+    """
+    if isinstance(source, _LargeFile):
+        return source.tar_member_name, source.key
+    return getattr(source, 'item', None)
+
+
+@contextlib.asynccontextmanager
+async def create_async_s3_client(pool_size=10, max_retries=4):
+    """Create an aiobotocore s3 client
+
+    Args:
+        pool_size (int, optional): Max number of connections.
+            Defaults to 10.
+        max_retries (int, optional): Max attempts of each request.
+            Defaults to 4.
+
+    Raises:
+        ImportError: If aiobotocore is not installed
+
+    Yields:
+        The client, closed when the context exits
+    """
+    if aiobotocore is None:
+        raise ImportError("aiobotocore is needed to create an async s3 client,"
+                          " install it with `pip install s3-tar[async]`"
+                          " or pass in a client")
+
+    config = aiobotocore.config.AioConfig(
+        max_pool_connections=pool_size,
+        retries=dict(
+            max_attempts=max_retries,
+        ),
+    )
+    session = aiobotocore.session.get_session()
+    async with session.create_client(
+        's3',
+        endpoint_url=os.getenv('S3_ENDPOINT_URL'),
+        config=config,
+    ) as s3:
+        yield s3
+
+
+class AsyncTarEngine:
+    """Lists, downloads, tars and uploads the files of an `S3Tar` job on
+    the running event loop
+
+    Each download is a task rather then a thread, and at most
+    `concurrency` of them run at a time. The s3 client can be any client
+    with awaitable methods, like aiobotocore's.
+    """
+
+    def __init__(self, job, s3, concurrency=None):
+        """
+        Args:
+            job (S3Tar): The job, with its options and files
+            s3: Async s3 client
+            concurrency (int, optional): Max number of downloads at a time.
+                Defaults to None, which uses `cache_size`.
+        """
+        self.job = job
+        self.s3 = s3
+        self.concurrency = concurrency
+        if self.concurrency is None:
+            self.concurrency = job.cache_size
+        if self.concurrency <= 0:
+            raise ValueError("concurrency must be 1 or larger")
+
+        self._download_limit = None
+        self._upload_limit = None
+        self.file_cache = None
+
+    async def add_files(self, prefix, folder='', preserve_paths=False):
+        """Add s3 files from a directory inside the source bucket
+
+        Args:
+            prefix (str): Folder path inside the source bucket
+            folder (str, optional): Folders to place the file inside
+                the tar file. Defaults to ''.
+            preserve_paths (bool, optional): Starting from the prefix, use
+                the path of the key in the tar file. Defaults to False.
+        """
+        # needs to end with '/'
+        if folder != '' and not folder.endswith('/'):
+            folder += '/'
+
+        logger.info("Gathering files from folder {}".format(prefix))
+        total_file_count = 0
+        list_kwargs = {'Bucket': self.job.source_bucket, 'Prefix': prefix}
+        while True:
+            resp = await self.s3.list_objects_v2(**list_kwargs)
+            if resp['KeyCount'] == 0:
+                break
+
+            file_list = self.job._listing_to_items(resp, prefix, folder,
+                                                   preserve_paths)
+            self.job.all_keys |= set(file_list)
+            total_file_count += len(file_list)
+            logger.debug("Found {} objects so far...".format(total_file_count))
+
+            if not resp['IsTruncated']:
+                break
+            list_kwargs['ContinuationToken'] = resp['NextContinuationToken']
+
+        if total_file_count == 0:
+            logger.warning("No files found in the prefix {}".format(prefix))
+            return
+        logger.info("Found {} objects under the prefix '{}'"
+                    .format(total_file_count, prefix))
+
+    async def tar(self):
+        """Start the tar'ing process with what has been added
+        """
+        for option, default in _UNSUPPORTED_OPTIONS.items():
+            if getattr(self.job, option) != default:
+                raise ValueError("{} is not supported by tar_async"
+                                 .format(option))
+
+        self._download_limit = asyncio.Semaphore(self.concurrency)
+        self._upload_limit = asyncio.Semaphore(self.job.upload_concurrency)
+        self.file_cache = asyncio.Queue(maxsize=self.concurrency)
+
+        items = list(self.job.all_keys)
+        if self.job.deterministic is True:
+            items.sort(key=lambda item: (item[1], item[0]))
+
+        cache_task = asyncio.ensure_future(self._pre_fetch_files(items))
+        try:
+            source = await self._get_file_from_cache()
+            file_number = 0
+            while source is not None:
+                file_number += 1
+                source = await self._new_file_upload(file_number, source)
+            await cache_task
+        finally:
+            cache_task.cancel()
+
+        self.job.keys_to_delete |= self.job.all_keys
+        self.job.all_keys = set()  # clear now that all have been processed
+        await self._cleanup()
+
+    async def _cleanup(self):
+        """Remove source keys from s3
+        """
+        if self.job.remove_keys is True:
+            logger.info("Removing all keys added to the tar {filename}"
+                        .format(filename=self.job.target_key))
+
+            # Only what is in a completed archive, e.g. not files that
+            # failed to download
+            items = self.job.keys_to_delete
+            self.job.kept_keys |= {key for tar_member_name, key
+                                   in items - self.job._archived_items}
+            keys = sorted({key for tar_member_name, key
+                           in items & self.job._archived_items})
+            self.job.keys_to_delete = set()
+            # The batches are deleted at the same time
+            results = await asyncio.gather(*[
+                self._delete_batch(keys[i:i + DELETE_BATCH_SIZE])
+                for i in range(0, len(keys), DELETE_BATCH_SIZE)
+            ])
+            for errors in results:
+                self.job.failed_deletes.update(errors)
+            self.job._report_failed_deletes()
+            self.job._report_kept_keys()
+
+        if self.job._compression_executor is not None:
+            self.job._compression_executor.shutdown()
+
+    async def _delete_batch(self, keys):
+        """Delete up to 1000 keys in a single request, retrying the keys
+        s3 could not delete
+
+        Args:
+            keys (list): Keys to delete
+
+        Returns:
+            dict: Error of each key that could not be deleted, by key
+        """
+        errors = {}
+        async with self._download_limit:
+            for attempt in range(self.job.s3_max_retries):
+                if attempt > 0:
+                    await asyncio.sleep(DELETE_RETRY_DELAY * 2**(attempt - 1))
+
+                logger.debug("Removing {} keys from {}"
+                             .format(len(keys), self.job.source_bucket))
+                resp = await self.s3.delete_objects(
+                    Bucket=self.job.source_bucket,
+                    Delete={
+                        'Objects': [{'Key': key} for key in keys],
+                        'Quiet': True,
+                    },
+                )
+                logger.debug("Delete objects response: {}".format(resp))
+                errors = _get_delete_errors(resp)
+                if not errors:
+                    break
+                keys = sorted(errors)
+
+        return errors
+
+    async def _new_file_upload(self, file_number, source):
+        """Build and upload a tar file, starting with `source`
+
+        Args:
+            file_number (int): The number of this file getting created
+            source: The first file to add
+
+        Returns:
+            The first file of the next tar file, None if there are no
+            files left
+        """
+        result_filepath = self.job._add_file_number(file_number)
+        resp = await self.s3.create_multipart_upload(
+            Bucket=self.job.target_bucket,
+            Key=result_filepath,
+            ContentType=self.job.content_type,
+        )
+        upload_id = resp['UploadId']
+
+        compressor = None
+        if self.job.single_compression_stream is True:
+            compressor = self.job._create_compressor()
+
+        uploads = []
+        archive_items = []  # Files fully added to the archive
+        current_file_size = 0
+        current_part_io = PartBuffer()
+        try:
+            while source is not None:
+                async for data in self._read_source(source):
+                    if compressor is not None:
+                        data = await self._compress(compressor.compress,
+                                                    data)
+                    current_part_io.write(data)
+                    if current_part_io.tell() >= self.job.part_size:
+                        current_file_size += current_part_io.tell()
+                        uploads.append(await self._upload_part(
+                            result_filepath, upload_id, len(uploads) + 1,
+                            current_part_io,
+                        ))
+                        current_part_io = PartBuffer()
+
+                item = _source_item(source)
+                if item is not None:
+                    archive_items.append(item)
+                source = await self._get_file_from_cache()
+                if (self.job.min_file_size is not None
+                        and (current_file_size + current_part_io.tell()
+                             >= self.job.min_file_size)):
+                    break
+
+            if compressor is not None:
+                current_part_io.write(await self._compress(compressor.flush))
+            if current_part_io.tell() > 0 or not uploads:
+                # The last part can be smaller then the min part size
+                uploads.append(await self._upload_part(
+                    result_filepath, upload_id, len(uploads) + 1,
+                    current_part_io,
+                ))
+
+            parts = await asyncio.gather(*uploads)
+        except BaseException:
+            for upload in uploads:
+                upload.cancel()
+            await self.s3.abort_multipart_upload(
+                Bucket=self.job.target_bucket,
+                Key=result_filepath,
+                UploadId=upload_id,
+            )
+            raise
+
+        await self.s3.complete_multipart_upload(
+            Bucket=self.job.target_bucket,
+            Key=result_filepath,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': list(parts)},
+        )
+        logger.info("Saved file {}".format(result_filepath))
+        self.job._archived_items |= set(archive_items)
+        return source
+
+    async def _upload_part(self, target_key, upload_id, part_num, part_io):
+        """Start uploading a part in the background
+
+        Blocks while `upload_concurrency` parts are already uploading
+
+        Args:
+            target_key (str): Key of the multipart upload
+            upload_id (str): Id of the multipart upload
+            part_num (int): Part number of the part
+            part_io (PartBuffer): The contents of the part
+
+        Returns:
+            asyncio.Task: Returns the part's ETag & PartNumber once uploaded
+        """
+        await self._upload_limit.acquire()
+
+        async def _upload():
+            try:
+                logger.info("Uploading part {} of {}"
+                            .format(part_num, target_key))
+                part_io.seek(0)
+                resp = await self.s3.upload_part(
+                    Bucket=self.job.target_bucket,
+                    Key=target_key,
+                    PartNumber=part_num,
+                    UploadId=upload_id,
+                    Body=part_io,
+                )
+                return {'ETag': resp['ETag'], 'PartNumber': part_num}
+            finally:
+                part_io.close()  # Cleanup
+                self._upload_limit.release()
+
+        return asyncio.ensure_future(_upload())
+
+    async def _read_source(self, source):
+        """Read the tar'd data of a file from the file cache
+
+        Args:
+            source (io.BytesIO|_LargeFile): The file
+
+        Yields:
+            bytes: The data, large files in ranges as they are downloaded
+        """
+        if not isinstance(source, _LargeFile):
+            source.seek(0)
+            yield source.read()
+            source.close()  # Cleanup
+            return
+
+        info = tarfile.TarInfo(name=source.tar_member_name)
+        info.size = source.size
+        info.mtime = source.mtime
+        compressor = None
+        if '|' in self.job.mode:
+            compressor = self.job._create_compressor()
+
+        async def _compress(data):
+            if compressor is None:
+                return data
+            return await self._compress(compressor.compress, data)
+
+        yield await _compress(info.tobuf(tarfile.DEFAULT_FORMAT,
+                                         tarfile.ENCODING,
+                                         'surrogateescape'))
+        for start in range(0, source.size, self.job.part_size):
+            end = min(start + self.job.part_size, source.size)
+            data = await self._download_source_range(source.key, start, end)
+            yield await _compress(data)
+
+        remainder = source.size % tarfile.BLOCKSIZE
+        if remainder > 0:
+            yield await _compress(tarfile.NUL
+                                  * (tarfile.BLOCKSIZE - remainder))
+        if compressor is not None:
+            yield await self._compress(compressor.flush)
+
+    async def _compress(self, compress_fn, *args):
+        """Compress on a thread, so the event loop is not blocked while
+        large chunks are compressed or a parallel compressor waits for
+        its blocks
+
+        Args:
+            compress_fn (function): `compress` or `flush` of a compressor
+
+        Returns:
+            bytes: The compressed data
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            None, compress_fn, *args,
+        )
+
+    async def _get_file_from_cache(self):
+        """Get the next file from the file cache
+
+        Returns:
+            io.BytesIO|_LargeFile|None: The file, None when there are no
+                files left
+        """
+        source = await self.file_cache.get()
+        if source is _END_OF_CACHE:
+            # In case it is asked for again
+            self.file_cache.put_nowait(_END_OF_CACHE)
+            return None
+        return source
+
+    async def _pre_fetch_files(self, items):
+        """Download the files into the file cache, at most `concurrency`
+        at a time
+
+        Args:
+            items (list): `(tar_member_name, key)` items, in the order
+                they are added if deterministic
+        """
+        tasks = []
+        previous_task = None
+        try:
+            for item in items:
+                await self._download_limit.acquire()
+                if self.job.deterministic is not True:
+                    previous_task = None
+                previous_task = asyncio.ensure_future(
+                    self._fetch(item, previous_task)
+                )
+                tasks.append(previous_task)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await self.file_cache.put(_END_OF_CACHE)
+
+    async def _fetch(self, item, previous_task=None):
+        """Download a file and add it to the file cache
+
+        A file that fails 3 times is skipped
+
+        Args:
+            item (tuple): The `(tar_member_name, key)` of the file
+            previous_task (asyncio.Task, optional): Wait for this to add
+                its file first. Defaults to None.
+        """
+        try:
+            cache_items = []
+            for i in range(3):
+                # re try 3 times before giving up
+                try:
+                    cache_items = await self._get_cache_items(*item)
+                except Exception:
+                    logger.exception("Retry failed batch of: {}".format(item))
+                else:
+                    break
+
+            if previous_task is not None:
+                await previous_task
+            for cache_item in cache_items:
+                await self.file_cache.put(cache_item)
+        finally:
+            self._download_limit.release()
+
+    async def _get_cache_items(self, tar_member_name, key):
+        """Get the source of an s3 key (and its metadata if needed)
+
+        Files larger then a single part are not downloaded here, they get
+        downloaded in ranges when they are added to the parts
+
+        Args:
+            tar_member_name (str): Filename and path of the file inside the tar
+            key (str): the key to download form s3
+
+        Returns:
+            list: Files to add to the file cache, in order
+        """
+        source_info = self.job.source_info.get(key)
+        if source_info is None:
+            source_info = await self._head_source_key(key)
+
+        if source_info.size > self.job.part_size:
+            source = _LargeFile(tar_member_name, key, source_info.size,
+                                source_info.mtime)
+        else:
+            resp = await self.s3.get_object(
+                Bucket=self.job.source_bucket,
+                Key=key,
+            )
+            source_key_io = io.BytesIO(await resp['Body'].read())
+            source_key_io.seek(0, io.SEEK_END)
+            source_info = self.job._save_source_info(key, resp)
+            source = await self._save_bytes_to_tar(
+                tar_member_name, source_key_io, source_info.mtime,
+            )
+            # So it is known which key is done once it has been added
+            source.item = (tar_member_name, key)
+
+        cache_items = [source]
+        if self.job.save_metadata is True:
+            if source_info.metadata is None:
+                source_info = await self._head_source_key(key)
+            if source_info.metadata != {}:
+                logger.debug("Adding metadata file to cache {}".format(key))
+                metadata_mtime = time.time()
+                if self.job.deterministic is True:
+                    # Use the time of the file so the tar is the same
+                    metadata_mtime = source_info.mtime
+                metadata_io = io.BytesIO(
+                    json.dumps(source_info.metadata).encode('utf-8')
+                )
+                metadata_io.seek(0, io.SEEK_END)
+                cache_items.insert(0, await self._save_bytes_to_tar(
+                    tar_member_name + '.metadata.json',
+                    metadata_io,
+                    metadata_mtime,
+                ))
+        return cache_items
+
+    async def _save_bytes_to_tar(self, name, source_io, source_mtime):
+        """Convert raw bytes into a tar, compressing it off of the event
+        loop if needed
+
+        Args:
+            name (str): Filename inside the tar
+            source_io (io.BytesIO): The data, with its position at the end
+            source_mtime (float): Last modified timestamp of the source file
+
+        Returns:
+            io.BytesIO: BytesIO object of the tar'd data
+        """
+        args = (name, source_io, source_mtime, self.job.mode,
+                self.job.compression_level)
+        if '|' not in self.job.mode:
+            return self.job._save_bytes_to_tar(*args)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.job._save_bytes_to_tar, *args,
+        )
+
+    async def _head_source_key(self, key):
+        """Get the info of an s3 file from a head request
+
+        Args:
+            key (str): S3 file to get the info of
+
+        Returns:
+            SourceInfo: Info of the file
+        """
+        resp = await self.s3.head_object(
+            Bucket=self.job.source_bucket,
+            Key=key,
+        )
+        return self.job._save_source_info(key, resp)
+
+    async def _download_source_range(self, key, start, end):
+        """Download a range of bytes of the source file from s3
+
+        Args:
+            key (str): S3 file to download from
+            start (int): Offset of the first byte
+            end (int): Offset to stop at, exclusive
+
+        Returns:
+            bytes: Contents of the range
+        """
+        for i in range(3):
+            # re try 3 times before giving up, the same as whole files
+            try:
+                resp = await self.s3.get_object(
+                    Bucket=self.job.source_bucket,
+                    Key=key,
+                    Range='bytes={}-{}'.format(start, end - 1),
+                )
+                return await resp['Body'].read()
+            except Exception:
+                if i == 2:
+                    raise
+                logger.exception("Retry failed range {}-{} of: {}"
+                                 .format(start, end, key))
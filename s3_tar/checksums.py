@@ -0,0 +1,112 @@
+import json
+import zlib
+import hashlib
+
+# Added to the key of an archive to get the key of its manifest
+MANIFEST_SUFFIX = '.manifest'
+# Bytes read at a time to checksum a buffer
+_READ_SIZE = 1024**2
+
+
+class Checksum:
+    """MD5 & CRC32 of data that is passed in a chunk at a time"""
+
+    def __init__(self):
+        self.size = 0  # Number of bytes checksummed so far
+        self._md5 = hashlib.md5()
+        self._crc32 = 0
+
+    def update(self, data):
+        self._md5.update(data)
+        self._crc32 = zlib.crc32(data, self._crc32)
+        self.size += len(data)
+
+    @property
+    def md5(self):
+        """str: Hex digest of the MD5"""
+        return self._md5.hexdigest()
+
+    @property
+    def crc32(self):
+        """str: CRC32 as 8 hex digits"""
+        return '{:08x}'.format(self._crc32 & 0xffffffff)
+
+
+def md5_of(source_io):
+    """Get the MD5 of everything in a buffer, it is left at the start
+
+    Args:
+        source_io (io.IOBase): Seekable buffer
+
+    Returns:
+        str: Hex digest of the MD5
+    """
+    md5 = hashlib.md5()
+    source_io.seek(0)
+    for chunk in iter(lambda: source_io.read(_READ_SIZE), b''):
+        md5.update(chunk)
+    source_io.seek(0)
+    return md5.hexdigest()
+
+
+def etag_matches(etag, md5, resp=None):
+    """Check an ETag against the MD5 of the data
+
+    Args:
+        etag (str): ETag from s3, with or without quotes
+        md5 (str): Hex digest of the MD5 of the data
+        resp (dict, optional): The s3 response the ETag is from, to know
+            how the data is encrypted. Defaults to None.
+
+    Returns:
+        bool|None: None if the ETag is not an MD5, e.g. it was uploaded
+            in parts and the size of each part is not known, or it is
+            encrypted with SSE-KMS or SSE-C
+    """
+    if etag is None:
+        return None
+    if resp is not None and (
+            resp.get('ServerSideEncryption', '').startswith('aws:kms')
+            or resp.get('SSECustomerAlgorithm') is not None):
+        return None
+    etag = etag.strip('"')
+    if len(etag) != 32 or '-' in etag:
+        return None
+    return etag == md5
+
+
+def multipart_etag(part_etags):
+    """Get the ETag s3 gives a multipart upload made of the parts
+
+    Args:
+        part_etags (list): ETag of each part, in order
+
+    Returns:
+        str: The ETag, with quotes
+    """
+    digests = b''.join(bytes.fromhex(etag.strip('"')) for etag in part_etags)
+    return '"{}-{}"'.format(hashlib.md5(digests).hexdigest(),
+                            len(part_etags))
+
+
+def dump_manifest(archive_key, etag, part_etags, files):
+    """Create the checksum manifest of an archive
+
+    Args:
+        archive_key (str): Key of the archive
+        etag (str): ETag of the archive
+        part_etags (list): ETag of each part of the archive, in order
+        files (list): Each file in the archive as a dict of its `name`,
+            `key`, `size`, source `etag`, `md5` & `crc32`. The checksums
+            are None when the data never passed through (e.g. it was
+            copied by s3)
+
+    Returns:
+        bytes: The manifest as json
+    """
+    return json.dumps({
+        'archive': archive_key,
+        'etag': etag,
+        'parts': part_etags,
+        'files': files,
+    }, separators=(',', ':')).encode('utf-8')
@@ -1,7 +1,9 @@
 import os
+import sys
+import json
 import logging
 import argparse
-from . import S3Tar
+from . import S3Tar, S3Untar
 
 logging.basicConfig(
     level=logging.WARNING,
@@ -11,6 +13,7 @@ logging.basicConfig(
 log_level = os.getenv('S3_TAR_LOG_LEVEL', 'INFO').upper()
 logging.getLogger('s3_tar.s3_tar').setLevel(log_level)
 logging.getLogger('s3_tar.s3_mpu').setLevel(log_level)
+logging.getLogger('s3_tar.s3_untar').setLevel(log_level)
 
 
 def create_parser():
@@ -24,13 +27,14 @@ def create_parser():
     )
     parser.add_argument(
         "--folder",
-        help="folder whose contents should be combined",
-        required=True,
+        help=("folder whose contents should be combined."
+              " Required unless using --list"),
+        default=None,
     )
     parser.add_argument(
         "--filename",
         help=("Output filename for the tar file."
-              "\nExtension: tar, tar.gz, or tar.bz2"),
+              "\nExtension: tar, tar.gz, tar.bz2, tar.xz, tar.zst or tar.lz4"),
         required=True,
     )
     parser.add_argument(
@@ -46,6 +50,33 @@ def create_parser():
               " in [B,KB,MB,GB,TB]. e.x. 5.2GB"),
         default=None,
     )
+    parser.add_argument(
+        "--max-filesize",
+        help=("Split the files into tar files of about the same size ahead"
+              " of time, using the sizes of the files. Max filesize of the"
+              " tar'd files (before compression) in [B,KB,MB,GB,TB]"),
+        default=None,
+    )
+    parser.add_argument(
+        "--archive-concurrency",
+        help=("Number of tar files to build and upload at the same time."
+              " Needs --min-filesize or --max-filesize. Default: 1"),
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--plan",
+        help=("Print how the files would be split into tar files as json,"
+              " without creating them. Needs --max-filesize"),
+        action='store_true',
+    )
+    parser.add_argument(
+        "--list",
+        help=("Print the files in the tar file --filename as json lines,"
+              " without downloading it. Uses its index if it has one,"
+              " otherwise only the headers of a .tar file are read"),
+        action='store_true',
+    )
     parser.add_argument(
         "--save-metadata",
         help="If a file has metadata, save it to a .metadata.json file",
@@ -56,6 +87,91 @@ def create_parser():
         help="Delete files that were added to the tar file",
         action='store_true',
     )
+    parser.add_argument(
+        "--incremental-remove",
+        help=("With --remove, delete the files of each tar file as soon as"
+              " it is complete, rather then all of them at the end"),
+        action='store_true',
+    )
+    parser.add_argument(
+        "--server-side-copy",
+        help=("Copy large files into the tar inside of s3, rather then"
+              " downloading and uploading them. Only for .tar files"),
+        action='store_true',
+    )
+    parser.add_argument(
+        "--compression-level",
+        help=("Compression level from 1 (fastest) to 9 (smallest)."
+              " Default: 9. zstd goes up to 22 and lz4 up to 16,"
+              " both default to a fast level"),
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--single-compression-stream",
+        help=("Compress the whole tar file as a single stream, rather then"
+              " compressing each file on its own. Creates smaller files"),
+        action='store_true',
+    )
+    parser.add_argument(
+        "--compression-workers",
+        help=("Number of threads to compress large files (and the single"
+              " compression stream) with. Only for .tar.gz, .tar.bz2"
+              " and .tar.zst"),
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--long-distance-matching",
+        help=("Let zstd find matches much further back, for large files"
+              " with repeated content. Only for .tar.zst"),
+        action='store_true',
+    )
+    parser.add_argument(
+        "--deterministic",
+        help=("Add files in order of their keys, so the same files always"
+              " create the same tar file"),
+        action='store_true',
+    )
+    parser.add_argument(
+        "--journal",
+        help=("Local file to save the progress to. If the job stops, run it"
+              " again with the same file to continue where it left off"),
+        default=None,
+    )
+    parser.add_argument(
+        "--member-index",
+        help=("Upload an index of where each file is in the tar file next to"
+              " it (as .index), so a file can be read with a single"
+              " ranged get"),
+        action='store_true',
+    )
+    parser.add_argument(
+        "--verify",
+        help=("Check the files and parts against their ETags as they are"
+              " streamed, and upload a manifest of their checksums next to"
+              " the tar file (as .manifest). Can not be used with --journal"),
+        action='store_true',
+    )
+    parser.add_argument(
+        "--progress",
+        help=("Print a line of the progress, throughput and time spent"
+              " waiting to stderr every --progress-interval seconds"),
+        action='store_true',
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help=("Save the counters and latency of each stage to this file"
+              " every --progress-interval seconds. In the prometheus text"
+              " format if it ends with .prom, otherwise as json"),
+        default=None,
+    )
+    parser.add_argument(
+        "--progress-interval",
+        help="Seconds between --progress lines and saves. Default: 5",
+        type=float,
+        default=5,
+    )
     parser.add_argument(
         "--preserve-paths",
         help="Preserve the path layout relative to the input folder",
@@ -74,6 +190,25 @@ def create_parser():
         type=int,
         default=5,
     )
+    parser.add_argument(
+        "--max-memory",
+        help=("ADVANCED: Max memory to use in [B,KB,MB,GB,TB]. Files are"
+              " downloaded when there is room for them, based on their size,"
+              " rather then --cache-size files at a time"),
+        default=None,
+    )
+    parser.add_argument(
+        "--spill-size",
+        help=("ADVANCED: Files and parts larger then this are staged in temp"
+              " files on disk rather then in memory. In [B,KB,MB,GB,TB]"),
+        default=None,
+    )
+    parser.add_argument(
+        "--spill-dir",
+        help=("ADVANCED: Directory for the temp files, e.g. on a fast local"
+              " disk. Default: the system temp directory"),
+        default=None,
+    )
     parser.add_argument(
         "--s3-max-retries",
         help="ADVANCED: Max retries for each request the s3 client makes",
@@ -87,13 +222,37 @@ def create_parser():
         type=int,
         default=10,
     )
+    parser.add_argument(
+        "--upload-concurrency",
+        help=("ADVANCED: Number of parts to upload at the same time."
+              " Each one is held in memory until it is uploaded"),
+        type=int,
+        default=2,
+    )
 
     return parser
 
 
+def _create_progress_callback(args):  # pragma: no cover
+    """Print the progress line and/or save the metrics file"""
+    if args.progress is False and args.metrics_file is None:
+        return None
+
+    def _on_progress(metrics):
+        if args.progress is True:
+            print(metrics.progress_line(), file=sys.stderr)
+        if args.metrics_file is not None:
+            metrics.write(args.metrics_file)
+
+    return _on_progress
+
+
 def cli():
     # No need to run testson these. They are tested separately
-    args = create_parser().parse_args()  # pragma: no cover
+    parser = create_parser()  # pragma: no cover
+    args = parser.parse_args()  # pragma: no cover
+    if args.folder is None and args.list is False:  # pragma: no cover
+        parser.error("--folder is required")
     job = S3Tar(
         args.source_bucket,
         args.filename,
@@ -101,13 +260,119 @@ def cli():
         cache_size=args.cache_size,
         min_file_size=args.min_filesize,
         remove_keys=args.remove,
+        incremental_remove=args.incremental_remove,
         save_metadata=args.save_metadata,
         allow_dups=args.allow_dups,
         s3_max_retries=args.s3_max_retries,
         part_size_multiplier=args.part_size_multiplier,
+        upload_concurrency=args.upload_concurrency,
+        server_side_copy=args.server_side_copy,
+        compression_level=args.compression_level,
+        single_compression_stream=args.single_compression_stream,
+        compression_workers=args.compression_workers,
+        long_distance_matching=args.long_distance_matching,
+        journal_path=args.journal,
+        deterministic=args.deterministic,
+        max_file_size=args.max_filesize,
+        archive_concurrency=args.archive_concurrency,
+        max_memory=args.max_memory,
+        spill_size=args.spill_size,
+        spill_dir=args.spill_dir,
+        member_index=args.member_index,
+        verify=args.verify,
+        progress_callback=_create_progress_callback(args),
+        progress_interval=args.progress_interval,
     )  # pragma: no cover
+    if args.list is True:  # pragma: no cover
+        for member in job.list_archive():
+            print(json.dumps(member))
+        return
     job.add_files(
         args.folder,
         preserve_paths=args.preserve_paths,
     )  # pragma: no cover
+    if args.plan is True:  # pragma: no cover
+        print(json.dumps(job.plan(), indent=2))
+        return
     job.tar()  # pragma: no cover
+
+
+def create_untar_parser():
+    parser = argparse.ArgumentParser(
+        description='Extract a tar file in s3 into s3'
+    )
+    parser.add_argument(
+        "--source-bucket",
+        help="Bucket the tar file is in",
+        required=True,
+    )
+    parser.add_argument(
+        "--filename",
+        help=("Key of the tar file."
+              "\nExtension: tar, tar.gz, tar.bz2, tar.xz, tar.zst or tar.lz4"),
+        required=True,
+    )
+    parser.add_argument(
+        "--folder",
+        help="Folder to extract the files into",
+        default='',
+    )
+    parser.add_argument(
+        "--target-bucket",
+        help=("Bucket that the files will be saved to."
+              " Only needed if different then source bucket"),
+        default=None,
+    )
+    parser.add_argument(
+        "--concurrency",
+        help=("Number of ranges of the tar file to extract at the same"
+              " time. Default: 5"),
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--server-side-copy",
+        help=("Copy large files out of the tar inside of s3, rather then"
+              " downloading and uploading them. Only for .tar files"),
+        action='store_true',
+    )
+    # ADVANCED USAGE
+    parser.add_argument(
+        "--s3-max-retries",
+        help="ADVANCED: Max retries for each request the s3 client makes",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--part-size-multiplier",
+        help=("ADVANCED: Multiplied by 5MB, files larger then this are"
+              " uploaded in parts of this size"),
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--upload-concurrency",
+        help=("ADVANCED: Number of parts of a large file to upload at the"
+              " same time"),
+        type=int,
+        default=2,
+    )
+
+    return parser
+
+
+def untar_cli():
+    # No need to run testson these. They are tested separately
+    args = create_untar_parser().parse_args()  # pragma: no cover
+    job = S3Untar(
+        args.source_bucket,
+        args.filename,
+        target_bucket=args.target_bucket,
+        folder=args.folder,
+        concurrency=args.concurrency,
+        s3_max_retries=args.s3_max_retries,
+        part_size_multiplier=args.part_size_multiplier,
+        upload_concurrency=args.upload_concurrency,
+        server_side_copy=args.server_side_copy,
+    )  # pragma: no cover
+    job.untar()  # pragma: no cover
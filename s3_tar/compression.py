@@ -0,0 +1,262 @@
+import bz2
+import zlib
+import struct
+import collections
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# gzip header with no filename, a mtime of 0 and an unknown OS
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+# Deflate can look back this far, so each block is primed with the
+# end of the block before it to keep the same compression ratio
+DEFLATE_WINDOW_SIZE = 32 * 1024
+# bz2 block size of each compression level, level 9 uses 900KB blocks
+BZ2_BLOCK_SIZE = 100 * 1000
+# Window size zstd uses for long distance matching, same as `zstd --long`
+ZSTD_LONG_WINDOW_LOG = 27
+
+
+def _deflate_block(data, level, previous, last):
+    """Compress a single block of a gzip stream
+
+    Each block ends on a byte boundary so the blocks can be compressed
+    separately and then joined together
+
+    Args:
+        data (bytes): Data of the block
+        level (int): Compression level
+        previous (bytes|None): The block before this one, None if it is
+            the first block
+        last (bool): If this is the last block of the stream
+
+    Returns:
+        bytes: Raw deflate data
+    """
+    zdict = None
+    if previous:
+        zdict = previous[-DEFLATE_WINDOW_SIZE:]
+
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zlib.DEF_MEM_LEVEL,
+                                      zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    output = compressor.compress(data)
+    if last is True:
+        output += compressor.flush(zlib.Z_FINISH)
+    else:
+        output += compressor.flush(zlib.Z_SYNC_FLUSH)
+    return output
+
+
+def _bz2_block(data, level, previous, last):
+    """Compress a single block as its own bz2 stream
+
+    Args:
+        data (bytes): Data of the block
+        level (int): Compression level
+        previous (bytes|None): The block before this one, None if it is
+            the first block
+        last (bool): If this is the last block of the stream
+
+    Returns:
+        bytes: bz2 data
+    """
+    if not data and previous is not None:
+        # No need for an empty stream at the end
+        return b''
+    return bz2.compress(data, level)
+
+
+class _ParallelCompressor:
+    """Compress a stream in blocks using many threads
+
+    The data is split into blocks that are compressed at the same time on
+    an executor (zlib & bz2 release the GIL while compressing). The blocks
+    are put back together in order.
+
+    Has the same `compress` & `flush` methods as `zlib.compressobj`
+    """
+
+    def __init__(self, compress_block, executor, level=None,
+                 block_size=1024**2, max_pending=8):
+        """
+        Args:
+            compress_block (callable): Compresses a block on the executor,
+                called with the block, level, the block before it & if it
+                is the last block
+            executor (concurrent.futures.Executor): Runs the compression
+            level (int, optional): Compression level. Defaults to None,
+                which uses 9.
+            block_size (int, optional): Bytes of input per block.
+                Defaults to 1MB.
+            max_pending (int, optional): Max blocks to have compressing at
+                a time, `compress` blocks once there are more. Defaults to 8.
+        """
+        self.compress_block = compress_block
+        self.executor = executor
+        self.level = level
+        if self.level is None:
+            self.level = 9
+        self.block_size = block_size
+        self.max_pending = max_pending
+
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._previous = None
+        self._header_written = False
+
+    def compress(self, data):
+        """Add data to be compressed
+
+        Args:
+            data (bytes): Data to compress
+
+        Returns:
+            bytes: Compressed data of the blocks that are done so far
+        """
+        self._buffer += data
+
+        while len(self._buffer) >= self.block_size:
+            self._submit_block(bytes(self._buffer[:self.block_size]), False)
+            del self._buffer[:self.block_size]
+
+        return self._collect(wait=False)
+
+    def flush(self):
+        """Finish the stream
+
+        Returns:
+            bytes: The rest of the compressed data, including any trailer
+        """
+        self._submit_block(bytes(self._buffer), True)
+        self._buffer = bytearray()
+
+        return self._collect(wait=True) + self._trailer()
+
+    def _submit_block(self, block, last):
+        self._pending.append(self.executor.submit(
+            self.compress_block, block, self.level, self._previous, last,
+        ))
+        self._previous = block
+
+    def _header(self):
+        return b''
+
+    def _trailer(self):
+        return b''
+
+    def _collect(self, wait):
+        """Get the output of the blocks that are done, in order
+
+        Args:
+            wait (bool): Wait for every block to be done
+
+        Returns:
+            bytes: Compressed data
+        """
+        output = bytearray()
+        if self._header_written is False:
+            output += self._header()
+            self._header_written = True
+
+        while self._pending and (wait is True
+                                 or self._pending[0].done()
+                                 or len(self._pending) > self.max_pending):
+            output += self._pending.popleft().result()
+
+        return bytes(output)
+
+
+class ParallelGzipCompressor(_ParallelCompressor):
+    """Compress a single gzip stream using many threads, like pigz
+
+    Each block is raw deflate data primed with the end of the block before
+    it, so the ratio stays close to compressing it all at once
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(_deflate_block, *args, **kwargs)
+        self._crc = 0
+        self._size = 0
+
+    def compress(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        return super().compress(data)
+
+    def _header(self):
+        return GZIP_HEADER
+
+    def _trailer(self):
+        return struct.pack('<II', self._crc & 0xffffffff,
+                           self._size & 0xffffffff)
+
+
+class ParallelBz2Compressor(_ParallelCompressor):
+    """Compress bz2 using many threads, like pbzip2
+
+    bz2 already works in independent blocks of up to 900KB, so each block
+    is compressed as its own bz2 stream. Concatenated bz2 streams are read
+    back as one by `bzip2`, `tarfile` & `bz2.decompress`
+    """
+
+    def __init__(self, executor, level=None, block_size=None,
+                 max_pending=8):
+        """
+        Args:
+            executor (concurrent.futures.Executor): Runs the compression
+            level (int, optional): Compression level. Defaults to None,
+                which uses 9.
+            block_size (int, optional): Bytes of input per block.
+                Defaults to None, which is the bz2 block size of the level
+                (level * 100KB).
+            max_pending (int, optional): Max blocks to have compressing at
+                a time, `compress` blocks once there are more. Defaults to 8.
+        """
+        if level is None:
+            level = 9
+        if block_size is None:
+            block_size = level * BZ2_BLOCK_SIZE
+        super().__init__(_bz2_block, executor, level=level,
+                         block_size=block_size, max_pending=max_pending)
+
+
+class LZ4Compressor:
+    """Wrap `lz4.frame.LZ4FrameCompressor` to have the same `compress` &
+    `flush` methods as `zlib.compressobj`, which do not need `begin` to be
+    called first
+    """
+
+    def __init__(self, level=None):
+        """
+        Args:
+            level (int, optional): Compression level. Defaults to None,
+                which uses 0.
+        """
+        if level is None:
+            level = 0
+        self._compressor = lz4.frame.LZ4FrameCompressor(
+            compression_level=level,
+        )
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        output = self._header + self._compressor.compress(data)
+        self._header = b''
+        return output
+
+    def flush(self):
+        output = self._header + self._compressor.flush()
+        self._header = b''
+        return output
@@ -0,0 +1,191 @@
+import os
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """Local record of how far a tar job got, so a rerun can resume it
+
+    Each event is saved as a line of json and flushed to disk right away,
+    so everything up to a crash is kept. Items are `(tar_member_name, key)`
+    pairs, the same as `S3Tar.all_keys`.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Local file to save to. If it exists, the events in
+                it are loaded and new ones are added to the end
+        """
+        self.path = path
+        self.plan = None  # Set of items the job was started with
+        # Each archive by file number, with its target key, upload id,
+        # parts by part number and if it was completed
+        self.archives = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            self._load()
+        self._file = open(self.path, 'a')
+
+    def _load(self):
+        end_of_events = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError("No end of line")
+                    event = json.loads(line)
+                except ValueError:
+                    # Only the last line can be cut off by a crash
+                    logger.warning("Removing partly written journal line")
+                    break
+                self._apply(event)
+                end_of_events += len(line)
+
+        # New events must not end up after a partly written one
+        os.truncate(self.path, end_of_events)
+
+    def _apply(self, event):
+        """Update the state with an event
+
+        Args:
+            event (dict): Event that was saved
+        """
+        if event['event'] == 'plan':
+            self.plan = set(map(tuple, event['items']))
+
+        elif event['event'] == 'start':
+            self.archives[event['file_number']] = {
+                'target_key': event['target_key'],
+                'upload_id': event['upload_id'],
+                'parts': {},
+                'complete': False,
+            }
+
+        elif event['event'] == 'part':
+            archive = self.archives[event['file_number']]
+            archive['parts'][event['part_number']] = {
+                'etag': event['etag'],
+                'size': event['size'],
+                'items': set(map(tuple, event['items'])),
+                'boundary': event['boundary'],
+                'partial': event.get('partial'),
+                'members': event.get('members', []),
+            }
+
+        elif event['event'] == 'resume':
+            # Parts after this get uploaded again
+            archive = self.archives[event['file_number']]
+            archive['parts'] = {
+                part_number: part
+                for part_number, part in archive['parts'].items()
+                if part_number <= event['part_number']
+            }
+
+        elif event['event'] == 'complete':
+            self.archives[event['file_number']]['complete'] = True
+
+    def _save(self, event):
+        with self._lock:
+            self._apply(event)
+            self._file.write(json.dumps(event) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def save_plan(self, items):
+        """Save all of the items the job is going to add
+
+        Args:
+            items (iterable): The `(tar_member_name, key)` items
+        """
+        self._save({'event': 'plan', 'items': sorted(items)})
+
+    def start_archive(self, file_number, target_key, upload_id):
+        """Save that a multipart upload was started for an archive
+
+        Args:
+            file_number (int): Number of the archive
+            target_key (str): Key the archive is uploaded to
+            upload_id (str): Id of the multipart upload
+        """
+        self._save({
+            'event': 'start',
+            'file_number': file_number,
+            'target_key': target_key,
+            'upload_id': upload_id,
+        })
+
+    def save_part(self, file_number, part_number, etag, size, items,
+                  boundary, partial=None, members=None):
+        """Save a part once it has been uploaded
+
+        Args:
+            file_number (int): Number of the archive
+            part_number (int): Part number of the part
+            etag (str): ETag of the part
+            size (int): Size of the part
+            items (iterable): Items that were finished in this part
+            boundary (bool): If the archive can be continued right after
+                this part
+            partial (tuple, optional): Tar member name, key & offset of
+                the item that is partly in the parts up to this one.
+                Defaults to None.
+            members (list, optional): Member index entries of the items
+                that were finished in this part. Defaults to None.
+        """
+        event = {
+            'event': 'part',
+            'file_number': file_number,
+            'part_number': part_number,
+            'etag': etag,
+            'size': size,
+            'items': sorted(items),
+            'boundary': boundary,
+            'partial': partial,
+        }
+        if members is not None:
+            event['members'] = members
+        self._save(event)
+
+    def resume_archive(self, file_number, part_number):
+        """Save that an archive is being continued after a part, any parts
+        after it will be uploaded again
+
+        Args:
+            file_number (int): Number of the archive
+            part_number (int): Last part that is kept
+        """
+        self._save({
+            'event': 'resume',
+            'file_number': file_number,
+            'part_number': part_number,
+        })
+
+    def complete_archive(self, file_number):
+        """Save that an archive was completed
+
+        Args:
+            file_number (int): Number of the archive
+        """
+        self._save({'event': 'complete', 'file_number': file_number})
+
+    def archive_items(self, file_number):
+        """Get every item that was finished in an archive
+
+        Args:
+            file_number (int): Number of the archive
+
+        Returns:
+            set: The `(tar_member_name, key)` items
+        """
+        items = set()
+        for part in self.archives[file_number]['parts'].values():
+            items |= part['items']
+        return items
+
+    def close(self):
+        self._file.close()
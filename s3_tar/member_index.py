@@ -0,0 +1,80 @@
+import json
+from .planner import header_size, padded_size
+
+# Added to the key of an archive to get the key of its index
+INDEX_SUFFIX = '.index'
+# What each member of the index has, in order
+INDEX_FIELDS = ('name', 'key', 'header_offset', 'data_offset', 'length',
+                'size', 'mtime')
+
+
+def index_entry(tar_member_name, key, start, end, size, mtime,
+                compressed=False):
+    """Create the index entry of a member of an archive
+
+    Args:
+        tar_member_name (str): Filename and path of the file inside the tar
+        key (str): S3 key of the source file
+        start (int): Offset in the archive the member starts at
+        end (int): Offset in the archive the member ends at, exclusive
+        size (int): Size of the file
+        mtime (float): Last modified timestamp of the file
+        compressed (bool, optional): If each member of the archive is
+            compressed on its own. Defaults to False.
+
+    Returns:
+        list: Values of the `INDEX_FIELDS`
+    """
+    if compressed is True:
+        # Only known once the member is decompressed on its own
+        data_offset = header_size(tar_member_name, size, mtime)
+    else:
+        data_offset = end - padded_size(size)
+    return [tar_member_name, key, start, data_offset, end - start, size,
+            int(round(mtime))]
+
+
+def dump_index(archive_key, compression_type, members):
+    """Create the index of an archive
+
+    The offsets of a member are in the archive as it is in s3.
+    `header_offset` & `length` are the range of the member. For `.tar`
+    files `data_offset` is where the file's data starts in the archive.
+    When each member is compressed on its own, the range holds only that
+    member, compressed as one or more streams one after another (large
+    files compressed on many threads are many streams), and `data_offset`
+    is where the file's data starts once it is decompressed.
+
+    Args:
+        archive_key (str): Key of the archive
+        compression_type (str): `gz`, `bz2`, `xz`, `zst`, `lz4` or None
+        members (list): Entries from `index_entry`
+
+    Returns:
+        bytes: The index as compact json
+    """
+    return json.dumps({
+        'archive': archive_key,
+        'compression': compression_type,
+        'fields': INDEX_FIELDS,
+        'members': members,
+    }, separators=(',', ':')).encode('utf-8')
+
+
+def load_index(data):
+    """Read an index created by `dump_index`
+
+    Args:
+        data (bytes|str): The index
+
+    Returns:
+        dict: The `archive`, its `compression` & its `members`, each as
+            a dict of the `INDEX_FIELDS`
+    """
+    index = json.loads(data)
+    fields = index['fields']
+    return {
+        'archive': index['archive'],
+        'compression': index['compression'],
+        'members': [dict(zip(fields, member)) for member in index['members']],
+    }
@@ -0,0 +1,47 @@
+import threading
+
+
+class MemoryBudget:
+    """Limit how many bytes of files are held in memory at a time
+
+    Space is reserved before a file is downloaded, and given back once it
+    has been added to a part. Reservations are made one at a time, so a
+    large file waiting for space is not passed over by small ones.
+    """
+
+    def __init__(self, limit):
+        """
+        Args:
+            limit (int): Max number of bytes reserved at a time
+        """
+        self.limit = limit
+        self.used = 0
+
+        self._condition = threading.Condition()
+        self._reserve_lock = threading.Lock()
+
+    def reserve(self, size):
+        """Block until there is space for `size` bytes, then reserve it
+
+        Something larger then the whole limit gets reserved once nothing
+        else is, so it can not wait forever
+
+        Args:
+            size (int): Number of bytes to reserve
+        """
+        with self._reserve_lock:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self.used + size <= self.limit or self.used == 0
+                )
+                self.used += size
+
+    def release(self, size):
+        """Give back space that was reserved
+
+        Args:
+            size (int): Number of bytes to give back
+        """
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import bisect
+import tempfile
+import threading
+import contextlib
+import collections
+
+# Stages whose latency is measured, each list/head/get/upload is a request
+STAGES = (
+    'list',  # Listing a page of keys
+    'head',  # Head request of a file
+    'get',  # Download of a file or a range of one
+    'pack',  # Adding a file to a tar
+    'compress',  # Compressing a chunk of data
+    'upload_part',  # Upload (or server side copy) of a part
+    'cache_get_wait',  # Building a part waits for a file to be downloaded
+    'cache_put_wait',  # A downloaded file waits for room in the file cache
+)
+# Upper bound of each latency bucket in seconds, like a prometheus histogram
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+class Histogram:
+    """Count of the values that fall in each bucket, and their total"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        """Cumulative counts by upper bound, the same as prometheus"""
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + ('+Inf',),
+                                self.bucket_counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'buckets': buckets,
+        }
+
+
+class Metrics:
+    """Counters, gauges and latency histograms of a job, safe to update
+    from many threads
+
+    Counters:
+        bytes_in: Bytes downloaded from the source files
+        bytes_out: Bytes of the parts uploaded
+        bytes_copied: Bytes copied into the tar by s3
+        files_listed: Files found while listing
+        files_added: Files added to a part
+        parts_uploaded: Parts uploaded or copied
+        archives_completed: Tar files completed
+
+    Gauges (each one also has a `_max`):
+        files_total: Files to tar
+        bytes_total: Size of the files to tar, of the ones that are known
+        cache_files: Files in the file cache ready to be added to a part
+    """
+
+    def __init__(self, progress_callback=None, progress_interval=1.0):
+        """
+        Args:
+            progress_callback (function, optional): Called with this object
+                as the job makes progress, at most once every
+                `progress_interval` seconds and once at the end.
+                Defaults to None.
+            progress_interval (float, optional): Min seconds between calls
+                to `progress_callback`. Defaults to 1.0.
+        """
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.latency = {stage: Histogram() for stage in STAGES}
+
+        self._start = time.monotonic()
+        self._last_report = None
+        self._lock = threading.Lock()
+
+    def add(self, name, value=1):
+        """Add to a counter"""
+        with self._lock:
+            self.counters[name] += value
+
+    def set(self, name, value):
+        """Set a gauge, and the max it has been"""
+        with self._lock:
+            self.gauges[name] = value
+            max_name = name + '_max'
+            self.gauges[max_name] = max(self.gauges.get(max_name, value),
+                                        value)
+
+    def observe(self, stage, seconds):
+        """Add the latency of a stage"""
+        with self._lock:
+            self.latency[stage].observe(seconds)
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        """Measure the latency of the code in the `with` block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    @property
+    def elapsed(self):
+        """float: Seconds since the job was created"""
+        return time.monotonic() - self._start
+
+    def snapshot(self):
+        """Get the current value of everything
+
+        Returns:
+            dict: `elapsed` seconds, `counters`, `gauges`, `throughput`
+                in MB/s and `latency` of each stage (see `Histogram.to_dict`)
+        """
+        elapsed = self.elapsed
+        with self._lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            latency = {stage: histogram.to_dict()
+                       for stage, histogram in self.latency.items()}
+
+        throughput = {}
+        for name in ('bytes_in', 'bytes_out'):
+            throughput[name.replace('bytes', 'mb_per_sec')] = round(
+                counters.get(name, 0) / 1024**2 / max(elapsed, 1e-9), 3
+            )
+        throughput['files_per_sec'] = round(
+            counters.get('files_added', 0) / max(elapsed, 1e-9), 3
+        )
+        return {
+            'elapsed': round(elapsed, 3),
+            'counters': counters,
+            'gauges': gauges,
+            'throughput': throughput,
+            'latency': latency,
+        }
+
+    def to_json(self):
+        """str: `snapshot` as json"""
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self, prefix='s3_tar'):
+        """Get everything in the prometheus text format, e.g. for the
+        node exporter's textfile collector
+
+        Args:
+            prefix (str, optional): Added to the name of each metric.
+                Defaults to 's3_tar'.
+
+        Returns:
+            str: The metrics
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.append('{}_{}_total {}'.format(prefix, name, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append('# TYPE {}_{} gauge'.format(prefix, name))
+            lines.append('{}_{} {}'.format(prefix, name, value))
+
+        name = '{}_latency_seconds'.format(prefix)
+        lines.append('# TYPE {} histogram'.format(name))
+        for stage, histogram in snapshot['latency'].items():
+            for bound, count in histogram['buckets'].items():
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'
+                             .format(name, stage, bound, count))
+            lines.append('{}_sum{{stage="{}"}} {}'
+                         .format(name, stage, histogram['sum']))
+            lines.append('{}_count{{stage="{}"}} {}'
+                         .format(name, stage, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Save the metrics to a file, replacing it all at once so it is
+        never read half written
+
+        Args:
+            path (str): Saved in the prometheus text format if it ends with
+                `.prom`, otherwise as json
+        """
+        if path.endswith('.prom'):
+            contents = self.to_prometheus()
+        else:
+            contents = self.to_json()
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+        )
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
+
+    def progress_line(self):
+        """str: Single line summary of the progress so far"""
+        snapshot = self.snapshot()
+        counters = snapshot['counters']
+        gauges = snapshot['gauges']
+
+        files = '{} files'.format(counters.get('files_added', 0))
+        if gauges.get('files_total'):
+            files = '{}/{} files ({:.1%})'.format(
+                counters.get('files_added', 0), gauges['files_total'],
+                counters.get('files_added', 0) / gauges['files_total'],
+            )
+
+        waits = snapshot['latency']
+        return ("{}, {:.1f} MB in ({:.1f} MB/s), {:.1f} MB out"
+                " ({:.1f} MB/s), {} parts, {} files in the cache (max {}),"
+                " waited {:.1f}s for downloads, {:.1f}s for room"
+                " in the cache".format(
+                    files,
+                    counters.get('bytes_in', 0) / 1024**2,
+                    snapshot['throughput']['mb_per_sec_in'],
+                    counters.get('bytes_out', 0) / 1024**2,
+                    snapshot['throughput']['mb_per_sec_out'],
+                    counters.get('parts_uploaded', 0),
+                    gauges.get('cache_files', 0),
+                    gauges.get('cache_files_max', 0),
+                    waits['cache_get_wait']['sum'],
+                    waits['cache_put_wait']['sum'],
+                ))
+
+    def report(self, force=False):
+        """Call the progress callback if it has not been called for
+        `progress_interval` seconds
+
+        Args:
+            force (bool, optional): Call it no matter when it was last
+                called. Defaults to False.
+        """
+        if self.progress_callback is None:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            if (force is False and self._last_report is not None
+                    and now - self._last_report < self.progress_interval):
+                return
+            self._last_report = now
+        self.progress_callback(self)
+
+
+class TimedCompressor:
+    """Measures the latency of each call to a compressor"""
+
+    def __init__(self, compressor, metrics):
+        self.compressor = compressor
+        self.metrics = metrics
+
+    def compress(self, data):
+        with self.metrics.time('compress'):
+            return self.compressor.compress(data)
+
+    def flush(self):
+        with self.metrics.time('compress'):
+            return self.compressor.flush()
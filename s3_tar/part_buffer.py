@@ -0,0 +1,113 @@
+import io
+import bisect
+
+
+class PartBuffer(io.IOBase):
+    """Contents of a part, kept as the list of chunks it was written in
+
+    Writing keeps each chunk as is rather then copying it into one large
+    buffer, and reading goes across the chunks. So it can be passed as the
+    body of an upload, which streams it out without it ever being joined.
+    Data is always written to the end.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._chunk_starts = []  # Offset each chunk starts at
+        self._size = 0
+        self._position = 0
+
+    def _check_closed(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed part buffer")
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def write(self, data):
+        """Add data to the end of the part
+
+        Args:
+            data (bytes): Kept as is. Anything else (bytearray, memoryview)
+                is copied, since it could change after being written
+
+        Returns:
+            int: Number of bytes written
+        """
+        self._check_closed()
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        if data:
+            self._chunks.append(data)
+            self._chunk_starts.append(self._size)
+            self._size += len(data)
+        self._position = self._size
+        return len(data)
+
+    def read(self, size=-1):
+        """Read from the current position, across chunks
+
+        Reading a whole chunk returns the chunk itself, without a copy
+
+        Args:
+            size (int, optional): Max number of bytes to read.
+                Defaults to -1, which reads to the end.
+
+        Returns:
+            bytes: The data read
+        """
+        self._check_closed()
+        if size is None or size < 0:
+            size = self._size - self._position
+
+        pieces = []
+        while size > 0 and self._position < self._size:
+            index = bisect.bisect_right(self._chunk_starts, self._position) - 1
+            chunk = self._chunks[index]
+            offset = self._position - self._chunk_starts[index]
+            if offset == 0 and size >= len(chunk):
+                piece = chunk
+            else:
+                piece = chunk[offset:offset + size]
+            pieces.append(piece)
+            self._position += len(piece)
+            size -= len(piece)
+
+        if len(pieces) == 1:
+            return pieces[0]
+        return b''.join(pieces)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._check_closed()
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self._position = offset
+        return self._position
+
+    def tell(self):
+        self._check_closed()
+        return self._position
+
+    def getvalue(self):
+        """Get all of the data joined together, this makes a copy
+
+        Returns:
+            bytes: The contents of the part
+        """
+        self._check_closed()
+        return b''.join(self._chunks)
+
+    def close(self):
+        self._chunks = []
+        self._chunk_starts = []
+        super().close()
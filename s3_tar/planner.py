@@ -0,0 +1,172 @@
+import math
+import tarfile
+
+
+def member_size(tar_member_name, size, mtime=0):
+    """Get the size a file takes up inside of an (uncompressed) tar
+
+    Args:
+        tar_member_name (str): Filename and path of the file inside the tar
+        size (int): Size of the file
+        mtime (int|float, optional): Last modified timestamp of the file.
+            Defaults to 0.
+
+    Returns:
+        int: Size of the header, the file and its padding
+    """
+    return header_size(tar_member_name, size, mtime) + padded_size(size)
+
+
+def header_size(tar_member_name, size, mtime=0):
+    """Get the size of the header(s) of a file inside of a tar
+
+    Args:
+        tar_member_name (str): Filename and path of the file inside the tar
+        size (int): Size of the file
+        mtime (int|float, optional): Last modified timestamp of the file.
+            Defaults to 0.
+
+    Returns:
+        int: Size of the headers
+    """
+    if (len(tar_member_name) > 100 or not tar_member_name.isascii()
+            or size >= 8**11 or isinstance(mtime, float)):
+        # Long names, unicode, large sizes & float timestamps need
+        # an extra pax header
+        info = tarfile.TarInfo(name=tar_member_name)
+        info.size = size
+        info.mtime = mtime
+        return len(info.tobuf(tarfile.DEFAULT_FORMAT,
+                              tarfile.ENCODING,
+                              'surrogateescape'))
+    return tarfile.BLOCKSIZE
+
+
+def padded_size(size):
+    """Get the size of a file's data inside of a tar, padded to blocks
+
+    Args:
+        size (int): Size of the file
+
+    Returns:
+        int: Size of the data and its padding
+    """
+    blocks = -(-size // tarfile.BLOCKSIZE)
+    return blocks * tarfile.BLOCKSIZE
+
+
+def _split(sizes, max_size, num_archives):
+    """Cut the files into about `num_archives` archives of even size
+
+    Args:
+        sizes (list): Size of each file, in order
+        max_size (int): Max size of an archive
+        num_archives (int): Number of archives to aim for
+
+    Returns:
+        list: Start index, end index & size of each archive
+    """
+    target_size = sum(sizes) / num_archives
+
+    archives = []
+    start = 0
+    archive_size = 0
+    added_size = 0
+    for i, size in enumerate(sizes):
+        if i > start:
+            # Cut at the end of the file closest to the next even share
+            share_end = target_size * (len(archives) + 1)
+            past_share = (len(archives) < num_archives - 1
+                          and added_size + size > share_end
+                          and (share_end - added_size
+                               <= added_size + size - share_end))
+            if past_share or archive_size + size > max_size:
+                archives.append((start, i, archive_size))
+                start = i
+                archive_size = 0
+        archive_size += size
+        added_size += size
+    archives.append((start, len(sizes), archive_size))
+    return archives
+
+
+def _fill(sizes, max_size):
+    """Fill each archive up to `max_size` before starting the next one
+
+    This takes the fewest archives that keep the files in order
+
+    Args:
+        sizes (list): Size of each file, in order
+        max_size (int): Max size of an archive
+
+    Returns:
+        list: Start index, end index & size of each archive
+    """
+    archives = []
+    start = 0
+    archive_size = 0
+    for i, size in enumerate(sizes):
+        if i > start and archive_size + size > max_size:
+            archives.append((start, i, archive_size))
+            start = i
+            archive_size = 0
+        archive_size += size
+    archives.append((start, len(sizes), archive_size))
+    return archives
+
+
+def _balance(sizes, max_size, num_archives):
+    """Fill `num_archives` archives with the smallest max size they fit in
+
+    Args:
+        sizes (list): Size of each file, in order
+        max_size (int): Max size of an archive, fits in `num_archives`
+        num_archives (int): Number of archives to use
+
+    Returns:
+        list: Start index, end index & size of each archive
+    """
+    low = math.ceil(sum(sizes) / num_archives)
+    high = max_size
+    while low < high:
+        mid = (low + high) // 2
+        if len(_fill(sizes, mid)) <= num_archives:
+            high = mid
+        else:
+            low = mid + 1
+    return _fill(sizes, high)
+
+
+def plan_archives(sizes, max_size, min_size=None):
+    """Split files into archives of about the same size, keeping their order
+
+    Uses as few archives as possible without going over `max_size`, each
+    cut where it is closest to an even share of the total. If the files do
+    not cut that evenly, the largest archive is kept as small as it can be.
+    A file larger then `max_size` gets an archive of its own.
+
+    Args:
+        sizes (list): Size of each file, in the order they are added
+        max_size (int): Max size of an archive
+        min_size (int, optional): Min size of an archive. A last archive
+            smaller then this is merged into the one before it, if they fit.
+            Defaults to None.
+
+    Returns:
+        list: Start and end (exclusive) index of the files in each archive
+    """
+    if not sizes:
+        return []
+
+    num_archives = len(_fill(sizes, max_size))
+    archives = _split(sizes, max_size, num_archives)
+    if len(archives) > num_archives:
+        archives = _balance(sizes, max_size, num_archives)
+
+    if min_size is not None and len(archives) > 1:
+        last_start, last_end, last_size = archives[-1]
+        prev_start, prev_end, prev_size = archives[-2]
+        if last_size < min_size and prev_size + last_size <= max_size:
+            archives[-2:] = [(prev_start, last_end, prev_size + last_size)]
+
+    return [(start, end) for start, end, archive_size in archives]
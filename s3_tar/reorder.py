@@ -0,0 +1,60 @@
+import threading
+
+
+class ReorderBuffer:
+    """Release values in order, while they are created out of order
+
+    Each value is numbered by its place in the order. Values that are ready
+    early are held until every value before them has been released, and no
+    value may be created more then `window` places ahead of the next one to
+    be released, so only that many are held at a time.
+    """
+
+    def __init__(self, release, window):
+        """
+        Args:
+            release (function): Called with each value, in order
+            window (int): How far ahead of the next value to be released
+                values can be created
+        """
+        self.release = release
+        self.window = window
+
+        self._next_index = 0
+        self._ready = {}
+        self._condition = threading.Condition()
+
+    def wait_turn(self, index):
+        """Block until the value at `index` is within the window
+
+        Args:
+            index (int): Place of the value in the order
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: index < self._next_index + self.window
+            )
+
+    def add(self, index, values):
+        """Add the values for a place in the order, and release everything
+        that is now next in line
+
+        Args:
+            index (int): Place of the values in the order
+            values (list): Values to release, in order. Can be empty
+        """
+        with self._condition:
+            self._ready[index] = values
+            while self._next_index in self._ready:
+                for value in self._ready.pop(self._next_index):
+                    self.release(value)
+                self._next_index += 1
+            self._condition.notify_all()
+
+    def skip(self, index):
+        """Let values after `index` be released, when it has nothing
+
+        Args:
+            index (int): Place in the order that failed
+        """
+        self.add(index, [])
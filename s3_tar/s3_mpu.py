@@ -1,56 +1,290 @@
+import io
+import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .checksums import md5_of, etag_matches, multipart_etag
 
 logger = logging.getLogger(__name__)
 
 
 class S3MPU:
 
-    def __init__(self, s3, target_bucket, target_key):
+    def __init__(self, s3, target_bucket, target_key, max_in_flight=None,
+                 upload_id=None, on_part_saved=None, verify=False,
+                 metrics=None):
+        """
+        Args:
+            s3 (botocore.client.S3): S3 client to use
+            target_bucket (str): Bucket to upload to
+            target_key (str): Key to upload to
+            max_in_flight (int, optional): Max number of parts to upload
+                at the same time in the background. Defaults to None,
+                which uploads each part before `upload_part` returns.
+            upload_id (str, optional): Continue this multipart upload
+                rather then starting a new one. Defaults to None.
+            on_part_saved (function, optional): Called with the part number
+                and ETag of each part once it is uploaded. Defaults to None.
+            verify (bool, optional): Check the ETag s3 gives each part
+                against the MD5 of what was sent, and the ETag of the
+                whole file once it is complete. Defaults to False.
+            metrics (Metrics, optional): Add the time each part takes to
+                upload, and its size, to these. Defaults to None.
+        """
         self.s3 = s3
         self.target_bucket = target_bucket
         self.target_key = target_key
         self.parts_mapping = []
+        self.max_in_flight = max_in_flight
+        self.on_part_saved = on_part_saved
+        self.verify = verify
+        self.metrics = metrics
+        self.etag = None  # ETag of the file once it is complete
+
+        self._part_num = 0
+        self._lock = threading.Lock()
+        self._futures = []
+        self._executor = None
+        if self.max_in_flight is not None:
+            self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+            # Limits the number of parts held in memory waiting to upload
+            self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+        if upload_id is not None:
+            logger.info("Resuming file {}".format(self.target_key))
+            self.resp = {'UploadId': upload_id}
+        else:
+            logger.info("Creating file {}".format(self.target_key))
+            self.resp = self.s3.create_multipart_upload(
+                Bucket=self.target_bucket,
+                Key=self.target_key,
+            )
+            logger.debug("Multipart upload start: {}".format(self.resp))
+        self.upload_id = self.resp['UploadId']
+
+    @property
+    def next_part_number(self):
+        """int: Part number the next part uploaded will get"""
+        return self._part_num + 1
+
+    def list_parts(self):
+        """Get the parts s3 already has for this upload
+
+        Returns:
+            dict: ETag & Size of each part, by part number
+        """
+        parts = {}
+        kwargs = {}
+        while True:
+            resp = self.s3.list_parts(
+                Bucket=self.target_bucket,
+                Key=self.target_key,
+                UploadId=self.upload_id,
+                **kwargs
+            )
+            for part in resp.get('Parts', []):
+                parts[part['PartNumber']] = {
+                    'ETag': part['ETag'],
+                    'Size': part['Size'],
+                }
+            if resp.get('IsTruncated') is not True:
+                return parts
+            kwargs['PartNumberMarker'] = resp['NextPartNumberMarker']
+
+    def keep_parts(self, parts):
+        """Use parts that were uploaded before as the start of the file,
+        new parts are numbered after them
+
+        Args:
+            parts (list): ETag & PartNumber of each part to keep
+        """
+        with self._lock:
+            self.parts_mapping = list(parts)
+            self._part_num = max([part['PartNumber'] for part in parts],
+                                 default=0)
+
+    def abort(self):
+        """Cancel the multipart upload and remove the parts s3 has
+
+        Parts waiting to be uploaded in the background are cancelled, and
+        the ones uploading are waited for so s3 does not keep them
+        """
+        if self._executor is not None:
+            for future in self._futures:
+                future.cancel()
+            self._executor.shutdown()
 
-        logger.info("Creating file {}".format(self.target_key))
-        self.resp = self.s3.create_multipart_upload(
+        logger.info("Aborting file {}".format(self.target_key))
+        self.s3.abort_multipart_upload(
             Bucket=self.target_bucket,
             Key=self.target_key,
+            UploadId=self.upload_id,
         )
-        logger.debug("Multipart upload start: {}".format(self.resp))
 
     def upload_part(self, source_io):
         """Upload a part of the multipart upload
 
-        Save to a parts mapping, needed to complete the multipart upload
+        Save to a parts mapping, needed to complete the multipart upload.
+        If `max_in_flight` is set, the part is uploaded in the background
+        and this will only block while that many parts are uploading.
 
         Args:
             source_io (io.BytesIO): BytesIO object to upload
 
         Returns:
-            bool: If the upload was successful
+            bool: If the upload was successful. When uploading in the
+                background, if the part was accepted to be uploaded
+        """
+        source_io.seek(0)
+        return self._submit(self._upload_part, source_io)
+
+    def upload_part_copy(self, source_bucket, source_key, start, end):
+        """Copy a range of an s3 file in as the next part, server side
+
+        The data never has to be downloaded or uploaded by us
+
+        Args:
+            source_bucket (str): Bucket of the file to copy from
+            source_key (str): Key of the file to copy from
+            start (int): Offset of the first byte to copy
+            end (int): Offset to stop copying at, exclusive
+
+        Returns:
+            bool: If the copy was successful. When uploading in the
+                background, if the part was accepted to be copied
         """
+        return self._submit(self._upload_part_copy,
+                            source_bucket, source_key, start, end)
+
+    def _submit(self, upload_fn, *args):
+        """Give the next part number to a part and upload it, either
+        right away or in the background
+
+        Args:
+            upload_fn (function): Called with the part number and `args`
+
+        Returns:
+            bool: Result of `upload_fn`, or True if it is in the background
+        """
+        with self._lock:
+            self._part_num += 1
+            part_num = self._part_num
+
+        if self._executor is None:
+            return upload_fn(part_num, *args)
+
+        self._in_flight.acquire()
+        future = self._executor.submit(upload_fn, part_num, *args)
+        future.add_done_callback(lambda f: self._in_flight.release())
+        self._futures.append(future)
+        return True
 
-        part_num = len(self.parts_mapping) + 1
+    def _upload_part(self, part_num, source_io):
+        """Upload a single part to s3
+
+        Args:
+            part_num (int): The part number of this part
+            source_io (io.IOBase): File like object to upload, it is
+                streamed as the body rather then read into memory first
+
+        Returns:
+            bool: If the upload was successful
+        """
         logger.info("Uploading part {} of {}"
                     .format(part_num, self.target_key))
 
+        md5 = None
+        if self.verify is True:
+            md5 = md5_of(source_io)
+
+        size = source_io.seek(0, io.SEEK_END)
         source_io.seek(0)
+        start = time.perf_counter()
         resp = self.s3.upload_part(
             Bucket=self.target_bucket,
             Key=self.target_key,
             PartNumber=part_num,
-            UploadId=self.resp['UploadId'],
-            Body=source_io.read(),
+            UploadId=self.upload_id,
+            Body=source_io,
         )
+        self._track_part('bytes_out', size, start)
         source_io.close()  # Cleanup
         logger.debug("Multipart upload part: {}".format(resp))
+        if (md5 is not None
+                and etag_matches(resp.get('ETag'), md5, resp) is False):
+            raise ValueError("Part {} of {} has the ETag {}, but the md5 of"
+                             " what was sent is {}"
+                             .format(part_num, self.target_key,
+                                     resp.get('ETag'), md5))
+
+        return self._save_part(part_num, resp, resp.get('ETag'))
+
+    def _upload_part_copy(self, part_num, source_bucket, source_key,
+                          start, end):
+        """Copy a range of an s3 file as a single part
 
+        Args:
+            part_num (int): The part number of this part
+            source_bucket (str): Bucket of the file to copy from
+            source_key (str): Key of the file to copy from
+            start (int): Offset of the first byte to copy
+            end (int): Offset to stop copying at, exclusive
+
+        Returns:
+            bool: If the copy was successful
+        """
+        logger.info("Copying part {} of {} from {}"
+                    .format(part_num, self.target_key, source_key))
+
+        request_start = time.perf_counter()
+        resp = self.s3.upload_part_copy(
+            Bucket=self.target_bucket,
+            Key=self.target_key,
+            PartNumber=part_num,
+            UploadId=self.upload_id,
+            CopySource={'Bucket': source_bucket, 'Key': source_key},
+            CopySourceRange='bytes={}-{}'.format(start, end - 1),
+        )
+        self._track_part('bytes_copied', end - start, request_start)
+        logger.debug("Multipart upload part copy: {}".format(resp))
+
+        return self._save_part(part_num, resp,
+                               resp.get('CopyPartResult', {}).get('ETag'))
+
+    def _track_part(self, counter, size, start):
+        """Add a part that was sent to the metrics
+
+        Args:
+            counter (str): Counter to add the size of the part to
+            size (int): Size of the part in bytes
+            start (float): `time.perf_counter()` when the request started
+        """
+        if self.metrics is None:
+            return
+        self.metrics.observe('upload_part', time.perf_counter() - start)
+        self.metrics.add(counter, size)
+        self.metrics.add('parts_uploaded')
+
+    def _save_part(self, part_num, resp, etag):
+        """Save the part to the parts mapping if it was uploaded
+
+        Args:
+            part_num (int): The part number of this part
+            resp (dict): Response from s3 for the part
+            etag (str): ETag of the part
+
+        Returns:
+            bool: If the part was uploaded successfully
+        """
         resp_status_code = resp['ResponseMetadata']['HTTPStatusCode']
         if resp_status_code == 200:
-            self.parts_mapping.append({
-                'ETag': resp['ETag'],
-                'PartNumber': part_num,
-            })
+            with self._lock:
+                self.parts_mapping.append({
+                    'ETag': etag,
+                    'PartNumber': part_num,
+                })
+            if self.on_part_saved is not None:
+                self.on_part_saved(part_num, etag)
             return True
 
         return False
@@ -58,14 +292,37 @@ class S3MPU:
     def complete(self):
         """Complete to multipart upload in s3
 
+        Waits for any parts still uploading first. If any of them failed,
+        the error is raised here.
+
         Returns:
             bool: If the upload was successful
         """
+        if self._executor is not None:
+            try:
+                for future in self._futures:
+                    future.result()
+            finally:
+                self._executor.shutdown()
+
+        # Parts may have finished uploading out of order
+        self.parts_mapping.sort(key=lambda part: part['PartNumber'])
         resp = self.s3.complete_multipart_upload(
             Bucket=self.target_bucket,
             Key=self.target_key,
-            UploadId=self.resp['UploadId'],
+            UploadId=self.upload_id,
             MultipartUpload={'Parts': self.parts_mapping},
         )
         logger.debug("Multipart upload complete: {}".format(resp))
+        self.etag = resp.get('ETag')
+
+        if self.verify is True:
+            expected_etag = multipart_etag(
+                [part['ETag'] for part in self.parts_mapping]
+            )
+            if self.etag != expected_etag:
+                raise ValueError("{} has the ETag {}, but its parts make {}"
+                                 .format(self.target_key, self.etag,
+                                         expected_etag))
+
         return resp['ResponseMetadata']['HTTPStatusCode'] == 200
@@ -1,15 +1,77 @@
 import io
+import os
 import json
 import time
 import boto3
+import queue
 import logging
 import tarfile
 import threading
+import functools
+import collections
+import botocore.exceptions
+from concurrent.futures import ThreadPoolExecutor
 from .s3_mpu import S3MPU
-from .utils import _create_s3_client, _convert_to_bytes, _threads, MIN_S3_SIZE
+from .async_engine import AsyncTarEngine, create_async_s3_client
+from .journal import Journal
+from .reorder import ReorderBuffer
+from .memory_budget import MemoryBudget
+from .part_buffer import PartBuffer
+from .planner import member_size, plan_archives
+from .member_index import INDEX_SUFFIX, index_entry, dump_index
+from .tar_listing import get_index, walk_headers
+from .metrics import Metrics, TimedCompressor
+from .checksums import Checksum, MANIFEST_SUFFIX, etag_matches, dump_manifest
+from .compression import ParallelGzipCompressor, ParallelBz2Compressor
+from .tar_member import TarMemberStream
+from .utils import (_create_s3_client, _create_compressor, _convert_to_bytes,
+                    _check_compression_type, _create_buffer, _threads,
+                    _get_compression_type, _get_delete_errors,
+                    MIN_S3_SIZE, MAX_S3_SIZE, COMPRESSION_LEVELS,
+                    DELETE_BATCH_SIZE, DELETE_RETRY_DELAY)
 
 logger = logging.getLogger(__name__)
 
+# Added to the file cache once every file has been added to it
+_END_OF_CACHE = object()
+# Added to the file cache after the files of each planned archive
+_END_OF_ARCHIVE = object()
+# Most files to download at the same time with a memory budget
+_MAX_DOWNLOAD_THREADS = 64
+# Seconds between checks if the other archives failed, while an archive
+# built at the same time waits for a file
+_STOP_CHECK_INTERVAL = 0.1
+
+# What is known about a source file, saved from listing/get/head responses
+# so the same info never needs to be requested twice.
+# `metadata` is None until a get or head request has been made
+SourceInfo = collections.namedtuple(
+    'SourceInfo', ['size', 'mtime', 'etag', 'metadata']
+)
+
+
+class _ArchiveState(threading.local):
+    """Where a thread is at in building an archive. Each thread building
+    an archive at the same time has its own
+    """
+
+    def __init__(self):
+        # Cache of the archive being built, if it does not use the shared one
+        self.file_cache = None
+        self.cache_done = False  # Set once the end of the cache is reached
+        self.current_source = None  # io object being added to parts
+        self.current_source_offset = 0  # Bytes of it added to parts so far
+        self.archive_done = False  # Set at the end of a planned archive
+        self.packed_items = []  # Items finished since the last part
+        # Bytes of the archive before the part being built
+        self.archive_offset = 0
+        self.member_start = 0  # Offset in the archive the file started at
+        self.index_members = []  # Index entries of the archive so far
+        self.tracked_members = 0  # Number of them already in a part
+        # Files fully added to the archive so far, if verifying or
+        # removing keys
+        self.archive_items = []
+
 
 class S3Tar:
 
@@ -19,9 +81,27 @@ class S3Tar:
                  cache_size=5,
                  save_metadata=False,
                  remove_keys=False,
+                 incremental_remove=False,
                  allow_dups=False,
                  s3_max_retries=4,
                  part_size_multiplier=None,
+                 upload_concurrency=2,
+                 server_side_copy=False,
+                 compression_level=None,
+                 single_compression_stream=False,
+                 compression_workers=None,
+                 long_distance_matching=False,
+                 journal_path=None,
+                 deterministic=False,
+                 max_file_size=None,
+                 archive_concurrency=1,
+                 max_memory=None,
+                 spill_size=None,
+                 spill_dir=None,
+                 member_index=False,
+                 verify=False,
+                 progress_callback=None,
+                 progress_interval=1.0,
                  session=boto3.session.Session()):
         self.allow_dups = allow_dups
         self.source_bucket = source_bucket
@@ -35,6 +115,16 @@ class S3Tar:
         else:
             self.min_file_size = None
 
+        # If set, the files are split into archives ahead of time
+        # using the sizes of the files
+        self.max_file_size = None
+        if max_file_size is not None:
+            self.max_file_size = _convert_to_bytes(max_file_size)
+            if (self.min_file_size is not None
+                    and self.min_file_size > self.max_file_size):
+                raise ValueError("Min file size can not be larger then"
+                                 " the max file size")
+
         if self.target_key.endswith('.tar'):
             self.content_type = 'application/x-tar'
             self.compression_type = None
@@ -47,14 +137,96 @@ class S3Tar:
             self.content_type = 'application/x-bzip2'
             self.compression_type = 'bz2'
 
+        elif self.target_key.endswith('.tar.xz'):
+            self.content_type = 'application/x-xz'
+            self.compression_type = 'xz'
+
+        elif self.target_key.endswith('.tar.zst'):
+            self.content_type = 'application/zstd'
+            self.compression_type = 'zst'
+
+        elif self.target_key.endswith('.tar.lz4'):
+            self.content_type = 'application/x-lz4'
+            self.compression_type = 'lz4'
+
         else:
             raise ValueError("Invalid file extension: {}"
                              .format(self.target_key))
+        _check_compression_type(self.compression_type)
 
         self.save_metadata = save_metadata
 
+        self.compression_level = compression_level
+        if self.compression_level is not None:
+            if self.compression_type is None:
+                raise ValueError("Compression level can only be used"
+                                 " with compressed files")
+            min_level, max_level = COMPRESSION_LEVELS[self.compression_type]
+            if not min_level <= self.compression_level <= max_level:
+                raise ValueError("Compression level must be between {} and {}"
+                                 .format(min_level, max_level))
+
+        # Compress the whole tar file as one stream rather then each file
+        # on its own. Makes smaller files, but the compression is no longer
+        # done in the threads downloading the files
+        self.single_compression_stream = single_compression_stream
+        if (self.single_compression_stream is True
+                and self.compression_type is None):
+            raise ValueError("Single compression stream can only be used"
+                             " with compressed files")
+
+        # Threads used to compress large files and the single compression
+        # stream. Small files are already compressed in parallel by the
+        # threads downloading them
+        self.compression_workers = compression_workers
+        self._compression_executor = None
+        if self.compression_workers is not None:
+            if self.compression_workers <= 0:
+                raise ValueError("compression workers must be 1 or larger")
+            if (self.compression_workers > 1
+                    and self.compression_type in ('gz', 'bz2')):
+                # zstd uses its own threads, gzip & bz2 are done in blocks
+                self._compression_executor = ThreadPoolExecutor(
+                    max_workers=self.compression_workers,
+                )
+
+        # Lets zstd find matches across files that are far apart
+        self.long_distance_matching = long_distance_matching
+        if (self.long_distance_matching is True
+                and self.compression_type != 'zst'):
+            raise ValueError("Long distance matching can only be used"
+                             " with .tar.zst files")
+
+        # Upload an index of where each file is in the archive next to it
+        self.member_index = member_index
+        if (self.member_index is True
+                and self.single_compression_stream is True):
+            raise ValueError("Member index can not be used with a single"
+                             " compression stream, the files can not be"
+                             " read on their own")
+
+        # Checksum the data as it passes through and check it against the
+        # ETags s3 has, then upload a manifest of them next to the archive
+        self.verify = verify
+        self._checksums = {}  # Checksum of each source file, by key
+        # Error of each key that did not match its ETag, by key. They are
+        # left out of the archive and never deleted
+        self.failed_verifies = {}
+        if self.verify is True and journal_path is not None:
+            raise ValueError("Verify can not be used with a journal, the"
+                             " files added before a resume are not read")
+
+        # Large files get copied into the tar by s3, rather then being
+        # downloaded and uploaded again
+        self.server_side_copy = server_side_copy
+        if self.server_side_copy is True and self.compression_type is not None:
+            raise ValueError("Server side copy can only be used"
+                             " with .tar files")
+
         self.mode = 'w'
-        if self.compression_type is not None:
+        if (self.compression_type is not None
+                and self.single_compression_stream is False):
+            # Each file gets compressed on its own
             self.mode += '|' + self.compression_type
 
         if part_size_multiplier is None:
@@ -66,130 +238,1073 @@ class S3Tar:
                                " Defaulting to 10")
                 self.part_size_multiplier = 10
             self.part_size_multiplier = part_size_multiplier
+        # Files larger then this are streamed into the tar in chunks
+        # rather then being downloaded into memory all at once
+        self.part_size = MIN_S3_SIZE * self.part_size_multiplier
 
         self.all_keys = set()  # Keys the user adds
+        # Key of each member name in all_keys, to quickly find dup names
+        self.member_names = {}
+        self.source_info = {}  # SourceInfo of keys, by key
         self.keys_to_delete = set()  # Keys to delete on cleanup
         self.remove_keys = remove_keys
-        self.file_cache = []  # io objects that are ready to be combined
+        # Error of each key that could not be deleted, by key
+        self.failed_deletes = {}
+        # Remove the keys of each archive once it is complete, rather then
+        # all of them at the end
+        self.incremental_remove = incremental_remove
+        if self.incremental_remove is True and self.remove_keys is False:
+            raise ValueError("Incremental remove can only be used when"
+                             " removing keys")
+        self._removed_items = set()  # Items already being removed
+        # Items in completed archives, from the journal and this run. Only
+        # these are removed, never files that failed to download
+        self._archived_items = set()
+        # Items already in the parts of each archive being continued,
+        # by file number. Archived once the archive is completed
+        self._resumed_items = {}
+        # Keys that are not in a completed archive, so were not removed
+        self.kept_keys = set()
+        self._remove_futures = []
+        self._remove_executor = None
+        if self.incremental_remove is True:
+            # One archive at a time, each one is deleted in batches
+            # at the same time
+            self._remove_executor = ThreadPoolExecutor(max_workers=1)
         self.cache_size = cache_size
         if self.cache_size is None or self.cache_size <= 0:
             raise ValueError("cache size must be 1 or larger")
+        self._state = _ArchiveState()
+        self._lock = threading.Lock()
+
+        # Number of archives to build and upload at the same time
+        self.archive_concurrency = archive_concurrency
+        if self.archive_concurrency is None or self.archive_concurrency <= 0:
+            raise ValueError("archive concurrency must be 1 or larger")
+        # Set once an archive fails, so the others stop
+        self._stop_archives = threading.Event()
+        if (self.archive_concurrency > 1 and self.min_file_size is None
+                and self.max_file_size is None):
+            raise ValueError("Archive concurrency needs a min or max file"
+                             " size, otherwise there is only one archive")
+
+        # Add the files in order of their keys, rather then in the order
+        # they finish downloading, so the same files make the same tar
+        self.deterministic = deterministic
+
+        # Local file to save the progress to, so a rerun can resume
+        self.journal_path = journal_path
+        self._journal = None
+        # File number & items of each planned archive left to build
+        self._archives = None
+        self._archives_to_build = None  # Iterator of the ones not started
+        # Upload, size, partly added file & index entries of each archive
+        # to continue, by file number. The upload is None if it has to
+        # start over
+        self._resume = {}
+        self._last_file_number = 0  # Last file number that was given out
+        self._part_contents = {}  # What is in each part being uploaded
 
         self.s3_max_retries = s3_max_retries
         if self.s3_max_retries is None or self.s3_max_retries <= 0:
             raise ValueError("s3 max retries must be 1 or larger")
 
+        # Number of parts to upload at the same time while the next
+        # parts are being created
+        self.upload_concurrency = upload_concurrency
+        if self.upload_concurrency is None or self.upload_concurrency <= 0:
+            raise ValueError("upload concurrency must be 1 or larger")
+
+        # Files and parts larger then this are staged in temp files on
+        # disk, rather then in memory
+        self.spill_size = None
+        if spill_size is not None:
+            self.spill_size = int(_convert_to_bytes(spill_size))
+        self.spill_dir = spill_dir
+        if self.spill_dir is not None:
+            if self.spill_size is None:
+                raise ValueError("Spill dir can only be used with a"
+                                 " spill size")
+            if not os.path.isdir(self.spill_dir):
+                raise ValueError("Spill dir {} does not exist"
+                                 .format(self.spill_dir))
+
+        # Limit the bytes of the files held in memory, rather then the
+        # number of files. Space for the parts is set aside first
+        self.max_memory = None
+        self._memory_budget = None
+        self._download_threads = self.cache_size
+        if max_memory is not None:
+            self.max_memory = int(_convert_to_bytes(max_memory))
+            parts_memory = (self.part_size * (self.upload_concurrency + 1)
+                            * self.archive_concurrency)
+            files_memory = self.max_memory - parts_memory
+            if files_memory < self.part_size:
+                raise ValueError("Max memory must be at least {} bytes for"
+                                 " the parts being built and uploaded"
+                                 .format(parts_memory + self.part_size))
+            self._memory_budget = MemoryBudget(files_memory)
+            # Small files take up little of the budget, so more of them
+            # can be downloaded at the same time
+            self._download_threads = max(
+                self.cache_size,
+                min(files_memory // self.part_size, _MAX_DOWNLOAD_THREADS),
+            )
+
+        # io objects that are ready to be combined.
+        # With a memory budget, it limits them instead
+        self._file_cache_size = self.cache_size
+        if self._memory_budget is not None:
+            self._file_cache_size = 0
+        self.file_cache = queue.Queue(maxsize=self._file_cache_size)
+
+        # Counters & latencies of each stage, to see what the job is
+        # waiting on. The callback is given them as the job makes progress
+        self.progress_callback = progress_callback
+        self.metrics = Metrics(progress_callback=progress_callback,
+                               progress_interval=progress_interval)
+
         self.s3 = _create_s3_client(
             session,
-            pool_size=self.cache_size * 2,
+            pool_size=(self._download_threads * 2
+                       + self.upload_concurrency * self.archive_concurrency),
             max_retries=self.s3_max_retries,
         )
 
     def tar(self):
         """Start the tar'ing process with what has been added
-        """
-        # Kick off a job to start download sources in the background
-        cache_t = threading.Thread(target=self._pre_fetch_files)
-        cache_t.daemon = True
-        cache_t.start()
 
-        # Keep creating new tar(.gz) as long as there are files left
-        file_number = 0
-        while self._is_complete() is False:
-            file_number += 1
-            self._new_file_upload(file_number)
+        If a journal is used, anything a run before already finished
+        is skipped
+        """
+        archives = None
+        if self.max_file_size is not None:
+            archives = self.plan()
+
+        completed = set()
+        if self.journal_path is not None:
+            completed = self._start_journal()
+
+        if self._memory_budget is not None:
+            # Sizes are needed up front to reserve memory for the files
+            self._get_unknown_sizes(self.all_keys)
+        self.metrics.set('files_total', len(self.all_keys))
+        self.metrics.set('bytes_total', sum(
+            self.source_info[key].size for tar_member_name, key
+            in self.all_keys if key in self.source_info
+        ))
+        self._last_file_number = max(completed | set(self._resume),
+                                     default=0)
+
+        if archives is not None:
+            # Skip the archives the journal has as completed
+            self._archives = [
+                (file_number,
+                 [item for item in archive['keys'] if item in self.all_keys])
+                for file_number, archive in enumerate(archives, 1)
+                if file_number not in completed
+            ]
+            self._archives_to_build = iter(self._archives)
+
+        cache_t = None
+        if self._archives is None or self.archive_concurrency == 1:
+            # Kick off a job to start download sources in the background
+            cache_t = threading.Thread(target=self._pre_fetch_files)
+            cache_t.daemon = True
+            cache_t.start()
+
+        if self.archive_concurrency == 1:
+            self._build_archives()
+        else:
+            self._build_archives_concurrently()
 
+        if cache_t is not None:
+            cache_t.join()
+        self.keys_to_delete |= self.all_keys
+        self.all_keys = set()  # clear now that all have been processed
         self._cleanup()
+        self.metrics.report(force=True)
+
+        if self.failed_verifies:
+            raise ValueError("{} files did not match their ETags and are not"
+                             " in the archive, they are in"
+                             " `failed_verifies`"
+                             .format(len(self.failed_verifies)))
+
+    def _build_archives_concurrently(self):
+        """Build `archive_concurrency` archives at the same time, each on
+        its own thread with its own multipart upload
+
+        If one fails, the others are stopped and their uploads aborted
+
+        Raises:
+            Exception: The first error from building an archive
+        """
+        errors = []
+
+        def _build():
+            try:
+                self._build_archives()
+            except Exception as e:
+                errors.append(e)
+                self._stop_archives.set()
+
+        threads = []
+        for _ in range(self.archive_concurrency):
+            t = threading.Thread(target=_build)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+    def _raise_if_stopped(self):
+        """Stop building an archive if another one failed
+
+        Raises:
+            RuntimeError: If an archive built at the same time failed
+        """
+        if self._stop_archives.is_set():
+            raise RuntimeError("Stopped since another archive failed")
+
+    def _build_archives(self):
+        """Keep building archives until there are none left
+        """
+        while True:
+            next_archive = self._get_next_archive()
+            if next_archive is None:
+                return
+
+            file_number, resume, items = next_archive
+            cache_t = None
+            if items is not None and self.archive_concurrency > 1:
+                # Each planned archive gets its own cache, filled by its
+                # share of the download threads
+                num_threads = max(
+                    1, self._download_threads // self.archive_concurrency,
+                )
+                file_cache_size = 0
+                if self._memory_budget is None:
+                    file_cache_size = num_threads
+                self._state.file_cache = queue.Queue(maxsize=file_cache_size)
+                self._state.cache_done = False
+                cache_t = threading.Thread(
+                    target=self._pre_fetch_files,
+                    args=(self._state.file_cache, items, num_threads),
+                )
+                cache_t.daemon = True
+                cache_t.start()
+
+            self._new_file_upload(file_number, resume=resume)
+
+            if cache_t is not None:
+                cache_t.join()
+
+    def _get_next_archive(self):
+        """Get the next archive to build
+
+        Archives being continued from the journal come first
+
+        Returns:
+            tuple|None: File number, what to continue it from & items of
+                the archive (if planned), None if there are none left
+        """
+        if self._archives is not None:
+            with self._lock:
+                next_archive = next(self._archives_to_build, None)
+                if next_archive is None:
+                    return None
+                file_number, items = next_archive
+                return file_number, self._resume.pop(file_number, None), items
+
+        with self._lock:
+            if self._resume:
+                file_number = min(self._resume)
+                return file_number, self._resume.pop(file_number), None
+
+        # Blocks until the next file is ready, to know if there is one
+        if self._is_complete() is True:
+            return None
+
+        with self._lock:
+            self._last_file_number += 1
+            return self._last_file_number, None, None
 
     def _cleanup(self):
         """Remove source keys from s3
         """
+        if self._remove_executor is not None:
+            # Wait for the keys of the archives that were already done
+            for future in self._remove_futures:
+                future.result()
+            self._remove_executor.shutdown()
+
         if self.remove_keys is True:
             logger.info("Removing all keys added to the tar {filename}"
                         .format(filename=self.target_key))
-
-            while len(self.keys_to_delete) > 0:
-                delete_these = []
-                while len(delete_these) < 1000 and len(self.keys_to_delete) > 0:
-                    delete_these.append({'Key': self.keys_to_delete.pop()[1]})
-                logger.debug("Removing {} keys from {}"
-                             .format(len(delete_these), self.source_bucket))
-                resp = self.s3.delete_objects(
-                    Bucket=self.source_bucket,
-                    Delete={'Objects': delete_these}
-                )
-                logger.debug("Delete objects response: {}".format(resp))
+            items = self.keys_to_delete - self._removed_items
+            # Only what is known to be in a completed archive, e.g. not
+            # files that failed to download or did not match their ETags
+            self.kept_keys |= {key for tar_member_name, key
+                               in items - self._archived_items}
+            items &= self._archived_items
+            self._delete_keys({key for tar_member_name, key in items})
+            self.keys_to_delete = set()
+            self._report_failed_deletes()
+            self._report_kept_keys()
+
+        if self._compression_executor is not None:
+            self._compression_executor.shutdown()
+
+        if self._journal is not None:
+            self._journal.close()
 
         # TODO: Clear the whole class
         self.s3 = None  # Clear all current connections
 
-    def _new_file_upload(self, file_number):
+    def _remove_archive_keys(self, items):
+        """Remove the keys of an archive that is complete, in the
+        background while the next archives are built
+
+        Args:
+            items (set): The `(tar_member_name, key)` of the files in it
+        """
+        with self._lock:
+            items = items - self._removed_items
+            self._removed_items |= items
+        keys = {key for tar_member_name, key in items}
+        self._remove_futures.append(
+            self._remove_executor.submit(self._delete_keys, keys)
+        )
+
+    def _delete_keys(self, keys):
+        """Delete keys from the source bucket, in batches of 1000 with
+        many batches at the same time
+
+        Keys that still can not be deleted after retrying are saved to
+        `failed_deletes`
+
+        Args:
+            keys (iterable): Keys to delete
+        """
+        keys = sorted(keys)
+        batches = [keys[i:i + DELETE_BATCH_SIZE]
+                   for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+
+        def _on_error(batch):
+            for key in batch:
+                self.failed_deletes[key] = 'Request failed'
+
+        for errors in _threads(self._download_threads, batches,
+                               self._delete_batch, on_error=_on_error):
+            if errors:
+                self.failed_deletes.update(errors)
+
+    def _delete_batch(self, keys):
+        """Delete up to 1000 keys in a single request, retrying the keys
+        s3 could not delete
+
+        Args:
+            keys (list): Keys to delete
+
+        Returns:
+            dict: Error of each key that could not be deleted, by key
+        """
+        errors = {}
+        for attempt in range(self.s3_max_retries):
+            if attempt > 0:
+                time.sleep(DELETE_RETRY_DELAY * 2**(attempt - 1))
+
+            logger.debug("Removing {} keys from {}"
+                         .format(len(keys), self.source_bucket))
+            resp = self.s3.delete_objects(
+                Bucket=self.source_bucket,
+                Delete={
+                    'Objects': [{'Key': key} for key in keys],
+                    'Quiet': True,
+                },
+            )
+            logger.debug("Delete objects response: {}".format(resp))
+            errors = _get_delete_errors(resp)
+            if not errors:
+                break
+            keys = sorted(errors)
+
+        return errors
+
+    def _report_failed_deletes(self):
+        """Log the keys that could not be deleted"""
+        if not self.failed_deletes:
+            return
+        examples = sorted(self.failed_deletes.items())[:10]
+        logger.error("Could not remove {} keys from {}, they are in"
+                     " `failed_deletes`. e.g. {}"
+                     .format(len(self.failed_deletes), self.source_bucket,
+                             examples))
+
+    def _report_kept_keys(self):
+        """Log the keys that were not removed since they are not in
+        a completed archive
+        """
+        if not self.kept_keys:
+            return
+        logger.warning("Did not remove {} keys from {} that are not in a"
+                       " completed tar file, they are in `kept_keys`."
+                       " e.g. {}"
+                       .format(len(self.kept_keys), self.source_bucket,
+                               sorted(self.kept_keys)[:10]))
+
+    def _new_file_upload(self, file_number, resume=None):
         """Start a new multipart upload for the tar file
 
         Args:
             file_number (int): The number of this file getting created
+            resume (tuple, optional): Upload, size, partly added file &
+                index entries to continue from. Defaults to None.
         """
         result_filepath = self._add_file_number(file_number)
-
-        # Start multipart upload
-        mpu = S3MPU(self.s3, self.target_bucket, result_filepath)
+        self._state.archive_done = False
+        self._state.index_members = []
+        self._state.tracked_members = 0
+        self._state.archive_items = []
 
         current_file_size = 0
-        # If out of files or min size is met, then complete file
-        while (self._is_complete() is False
-                and (self.min_file_size is None
-                     or current_file_size < self.min_file_size)):
-            current_part_io = self._get_part_contents()
+        if resume is not None and resume[0] is not None:
+            # Continue the archive a run before did not finish
+            mpu, current_file_size, partial, index_members = resume
+            self._state.index_members = list(index_members)
+            self._state.tracked_members = len(index_members)
+            if partial is not None:
+                self._state.current_source = self._get_partial_source(*partial)
+                self._state.current_source_offset = partial[2]
+                self._state.member_start = current_file_size - partial[2]
+        else:
+            # Start multipart upload
+            mpu = self._create_mpu(file_number, result_filepath)
+            if self._journal is not None:
+                self._journal.start_archive(file_number, result_filepath,
+                                            mpu.upload_id)
+
+        compressor = None
+        if self.single_compression_stream is True:
+            compressor = self._create_compressor()
+
+        try:
+            self._upload_parts(mpu, current_file_size, compressor)
+            mpu.complete()
+        except BaseException:
+            self._abort_upload(mpu)
+            raise
+
+        self.metrics.add('archives_completed')
+        if self.member_index is True:
+            self._upload_index(result_filepath)
+        if self.verify is True:
+            self._upload_manifest(result_filepath, mpu)
+        if self._journal is not None:
+            self._journal.complete_archive(file_number)
+        if self.remove_keys is True:
+            items = (set(self._state.archive_items)
+                     | self._resumed_items.pop(file_number, set()))
+            with self._lock:
+                self._archived_items |= items
+            if self.incremental_remove is True:
+                self._remove_archive_keys(items)
+
+    def _upload_parts(self, mpu, current_file_size, compressor=None):
+        """Build and upload the parts of an archive until it is done
 
-            current_file_size += current_part_io.tell()
+        Args:
+            mpu (S3MPU): Multipart upload of the archive
+            current_file_size (int): Bytes already in the archive
+            compressor (object, optional): Compressor shared by the whole
+                tar file. Defaults to None.
+        """
+        is_last_part = False
+        while is_last_part is False:
+            self._state.archive_offset = current_file_size
+            current_part_io = self._get_part_contents(compressor=compressor)
+            current_part_size = current_part_io.tell()
+            current_file_size += current_part_size
+
+            if self._archives is not None:
+                # The plan decides which files are in each archive
+                is_last_part = (self._state.archive_done is True
+                                or self._is_complete() is True)
+            else:
+                # If out of files or min size is met, then complete file.
+                # A file that is partly added must be finished in this file
+                is_last_part = (
+                    (self._is_min_size(current_part_size) is True
+                     and self._state.current_source_offset == 0)
+                    or self._is_complete() is True
+                )
+            if is_last_part is True and compressor is not None:
+                current_part_io.write(compressor.flush())
+
+            if current_part_io.tell() == 0 and mpu.next_part_number > 1:
+                # Everything was already in the parts of a resumed archive,
+                # or the last file ended right at the end of the part before.
+                # With no part to save them in, the journal does not get
+                # the files that were finished, so a resume adds them again
+                current_part_io.close()
+                self._state.packed_items = []
+                break
+
+            self._track_part(mpu, current_part_io.tell(),
+                             *self._get_resume_point())
             mpu.upload_part(current_part_io)
 
-        mpu.complete()
+            current_file_size += self._copy_source_body(mpu)
+            self.metrics.report()
+
+    def _abort_upload(self, mpu):
+        """Abort the upload of an archive that failed, so s3 does not keep
+        its parts. With a journal it is kept, to be continued by a rerun
+
+        Args:
+            mpu (S3MPU): The multipart upload
+        """
+        if self._journal is not None:
+            return
+        try:
+            mpu.abort()
+        except Exception:
+            logger.exception("Could not abort the upload of {}"
+                             .format(mpu.target_key))
+
+    def _upload_index(self, target_key):
+        """Upload the index of the members of an archive next to it
+
+        Args:
+            target_key (str): Key of the archive
+        """
+        index_key = target_key + INDEX_SUFFIX
+        logger.info("Saving index {}".format(index_key))
+        self.s3.put_object(
+            Bucket=self.target_bucket,
+            Key=index_key,
+            Body=dump_index(target_key, self.compression_type,
+                            self._state.index_members),
+            ContentType='application/json',
+        )
+
+    def _upload_manifest(self, target_key, mpu):
+        """Upload the checksums of an archive and its files next to it
+
+        Args:
+            target_key (str): Key of the archive
+            mpu (S3MPU): The completed upload of the archive
+        """
+        files = []
+        for tar_member_name, key in self._state.archive_items:
+            checksum = self._checksums.get(key)
+            files.append({
+                'name': tar_member_name,
+                'key': key,
+                'size': self.source_info[key].size,
+                'etag': self.source_info[key].etag,
+                'md5': checksum.md5 if checksum is not None else None,
+                'crc32': checksum.crc32 if checksum is not None else None,
+            })
+
+        manifest_key = target_key + MANIFEST_SUFFIX
+        logger.info("Saving manifest {}".format(manifest_key))
+        self.s3.put_object(
+            Bucket=self.target_bucket,
+            Key=manifest_key,
+            Body=dump_manifest(target_key, mpu.etag,
+                               [part['ETag'] for part in mpu.parts_mapping],
+                               files),
+            ContentType='application/json',
+        )
+
+    def _save_checksum(self, key, checksum, resp):
+        """Check the checksum of a source file against its ETag and save it
+        for the manifest
+
+        Args:
+            key (str): S3 file the checksum is of
+            checksum (Checksum): Checksum of all of the file
+            resp (dict): A get response of the file, with its ETag
+
+        Raises:
+            ValueError: If the ETag is an MD5 and it does not match. The
+                error is kept in `failed_verifies` unless a retry matches
+        """
+        etag = resp.get('ETag')
+        if etag_matches(etag, checksum.md5, resp) is False:
+            error = ("{} has the ETag {}, but the md5 of what was"
+                     " downloaded is {}".format(key, etag, checksum.md5))
+            with self._lock:
+                self.failed_verifies[key] = error
+            raise ValueError(error)
+        with self._lock:
+            self.failed_verifies.pop(key, None)
+        self._checksums[key] = checksum
+
+    def _index_entry(self, source, end):
+        """Create the index entry of a file that was fully added
+
+        Args:
+            source (io.IOBase): Source of the file from the file cache.
+                Metadata files have the name, key, size & mtime of their
+                member, any other file has its item
+            end (int): Offset in the archive the file ends at
+
+        Returns:
+            list: The index entry
+        """
+        member = getattr(source, 'member', None)
+        if member is None:
+            tar_member_name, key = source.item
+            member = ((tar_member_name, key)
+                      + self._get_source_key_info(key))
+        tar_member_name, key, source_size, source_mtime = member
+        return index_entry(tar_member_name, key, self._state.member_start,
+                           end, source_size, source_mtime,
+                           compressed='|' in self.mode)
+
+    def _create_mpu(self, file_number, target_key, upload_id=None):
+        """Create the multipart upload of an archive
+
+        Args:
+            file_number (int): The number of the archive
+            target_key (str): Key to upload to
+            upload_id (str, optional): Continue this upload. Defaults to None.
+
+        Returns:
+            S3MPU: The multipart upload
+        """
+        mpu = S3MPU(self.s3, self.target_bucket, target_key,
+                    max_in_flight=self.upload_concurrency,
+                    upload_id=upload_id,
+                    verify=self.verify,
+                    metrics=self.metrics)
+        if self._journal is not None:
+            mpu.on_part_saved = functools.partial(
+                self._journal_part, file_number, mpu.upload_id,
+            )
+        return mpu
+
+    def _get_resume_point(self):
+        """Check if an archive could be continued right after what has
+        been added to the parts so far
+
+        Returns:
+            tuple: If it can be continued, and the tar member name, key &
+                offset of the file that is partly added, if there is one
+        """
+        if self._state.current_source_offset == 0:
+            return True, None
+
+        item = getattr(self._state.current_source, 'item', None)
+        if item is None:
+            # Metadata files are not tracked, so can not be continued
+            return False, None
+        return True, (item[0], item[1], self._state.current_source_offset)
+
+    def _get_partial_source(self, tar_member_name, key, offset):
+        """Create the source of a file that was partly added to an archive,
+        at the point where it was left off
+
+        Args:
+            tar_member_name (str): Filename and path of the file inside the tar
+            key (str): S3 key of the file
+            offset (int): Number of bytes of it that were added
+
+        Returns:
+            io.BytesIO|TarMemberStream: The source of the file
+        """
+        source_tar_io = self._get_tar_source_data(tar_member_name, key)
+        source_tar_io.item = (tar_member_name, key)
+        if isinstance(source_tar_io, TarMemberStream):
+            source_tar_io.skip(offset)
+        else:
+            source_tar_io.seek(offset)
+        return source_tar_io
+
+    def _track_part(self, mpu, size, boundary, partial=None):
+        """Remember what is in the next part of an upload, so it can be
+        saved to the journal once it is uploaded
+
+        Args:
+            mpu (S3MPU): Upload the part is about to be added to
+            size (int): Size of the part
+            boundary (bool): If the archive can be continued after the part
+            partial (tuple, optional): The tar member name, key & offset
+                of the file that is partly added. Defaults to None.
+        """
+        if self._journal is None:
+            return
+        members = None
+        if self.member_index is True:
+            members = self._state.index_members[self._state.tracked_members:]
+            self._state.tracked_members = len(self._state.index_members)
+        self._part_contents[(mpu.upload_id, mpu.next_part_number)] = (
+            size, self._state.packed_items, boundary, partial, members,
+        )
+        self._state.packed_items = []
+
+    def _journal_part(self, file_number, upload_id, part_num, etag):
+        """Save a part to the journal once it has been uploaded
+
+        Args:
+            file_number (int): The number of the archive
+            upload_id (str): Id of the upload the part is in
+            part_num (int): Part number of the part
+            etag (str): ETag of the part
+        """
+        size, items, boundary, partial, members = self._part_contents.pop(
+            (upload_id, part_num)
+        )
+        self._journal.save_part(file_number, part_num, etag, size, items,
+                                boundary, partial=partial, members=members)
+
+    def _start_journal(self):
+        """Open the journal and skip anything a run before finished
+
+        Keys in completed archives are skipped. An archive that was not
+        completed is continued after the last part it can be continued
+        from, or started over if that is not possible.
+
+        Returns:
+            set: File numbers of the archives that were completed
+        """
+        self._journal = Journal(self.journal_path)
+        if self._journal.plan is None:
+            self._journal.save_plan(self.all_keys)
+        elif not self.all_keys <= self._journal.plan:
+            raise ValueError("Journal {} was made for different keys"
+                             .format(self.journal_path))
+
+        done_items = set()
+        completed = set()
+        for file_number, archive in sorted(self._journal.archives.items()):
+            if archive['target_key'] != self._add_file_number(file_number):
+                raise ValueError("Journal {} was made for a different file"
+                                 .format(self.journal_path))
+
+            if archive['complete'] is True:
+                items = self._journal.archive_items(file_number)
+                self._archived_items |= items
+                completed.add(file_number)
+            else:
+                items = self._resume_archive(file_number, archive)
+                self._resumed_items[file_number] = items
+            done_items |= items
+
+        logger.info("Skipping {} keys that are already in an archive"
+                    .format(len(done_items)))
+        # They still get removed on cleanup
+        self.keys_to_delete |= done_items
+        self.all_keys -= done_items
+        return completed
+
+    def _resume_archive(self, file_number, archive):
+        """Set up an archive that was not completed to be continued
+
+        Args:
+            file_number (int): The number of the archive
+            archive (dict): The archive from the journal
 
-    def _get_part_contents(self):
+        Returns:
+            set: Items that are in the parts being kept
+        """
+        # Start it over with the same file number if it can not be continued
+        self._resume[file_number] = (None, 0, None, [])
+        mpu = self._create_mpu(file_number, archive['target_key'],
+                               upload_id=archive['upload_id'])
+        try:
+            if self.single_compression_stream is True:
+                # The state of the compressor can not be brought back
+                mpu.abort()
+                return set()
+            uploaded_parts = mpu.list_parts()
+        except botocore.exceptions.ClientError:
+            # e.g. it was completed or aborted after the journal was saved
+            logger.warning("Can not continue {}, starting it over"
+                           .format(archive['target_key']))
+            return set()
+
+        kept_parts = []
+        kept_items = set()
+        kept_size = 0
+        kept_partial = None
+        kept_members = []
+        pending_parts = []
+        pending_items = set()
+        pending_size = 0
+        pending_members = []
+        part_num = 1
+        while (part_num in archive['parts']
+               and part_num in uploaded_parts
+               and (archive['parts'][part_num]['etag']
+                    == uploaded_parts[part_num]['ETag'])):
+            part = archive['parts'][part_num]
+            pending_parts.append({'ETag': part['etag'],
+                                  'PartNumber': part_num})
+            pending_items |= part['items']
+            pending_size += part['size']
+            pending_members += part['members']
+            if part['boundary'] is True:
+                kept_parts += pending_parts
+                kept_items |= pending_items
+                kept_size += pending_size
+                kept_partial = part['partial']
+                kept_members += pending_members
+                pending_parts = []
+                pending_items = set()
+                pending_size = 0
+                pending_members = []
+            part_num += 1
+
+        logger.info("Continuing {} after part {}"
+                    .format(archive['target_key'], len(kept_parts)))
+        mpu.keep_parts(kept_parts)
+        self._journal.resume_archive(file_number, len(kept_parts))
+        self._resume[file_number] = (mpu, kept_size, kept_partial,
+                                     kept_members)
+        if kept_partial is not None:
+            # It is added first when the archive is continued
+            kept_items.add(tuple(kept_partial[:2]))
+        return kept_items
+
+    def _get_copy_range(self):
+        """Get the range of the current file that can be copied server side
+
+        Returns:
+            tuple|None: Start and end (exclusive) offsets of the source file,
+                None if nothing can be copied right now
+        """
+        if (self.server_side_copy is False
+                or not isinstance(self._state.current_source, TarMemberStream)):
+            return None
+
+        copy_range = self._state.current_source.body_range()
+        if copy_range is None or copy_range[1] - copy_range[0] < MIN_S3_SIZE:
+            # Parts must be at least the min size unless its the last one
+            return None
+        return copy_range
+
+    def _copy_source_body(self, mpu):
+        """Copy the rest of the current file into the tar server side
+
+        Must only be called right after a part has been uploaded, since
+        the part before a copied part must be at least the min size
+
+        Args:
+            mpu (S3MPU): Multipart upload to copy the file into
+
+        Returns:
+            int: Number of bytes that were copied
+        """
+        copy_range = self._get_copy_range()
+        if copy_range is None:
+            return 0
+
+        start, end = copy_range
+        # Split up evenly so each part is within the s3 part size limits
+        num_parts = -(-(end - start) // MAX_S3_SIZE)
+        copy_part_size = -(-(end - start) // num_parts)
+        for part_start in range(start, end, copy_part_size):
+            self._track_part(mpu, min(copy_part_size, end - part_start),
+                             False)
+            mpu.upload_part_copy(
+                self.source_bucket,
+                self._state.current_source.key,
+                part_start,
+                min(part_start + copy_part_size, end),
+            )
+
+        self._state.current_source.skip_body(end)
+        self._state.current_source_offset += end - start
+        return end - start
+
+    def _get_part_contents(self, compressor=None):
         """Create multipart upload contents
         Pull files from file cache and append until file is large enough
         to be uploaded to s3's multi prt upload
 
+        Args:
+            compressor (object, optional): Compressor shared by the whole
+                tar file to pass the data through. Defaults to None.
+
         Returns:
-            BytesIO: io.BytesIO object to be upload
+            PartBuffer|tempfile.SpooledTemporaryFile: The part to be uploaded
         """
-        current_io = io.BytesIO()
-        current_size = 0
-        while current_size < MIN_S3_SIZE * self.part_size_multiplier:
-            source_tar_io = self._get_file_from_cache()
-            if source_tar_io is None:
-                # Must be the end since no more files to add
-                break
-            source_tar_io.seek(0)
-            current_io.write(source_tar_io.read())
-            source_tar_io.close()  # Cleanup
-            # New current size
-            current_size = current_io.tell()
+        if self.spill_size is None:
+            # Chunks are kept as they are read, rather then copied together
+            current_io = PartBuffer()
+        else:
+            current_io = self._create_buffer()
+        while current_io.tell() < self.part_size:
+            self._raise_if_stopped()
+            if self._state.current_source is None:
+                if self._is_min_size(current_io.tell()) is True:
+                    # Close the archive here, between two files
+                    break
+                self._state.current_source = self._get_file_from_cache()
+                if self._state.current_source is None:
+                    # Must be the end since no more files to add
+                    break
+
+            # Large files can span multiple parts, so only read
+            # what is needed to fill this one
+            read_size = self.part_size - current_io.tell()
+
+            copy_range = self._get_copy_range()
+            if copy_range is not None:
+                # The part before the copied part must be at least the
+                # min size, use the start of the file to fill it if needed
+                fill_size = MIN_S3_SIZE - current_io.tell()
+                if fill_size <= 0:
+                    # The rest gets copied once this part is uploaded
+                    break
+                if copy_range[1] - copy_range[0] - fill_size >= MIN_S3_SIZE:
+                    read_size = fill_size
+
+            data = self._state.current_source.read(read_size)
+            if not data:
+                item = getattr(self._state.current_source, 'item', None)
+                if item is not None:
+                    self.metrics.add('files_added')
+                    self.metrics.report()
+                if item is not None and self._journal is not None:
+                    self._state.packed_items.append(item)
+                if item is not None and (self.verify is True
+                                         or self.remove_keys is True):
+                    self._state.archive_items.append(item)
+                if self.member_index is True:
+                    self._state.index_members.append(self._index_entry(
+                        self._state.current_source,
+                        self._state.archive_offset + current_io.tell(),
+                    ))
+                reserved = getattr(self._state.current_source, 'reserved', 0)
+                if reserved:
+                    self._memory_budget.release(reserved)
+                self._state.current_source.close()  # Cleanup
+                self._state.current_source = None
+                self._state.current_source_offset = 0
+                continue
+
+            if self._state.current_source_offset == 0:
+                # Where the file starts in the archive
+                self._state.member_start = (self._state.archive_offset
+                                            + current_io.tell())
+            self._state.current_source_offset += len(data)
+            if compressor is not None:
+                data = compressor.compress(data)
+            current_io.write(data)
 
         return current_io
 
+    def _is_min_size(self, part_size):
+        """Check if the archive being built has reached the min file size,
+        when the archives are not planned
+
+        Args:
+            part_size (int): Bytes of the part being built so far
+
+        Returns:
+            bool: If the archive can be completed once the file being
+                added is done
+        """
+        return (self._archives is None
+                and self.min_file_size is not None
+                and (self._state.archive_offset + part_size
+                     >= self.min_file_size))
+
     def _get_file_from_cache(self):
         """Pull content from the file cache to build a part to get uploaded
 
+        Blocks until a file is ready, or the end of the cache is reached
+
+        Returns:
+            BytesIO|None: io.BytesIO object, None when there are no files left
+        """
+        if self._state.cache_done is True:
+            return None
+
+        file_cache = self._state.file_cache
+        if file_cache is None:
+            file_cache = self.file_cache
+
+        with self.metrics.time('cache_get_wait'):
+            source_io = self._wait_for_file(file_cache)
+        self.metrics.set('cache_files', file_cache.qsize())
+        if source_io is _END_OF_CACHE:
+            self._state.cache_done = True
+            # Let any other threads building archives from it know as well
+            file_cache.put(_END_OF_CACHE)
+            return None
+
+        if source_io is _END_OF_ARCHIVE:
+            self._state.archive_done = True
+            return None
+
+        if not isinstance(source_io, TarMemberStream):
+            # Streams are read from the start as they are created. Not
+            # `seekable()`, temp files only have it from python 3.11
+            source_io.seek(0)
+        return source_io
+
+    def _wait_for_file(self, file_cache):
+        """Block until the next file is in a file cache
+
+        While other archives are built at the same time, it stops waiting
+        if one of them fails, since the files it waits on may never come
+
+        Args:
+            file_cache (queue.Queue): Cache to get the file from
+
         Returns:
-            BytesIO: io.BytesIO object
+            What was next in the file cache
         """
-        while self._is_complete() is False:
-            if self.file_cache != []:
-                # Must pop from idx 0
-                # the last item in the file cache has the EOF bytes
-                return self.file_cache.pop(0)
-            time.sleep(0.1)
+        if self.archive_concurrency == 1:
+            return file_cache.get()
+
+        while True:
+            try:
+                return file_cache.get(timeout=_STOP_CHECK_INTERVAL)
+            except queue.Empty:
+                self._raise_if_stopped()
 
-        return None
+    def _create_compressor(self):
+        """Create a compressor for data compressed outside of the threads
+        downloading the files (large files & the single compression stream)
+
+        Returns:
+            object: Compressor with `compress` & `flush` methods
+        """
+        if self._compression_executor is not None:
+            if self.compression_type == 'bz2':
+                parallel_compressor = ParallelBz2Compressor
+            else:
+                parallel_compressor = ParallelGzipCompressor
+            compressor = parallel_compressor(
+                self._compression_executor,
+                level=self.compression_level,
+                max_pending=self.compression_workers * 2,
+            )
+        else:
+            compressor = _create_compressor(
+                self.compression_type,
+                self.compression_level,
+                workers=self.compression_workers,
+                long_distance_matching=self.long_distance_matching,
+            )
+        return TimedCompressor(compressor, self.metrics)
 
     def _add_file_number(self, file_number):
         """Add file number to tar file if needed
 
         If its possible that there may need to be multiple tar files,
         number them so they do not get overwritten.
-        This would happen if self.min_file_size is set
+        This would happen if self.min_file_size or self.max_file_size is set
 
         Args:
             file_number (int): The number to give the file
@@ -198,7 +1313,7 @@ class S3Tar:
             str: The filename to use in s3
         """
         result_filepath = self.target_key
-        if self.min_file_size is not None:
+        if self.min_file_size is not None or self.max_file_size is not None:
             # Need to number since the number of files is unknown
             compression_ext = ''
             if self.compression_type is not None:
@@ -214,26 +1329,159 @@ class S3Tar:
     def _is_complete(self):
         """Are they any files left to be uploaded/tar'd
 
+        Blocks until the next file is in the cache so it can be known
+        if there are more files coming or not
+
         Returns:
             bool: If we can complete this tar'ing process or not
         """
-        return self.all_keys == set() and self.file_cache == []
+        if self._state.current_source is None:
+            self._state.current_source = self._get_file_from_cache()
+        return self._state.current_source is None
 
-    def _pre_fetch_files(self):
+    def _pre_fetch_files(self, file_cache=None, items=None, num_threads=None):
         """Started as a background job to keep adding files to the
         file cache to speed things along
+
+        Args:
+            file_cache (queue.Queue, optional): Cache to add the files to.
+                Defaults to None, which uses `self.file_cache`.
+            items (list, optional): Only add these `(tar_member_name, key)`
+                items, in order. Defaults to None, which adds all of the keys.
+            num_threads (int, optional): Number of files to download at the
+                same time. Defaults to None, which uses `cache_size`, or more
+                with a memory budget.
         """
+        if file_cache is None:
+            file_cache = self.file_cache
+        if num_threads is None:
+            num_threads = self._download_threads
+
         def _fetch(item):
-            while len(self.file_cache) >= self.cache_size:
-                # Hold here until more files are needed in the cache
-                time.sleep(0.1)
             tar_member_name, key = item
             logger.debug("Adding to cache {}".format(key))
+            # Blocks while the cache is full
             self._add_key_to_cache(tar_member_name, key)
 
-        _threads(self.cache_size, self.all_keys, _fetch)
-        self.keys_to_delete = self.all_keys.copy()
-        self.all_keys = set()  # clear now that all have been processed
+        try:
+            if items is not None:
+                self._pre_fetch_files_in_order(file_cache, [items],
+                                               num_threads)
+            elif self._archives is not None:
+                self._pre_fetch_files_in_order(
+                    file_cache,
+                    [items for file_number, items in self._archives],
+                    num_threads,
+                    end_of_group=_END_OF_ARCHIVE,
+                )
+            elif self.deterministic is True:
+                self._pre_fetch_files_in_order(file_cache, [
+                    sorted(self.all_keys, key=lambda item: (item[1], item[0]))
+                ], num_threads)
+            else:
+                _threads(num_threads, self._reserve_memory(self.all_keys),
+                         _fetch, on_error=self._release_memory)
+        finally:
+            # Always let the consumer know nothing else is coming
+            file_cache.put(_END_OF_CACHE)
+
+    def _pre_fetch_files_in_order(self, file_cache, groups, num_threads,
+                                  end_of_group=None):
+        """Download the files on many threads, but add them to the file
+        cache in the order given
+
+        Files that finish early wait for the ones before them, and only
+        `num_threads` files can be downloaded ahead of the next one in line.
+        Files that fail to download are skipped.
+
+        Args:
+            file_cache (queue.Queue): Cache to add the files to
+            groups (list): Lists of `(tar_member_name, key)` items to add
+            num_threads (int): Number of files to download at the same time
+            end_of_group (object, optional): Added to the file cache after
+                the files of each group. Defaults to None.
+        """
+        reorder_buffer = ReorderBuffer(
+            functools.partial(self._put_in_cache, file_cache),
+            num_threads,
+        )
+
+        slots = []
+        for group in groups:
+            slots.extend(group)
+            if end_of_group is not None:
+                slots.append(end_of_group)
+
+        def _fetch(indexed_slot):
+            index, slot = indexed_slot
+            reorder_buffer.wait_turn(index)
+            if slot is end_of_group:
+                reorder_buffer.add(index, [slot])
+                return
+
+            tar_member_name, key = slot
+            logger.debug("Adding to cache {}".format(key))
+            reorder_buffer.add(index,
+                               self._get_cache_items(tar_member_name, key))
+
+        def _skip(indexed_slot):
+            index, slot = indexed_slot
+            self._release_memory(slot)
+            reorder_buffer.skip(index)
+
+        _threads(num_threads, enumerate(self._reserve_memory(slots)), _fetch,
+                 on_error=_skip)
+
+    def _reserve_memory(self, slots):
+        """Reserve memory for each file before it is given out to be
+        downloaded, if there is a memory budget
+
+        Reserving them one at a time in order means the files that are
+        already reserved can always be added, so it never gets stuck
+
+        Args:
+            slots (iterable): `(tar_member_name, key)` items. Anything else
+                is passed through as is
+
+        Yields:
+            The slots, once there is memory for them
+        """
+        for slot in slots:
+            if self._memory_budget is not None and isinstance(slot, tuple):
+                self._memory_budget.reserve(self._memory_cost(*slot))
+            yield slot
+
+    def _release_memory(self, slot):
+        """Give back the memory reserved for a file that failed to download
+
+        Args:
+            slot: The `(tar_member_name, key)` item, or what was in its slot
+        """
+        if self._memory_budget is not None and isinstance(slot, tuple):
+            self._memory_budget.release(self._memory_cost(*slot))
+
+    def _memory_cost(self, tar_member_name, key):
+        """Get how much memory a file takes up until it is added to a part
+
+        Files larger then a part are streamed, so only hold a part at a time.
+        Files larger then `spill_size` only hold that much, the rest is on
+        disk
+
+        Args:
+            tar_member_name (str): Filename and path of the file inside the tar
+            key (str): The key of the file
+
+        Returns:
+            int: Number of bytes
+        """
+        source_size, source_mtime = self._get_source_key_info(key)
+        memory_cost = member_size(tar_member_name, source_size, source_mtime)
+        if source_size > self.part_size:
+            memory_cost = self.part_size
+        if self.spill_size is not None:
+            # The rest is on disk
+            memory_cost = min(memory_cost, self.spill_size)
+        return memory_cost
 
     def _add_key_to_cache(self, tar_member_name, key):
         """Get the source of an s3 key (and its metadata if needed) and add
@@ -243,35 +1491,145 @@ class S3Tar:
             tar_member_name (str): Filename and path of the file inside the tar
             key (str): the key to download form s3
         """
+        for source_io in self._get_cache_items(tar_member_name, key):
+            self._put_in_cache(self.file_cache, source_io)
+
+    def _put_in_cache(self, file_cache, source_io):
+        """Add to a file cache, blocks while it is full
+
+        Args:
+            file_cache (queue.Queue): Cache to add to
+            source_io (io.IOBase): Source to add
+        """
+        with self.metrics.time('cache_put_wait'):
+            file_cache.put(source_io)
+        self.metrics.set('cache_files', file_cache.qsize())
+
+    def _get_cache_items(self, tar_member_name, key):
+        """Get the source of an s3 key (and its metadata if needed)
+
+        Args:
+            tar_member_name (str): Filename and path of the file inside the tar
+            key (str): the key to download form s3
+
+        Returns:
+            list: io objects to add to the file cache, in order
+        """
+        cache_items = []
+        # Get the data first, the response includes the metadata
+        source_tar_io = self._get_tar_source_data(tar_member_name, key)
+        # So it is known which key is done once it has been added to a part
+        source_tar_io.item = (tar_member_name, key)
+        if self._memory_budget is not None:
+            # Given back once it has been added to a part
+            source_tar_io.reserved = self._memory_cost(tar_member_name, key)
+
         if self.save_metadata is True:
             metadata_io = self._get_tar_source_metadata(tar_member_name, key)
             if metadata_io is not None:
                 logger.debug("Adding metadata file to cache {}".format(key))
-                self.file_cache.append(metadata_io)
+                cache_items.append(metadata_io)
 
-        self.file_cache.append(self._get_tar_source_data(tar_member_name, key))
+        cache_items.append(source_tar_io)
+        return cache_items
 
     def _get_tar_source_data(self, tar_member_name, key):
         """Download source file and generate a tar from it
 
+        Files larger then a single part are not downloaded here, they get
+        streamed in chunks when the parts are being created
+
         Args:
             tar_member_name (str): Filename and path of the file inside the tar
             key (str): File from s3 to download
 
         Returns:
-            io.BytesIO: BytesIO object of the tar file
+            io.BytesIO|TarMemberStream: BytesIO object of the tar file,
+                or a stream of it for large files
         """
+        source_size, source_mtime = self._get_source_key_info(key)
+        if source_size > self.part_size:
+            return self._get_tar_source_stream(
+                tar_member_name,
+                key,
+                source_size,
+                source_mtime,
+            )
+
         source_key_io = self._download_source_file(key)
-        source_mtime = self._get_source_key_mtime(key)
         source_tar_io = self._save_bytes_to_tar(
             tar_member_name,
             source_key_io,
             source_mtime,
             mode=self.mode,
+            compression_level=self.compression_level,
+            create_buffer=self._create_buffer,
+            metrics=self.metrics,
         )
         source_key_io.close()  # Cleanup
         return source_tar_io
 
+    def _get_tar_source_stream(self, tar_member_name, key,
+                               source_size, source_mtime):
+        """Create a tar stream of the source file that downloads
+        the file in ranges as it gets read
+
+        Args:
+            tar_member_name (str): Filename and path of the file inside the tar
+            key (str): File from s3 to stream
+            source_size (int): Size of the source file in bytes
+            source_mtime (float): Last modified timestamp of the source file
+
+        Returns:
+            TarMemberStream: Stream of the tar'd data
+        """
+        info = tarfile.TarInfo(name=tar_member_name)
+        info.size = source_size
+        info.mtime = source_mtime
+
+        compressor = None
+        if '|' in self.mode:
+            compressor = self._create_compressor()
+
+        read_range = functools.partial(self._download_source_range, key)
+        if self.verify is True:
+            read_range = self._checksum_ranges(key, source_size)
+
+        return TarMemberStream(
+            info,
+            read_range,
+            self.part_size,
+            compressor=compressor,
+            key=key,
+        )
+
+    def _checksum_ranges(self, key, source_size):
+        """Checksum a large file as its ranges are downloaded
+
+        Only if every range is read in order, if any of it is skipped
+        (e.g. copied by s3) there is no checksum of it
+
+        Args:
+            key (str): S3 file the ranges are of
+            source_size (int): Size of the file in bytes
+
+        Returns:
+            function: Called with `start` & `end` offsets and returns
+                those bytes of the file, checksumming them
+        """
+        checksum = Checksum()
+
+        def _read_range(start, end):
+            data, resp = self._get_source_range(key, start, end)
+            if start == checksum.size:
+                checksum.update(data)
+                if checksum.size == source_size:
+                    # The ETag of the range response is of the whole file
+                    self._save_checksum(key, checksum, resp)
+            return data
+
+        return _read_range
+
     def _get_tar_source_metadata(self, tar_member_name, key):
         """Get metadata from the s3 file
         If a file has metadata then add it to a tar file
@@ -288,28 +1646,99 @@ class S3Tar:
         if source_metadata_io is None:
             return None
 
+        # Whole seconds, as not every tar format keeps fractions
+        # and the member index needs the time in its header
+        metadata_mtime = int(time.time())
+        if self.deterministic is True:
+            # Use the time of the file so the tar is the same every time
+            metadata_mtime = self._get_source_key_info(key)[1]
+
+        metadata_name = tar_member_name + '.metadata.json'
+        metadata_size = source_metadata_io.tell()
         source_metadata_tar_io = self._save_bytes_to_tar(
-            tar_member_name + '.metadata.json',
+            metadata_name,
             source_metadata_io,
-            time.time(),
+            metadata_mtime,
             mode=self.mode,
+            compression_level=self.compression_level,
+            metrics=self.metrics,
         )
+        # It is not a key, so its member is needed to index it
+        source_metadata_tar_io.member = (metadata_name, key, metadata_size,
+                                         metadata_mtime)
         source_metadata_io.close()  # Cleanup
         return source_metadata_tar_io
 
     def _download_source_file(self, key):
-        """Download source file from s3 into a BytesIO object
+        """Download source file from s3 into a buffer
 
         Args:
             key (str): S3 file to download
 
         Returns:
-            io.BytesIO: BytesIO object of the contents
+            io.BytesIO|tempfile.SpooledTemporaryFile: Buffer of the contents
         """
-        source_key_io = io.BytesIO()
-        self.s3.download_fileobj(self.source_bucket, key, source_key_io)
+        source_key_io = self._create_buffer()
+        checksum = Checksum() if self.verify is True else None
+        with self.metrics.time('get'):
+            resp = self.s3.get_object(
+                Bucket=self.source_bucket,
+                Key=key,
+            )
+            for chunk in resp['Body'].iter_chunks(MIN_S3_SIZE):
+                source_key_io.write(chunk)
+                if checksum is not None:
+                    checksum.update(chunk)
+        self.metrics.add('bytes_in', source_key_io.tell())
+        self._save_source_info(key, resp)
+        if checksum is not None:
+            self._save_checksum(key, checksum, resp)
         return source_key_io
 
+    def _download_source_range(self, key, start, end):
+        """Download a range of bytes of the source file from s3
+
+        Args:
+            key (str): S3 file to download from
+            start (int): Offset of the first byte
+            end (int): Offset to stop at, exclusive
+
+        Returns:
+            bytes: Contents of the range
+        """
+        return self._get_source_range(key, start, end)[0]
+
+    def _get_source_range(self, key, start, end):
+        """Download a range of bytes of the source file from s3
+
+        Args:
+            key (str): S3 file to download from
+            start (int): Offset of the first byte
+            end (int): Offset to stop at, exclusive
+
+        Returns:
+            tuple: Contents of the range, and the get response
+        """
+        for i in range(3):
+            # re try 3 times before giving up, the same as whole files
+            try:
+                with self.metrics.time('get'):
+                    resp = self.s3.get_object(
+                        Bucket=self.source_bucket,
+                        Key=key,
+                        Range='bytes={}-{}'.format(start, end - 1),
+                    )
+                    data = resp['Body'].read()
+            except Exception:
+                if i == 2:
+                    raise
+                logger.exception("Retry failed range {}-{} of: {}"
+                                 .format(start, end, key))
+            else:
+                break
+        self.metrics.add('bytes_in', len(data))
+        return data, resp
+
     def _download_source_metadata(self, key):
         """Get metadata from an s3 file
 
@@ -320,24 +1749,81 @@ class S3Tar:
             io.BytesIO|None: BytesIO object of the tar file
         """
         source_metadata_io = io.BytesIO()
-        metadata = self.s3.head_object(
-            Bucket=self.source_bucket,
-            Key=key,
-        )['Metadata']
+        source_info = self.source_info.get(key)
+        if source_info is None or source_info.metadata is None:
+            source_info = self._head_source_key(key)
+
+        metadata = source_info.metadata
         if metadata == {}:
             return None
 
         source_metadata_io.write(json.dumps(metadata).encode('utf-8'))
         return source_metadata_io
 
-    def _get_source_key_mtime(self, key):
-        return self.s3.head_object(
-            Bucket=self.source_bucket,
-            Key=key,
-        )['LastModified'].timestamp()
+    def _get_source_key_info(self, key):
+        """Get the size and last modified time of an s3 file
+
+        Only makes a request if it was not already known from listing it
+
+        Args:
+            key (str): S3 file to get the info of
+
+        Returns:
+            tuple: Size in bytes and last modified timestamp
+        """
+        source_info = self.source_info.get(key)
+        if source_info is None:
+            source_info = self._head_source_key(key)
+        return source_info.size, source_info.mtime
+
+    def _head_source_key(self, key):
+        """Get the info of an s3 file from a head request
+
+        Args:
+            key (str): S3 file to get the info of
+
+        Returns:
+            SourceInfo: Info of the file
+        """
+        with self.metrics.time('head'):
+            resp = self.s3.head_object(
+                Bucket=self.source_bucket,
+                Key=key,
+            )
+        return self._save_source_info(key, resp)
+
+    def _save_source_info(self, key, resp):
+        """Save the info of an s3 file from a get or head response
+
+        Args:
+            key (str): S3 file the response is for
+            resp (dict): The get_object or head_object response
+
+        Returns:
+            SourceInfo: Info of the file
+        """
+        source_info = SourceInfo(
+            size=resp['ContentLength'],
+            mtime=resp['LastModified'].timestamp(),
+            etag=resp.get('ETag'),
+            metadata=resp.get('Metadata', {}),
+        )
+        self.source_info[key] = source_info
+        return source_info
+
+    def _create_buffer(self):
+        """Create a buffer to stage a file or part in, which is moved to
+        a temp file once it is larger then `spill_size`
+
+        Returns:
+            io.BytesIO|tempfile.SpooledTemporaryFile: The empty buffer
+        """
+        return _create_buffer(self.spill_size, self.spill_dir)
 
     @classmethod
-    def _save_bytes_to_tar(cls, name, source_io, source_mtime, mode):
+    def _save_bytes_to_tar(cls, name, source_io, source_mtime, mode,
+                           compression_level=None, create_buffer=io.BytesIO,
+                           metrics=None):
         """Convert raw bytes into a tar
 
         Args:
@@ -345,42 +1831,190 @@ class S3Tar:
             source_io (io.BytesIO): The data to be saved into the tar
             source_mtime (): Last modified timestamp of the source file
             mode (str): The file mode in which to open the tar file
+            compression_level (int, optional): Level to compress at if
+                the mode uses compression. Defaults to None.
+            create_buffer (function, optional): Creates the buffers the tar
+                is saved to. Defaults to io.BytesIO.
+            metrics (Metrics, optional): Add the time it takes to pack and
+                compress to these. Defaults to None.
 
         Returns:
             io.BytesIO: BytesIO object of the tar'd data
         """
-        source_tar_io = io.BytesIO()
-        tar = tarfile.open(fileobj=source_tar_io, mode=mode)
+        start = time.perf_counter()
+        source_tar_io = create_buffer()
+        tar = tarfile.open(fileobj=source_tar_io, mode='w')
         info = tarfile.TarInfo(name=name)
         info.size = source_io.tell()
         info.mtime = source_mtime
         source_io.seek(0)
         tar.addfile(tarinfo=info, fileobj=source_io)
+        if metrics is not None:
+            metrics.observe('pack', time.perf_counter() - start)
 
         if '|' in mode:
-            # When using compression, the data is
-            # not writted to the fileobj until its done
-            tar.fileobj.close()
+            compressor = _create_compressor(mode.split('|', 1)[1],
+                                            compression_level)
+            if metrics is not None:
+                compressor = TimedCompressor(compressor, metrics)
+            compressed_io = create_buffer()
+            source_tar_io.seek(0)
+            for chunk in iter(lambda: source_tar_io.read(MIN_S3_SIZE), b''):
+                compressed_io.write(compressor.compress(chunk))
+            compressed_io.write(compressor.flush())
+            source_tar_io.close()  # Cleanup
+            source_tar_io = compressed_io
 
         return source_tar_io
 
-    def _raise_if_dup(self, tar_member_name, key, key_list=None):
-        if key_list is None:
-            key_list = self.all_keys
+    def _raise_if_dup(self, tar_member_name, key, member_names=None):
+        """Raise if a different key already uses this member name
+
+        Args:
+            tar_member_name (str): Filename and path of the file inside the tar
+            key (str): The key being added
+            member_names (dict, optional): Key of each member name to check
+                against. Defaults to self.member_names.
+
+        Raises:
+            ValueError: If the member name is a dup and allow_dups is False
+        """
+        if member_names is None:
+            member_names = self.member_names
 
         if self.allow_dups is False:
-            if any((True for x in key_list
-                    if tar_member_name == x[0] and key != x[1])):
+            if member_names.get(tar_member_name, key) != key:
                 raise ValueError(("Filename '{member_name}' for key '{key}'"
                                   " already exists in the tar file."
                                   " Set allow_dups to continue.")
                                  .format(member_name=tar_member_name,
                                          key=key))
 
-    def add_files(self, prefix, folder='', preserve_paths=False):
-        """Add s3 files from a directory inside the source bucket
+    def plan(self):
+        """Split the files into archives ahead of time, using their sizes
 
-        self.all_keys gets added to directly
+        Each archive is about the same size and no larger then
+        `max_file_size` (unless a single file is). Files stay in order of
+        their keys. Sizes are of the uncompressed tar, not counting
+        metadata files.
+
+        Returns:
+            list: Each archive as a dict of its `target_key`, estimated
+                `size` and `keys`, the `(tar_member_name, key)` of its files
+        """
+        if self.max_file_size is None:
+            raise ValueError("Max file size must be set to plan the archives")
+
+        items = sorted(self.all_keys, key=lambda item: (item[1], item[0]))
+        self._get_unknown_sizes(items)
+
+        sizes = [member_size(tar_member_name,
+                             *self._get_source_key_info(key))
+                 for tar_member_name, key in items]
+        archives = []
+        ranges = plan_archives(sizes, self.max_file_size, self.min_file_size)
+        for file_number, (start, end) in enumerate(ranges, 1):
+            archives.append({
+                'target_key': self._add_file_number(file_number),
+                'size': sum(sizes[start:end]),
+                'keys': items[start:end],
+            })
+        return archives
+
+    def list_archive(self, target_key=None):
+        """List the files in a tar file in the target bucket, without
+        downloading it
+
+        The index uploaded next to it is used if there is one (see
+        `member_index`). Otherwise only the headers of a .tar file are read,
+        using ranged gets
+
+        Args:
+            target_key (str, optional): Key of the tar file. Defaults to None,
+                which uses the target key.
+
+        Raises:
+            ValueError: If the tar file is compressed and has no index
+
+        Yields:
+            dict: Where each file is in the tar file, see
+                `member_index.INDEX_FIELDS`
+        """
+        if target_key is None:
+            target_key = self.target_key
+
+        index = get_index(self.s3, self.target_bucket, target_key)
+        if index is not None:
+            yield from index['members']
+            return
+
+        if _get_compression_type(target_key) is not None:
+            raise ValueError("Compressed tar files can only be listed if they"
+                             " have an index, see member_index")
+
+        yield from walk_headers(self.s3, self.target_bucket, target_key)
+
+    def _get_unknown_sizes(self, items):
+        """Files added one at a time were not listed, so get all of their
+        sizes at the same time
+
+        Args:
+            items (iterable): The `(tar_member_name, key)` items
+        """
+        unknown_keys = {key for tar_member_name, key in items
+                        if key not in self.source_info}
+        _threads(self._download_threads, unknown_keys,
+                 self._get_source_key_info)
+
+    def _listing_to_items(self, resp, prefix, folder, preserve_paths):
+        """Get the items of a page of listed s3 files
+
+        Args:
+            resp (dict): The list objects response
+            prefix (str): Folder path inside the source bucket
+            folder (str): Folders to place the file inside the tar file,
+                ending with '/' if set
+            preserve_paths (bool): Starting from the prefix, use the path
+                of the key in the tar file
+
+        Returns:
+            list: The `(tar_member_name, key)` items
+        """
+        file_list = []
+        # Only added to self.member_names once the whole page is good
+        page_member_names = {}
+        for x in resp['Contents']:
+            key = x['Key']
+            if key == prefix:
+                continue
+
+            # Get the paths after the prefix, and before the file
+            if preserve_paths is True:
+                tar_member_name = folder + key.replace(prefix, '')
+            else:
+                tar_member_name = folder + key.split('/')[-1]
+
+            self._raise_if_dup(tar_member_name, key)
+            self._raise_if_dup(tar_member_name, key,
+                               member_names=page_member_names)
+            if self.allow_dups is False:
+                page_member_names[tar_member_name] = key
+
+            file_list.append((tar_member_name, key))
+            # Saves needing to make a head request for these later
+            self.source_info[key] = SourceInfo(
+                size=x['Size'],
+                mtime=x['LastModified'].timestamp(),
+                etag=x.get('ETag'),
+                metadata=None,
+            )
+
+        self.member_names.update(page_member_names)
+        return file_list
+
+    async def add_files_async(self, prefix, folder='', preserve_paths=False,
+                              s3=None):
+        """Same as `add_files`, but lists the files on the event loop
 
         Args:
             prefix (str): Folder path inside the source bucket
@@ -388,33 +2022,71 @@ class S3Tar:
                 the tar file. Defaults to ''.
             preserve_paths (bool, optional): Starting from the prefix, use
                 the path of the key in the tar file. Defaults to False.
+            s3 (optional): Async s3 client, like aiobotocore's.
+                Defaults to None, which creates an aiobotocore client.
         """
-        def resp_to_filelist(resp):
-            file_list = []
-            for x in resp['Contents']:
-                key = x['Key']
-                if key == prefix:
-                    continue
+        if s3 is None:
+            async with create_async_s3_client(
+                    max_retries=self.s3_max_retries) as s3:
+                await self.add_files_async(prefix, folder=folder,
+                                           preserve_paths=preserve_paths,
+                                           s3=s3)
+            return
 
-                # Get the paths after the prefix, and before the file
-                if preserve_paths is True:
-                    tar_member_name = folder + key.replace(prefix, '')
-                else:
-                    tar_member_name = folder + key.split('/')[-1]
+        await AsyncTarEngine(self, s3).add_files(
+            prefix, folder=folder, preserve_paths=preserve_paths,
+        )
 
-                self._raise_if_dup(tar_member_name, key, key_list=self.all_keys)
-                self._raise_if_dup(tar_member_name, key, key_list=file_list)
+    async def tar_async(self, s3=None, concurrency=None):
+        """Same as `tar`, but everything runs as tasks on the event loop
+        rather then on threads
 
-                file_list.append((tar_member_name, key))
+        Compression still runs on threads, so it does not block the loop.
+        A journal, server side copy, max file size, archive concurrency,
+        max memory, spill size, member index, verify, incremental remove &
+        a progress callback are not supported.
 
-            return file_list
+        Args:
+            s3 (optional): Async s3 client, like aiobotocore's.
+                Defaults to None, which creates an aiobotocore client.
+            concurrency (int, optional): Max number of downloads at a time.
+                Defaults to None, which uses `cache_size`.
+        """
+        engine = AsyncTarEngine(self, s3, concurrency=concurrency)
+        if s3 is None:
+            async with create_async_s3_client(
+                    pool_size=engine.concurrency + self.upload_concurrency,
+                    max_retries=self.s3_max_retries) as s3:
+                engine.s3 = s3
+                await engine.tar()
+            return
+
+        await engine.tar()
+
+    def add_files(self, prefix, folder='', preserve_paths=False):
+        """Add s3 files from a directory inside the source bucket
+
+        self.all_keys gets added to directly
+
+        Args:
+            prefix (str): Folder path inside the source bucket
+            folder (str, optional): Folders to place the file inside
+                the tar file. Defaults to ''.
+            preserve_paths (bool, optional): Starting from the prefix, use
+                the path of the key in the tar file. Defaults to False.
+        """
+        def resp_to_filelist(resp):
+            return self._listing_to_items(resp, prefix, folder,
+                                          preserve_paths)
 
         # needs to end with '/'
         if folder != '' and not folder.endswith('/'):
             folder += '/'
 
         logger.info("Gathering files from folder {}".format(prefix))
-        resp = self.s3.list_objects_v2(Bucket=self.source_bucket, Prefix=prefix)
+        with self.metrics.time('list'):
+            resp = self.s3.list_objects_v2(Bucket=self.source_bucket,
+                                           Prefix=prefix)
         if resp['KeyCount'] == 0:
             logger.warning("No files found in the prefix {}".format(prefix))
             return
@@ -422,18 +2094,21 @@ class S3Tar:
         file_list = resp_to_filelist(resp)
         self.all_keys |= set(file_list)
         total_file_count = len(file_list)
+        self.metrics.add('files_listed', len(file_list))
 
         logger.debug("Found {} objects so far...".format(total_file_count))
         while resp['IsTruncated']:
             last_key = file_list[-1][1]
-            resp = self.s3.list_objects(
-                Bucket=self.source_bucket,
-                Prefix=prefix,
-                Marker=last_key,
-            )
+            with self.metrics.time('list'):
+                resp = self.s3.list_objects(
+                    Bucket=self.source_bucket,
+                    Prefix=prefix,
+                    Marker=last_key,
+                )
             file_list = resp_to_filelist(resp)
             self.all_keys |= set(file_list)
             total_file_count += len(file_list)
+            self.metrics.add('files_listed', len(file_list))
 
             logger.debug("Found {} objects so far...".format(total_file_count))
 
@@ -458,3 +2133,5 @@ class S3Tar:
         self._raise_if_dup(tar_member_name, key)
 
         self.all_keys.add((tar_member_name, key))
+        if self.allow_dups is False:
+            self.member_names[tar_member_name] = key
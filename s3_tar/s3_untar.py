@@ -0,0 +1,429 @@
+import io
+import boto3
+import logging
+import tarfile
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .s3_mpu import S3MPU
+from .tar_listing import get_index, walk_headers
+from .utils import (_create_s3_client, _create_decompressor,
+                    _get_compression_type, MIN_S3_SIZE)
+
+logger = logging.getLogger(__name__)
+
+
+def _decompress_streams(chunks, compression_type):
+    """Decompress compressed streams that follow one another (e.g. each
+    file of a tar compressed on its own, or a large file compressed in
+    blocks on many threads)
+
+    Args:
+        chunks (iterable): Compressed data, in order
+        compression_type (str): `gz`, `bz2`, `xz`, `zst` or `lz4`
+
+    Yields:
+        bytes: The next decompressed data
+    """
+    decompressor = _create_decompressor(compression_type)
+    for data in chunks:
+        while data:
+            yield decompressor.decompress(data)
+            data = b''
+            if decompressor.eof is True:
+                # The next stream needs a new decompressor
+                data = decompressor.unused_data
+                decompressor = _create_decompressor(compression_type)
+
+
+class _DecompressedReader(io.RawIOBase):
+    """Read compressed streams that follow one another (e.g. each file of
+    a tar compressed on its own) as one decompressed stream
+    """
+
+    def __init__(self, source, compression_type, read_size=MIN_S3_SIZE):
+        """
+        Args:
+            source (io.IOBase): Compressed data, only needs a `read` method
+            compression_type (str): `gz`, `bz2`, `xz`, `zst` or `lz4`
+            read_size (int, optional): Number of bytes to read from the
+                source at a time. Defaults to `MIN_S3_SIZE`.
+        """
+        self.source = source
+        self.compression_type = compression_type
+        self.read_size = read_size
+
+        self._chunks = _decompress_streams(
+            iter(functools.partial(self.source.read, self.read_size), b''),
+            self.compression_type,
+        )
+        self._buffer = bytearray()
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while (size is None or size < 0
+               or len(self._buffer) < size) and self._done is False:
+            data = next(self._chunks, None)
+            if data is None:
+                self._done = True
+                break
+            self._buffer += data
+
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class S3Untar:
+
+    def __init__(self, source_bucket, source_key,
+                 target_bucket=None,
+                 folder='',
+                 concurrency=5,
+                 s3_max_retries=4,
+                 part_size_multiplier=None,
+                 upload_concurrency=2,
+                 server_side_copy=False,
+                 session=boto3.session.Session()):
+        """
+        Args:
+            source_bucket (str): Bucket the tar file is in
+            source_key (str): Key of the tar file
+            target_bucket (str, optional): Bucket to extract the files to.
+                Defaults to None, which uses the source bucket.
+            folder (str, optional): Folder to extract the files into.
+                Defaults to '', the top of the bucket.
+            concurrency (int, optional): Number of ranges of the tar file to
+                extract at the same time. Defaults to 5.
+            s3_max_retries (int, optional): Max retries of each s3 request.
+                Defaults to 4.
+            part_size_multiplier (int, optional): Files larger then
+                5MB * this are uploaded in parts of that size.
+                Defaults to None, which uses 10.
+            upload_concurrency (int, optional): Number of parts of a large
+                file to upload at the same time. Defaults to 2.
+            server_side_copy (bool, optional): Copy large files out of the
+                tar inside of s3, rather then downloading and uploading
+                them. Only for `.tar` files. Defaults to False.
+            session (boto3.session.Session, optional): Session to create the
+                s3 client with.
+        """
+        self.source_bucket = source_bucket
+        self.source_key = source_key
+        self.target_bucket = target_bucket
+        if self.target_bucket is None:
+            self.target_bucket = self.source_bucket
+        self.folder = folder.strip('/')
+
+        self.compression_type = _get_compression_type(self.source_key)
+
+        self.server_side_copy = server_side_copy
+        if self.server_side_copy is True and self.compression_type is not None:
+            raise ValueError("Server side copy can only be used"
+                             " with .tar files")
+
+        self.concurrency = concurrency
+        if self.concurrency is None or self.concurrency <= 0:
+            raise ValueError("concurrency must be 1 or larger")
+
+        self.upload_concurrency = upload_concurrency
+        if self.upload_concurrency is None or self.upload_concurrency <= 0:
+            raise ValueError("upload concurrency must be 1 or larger")
+
+        self.s3_max_retries = s3_max_retries
+        if self.s3_max_retries is None or self.s3_max_retries <= 0:
+            raise ValueError("s3 max retries must be 1 or larger")
+
+        self.part_size_multiplier = part_size_multiplier
+        if self.part_size_multiplier is None:
+            self.part_size_multiplier = 10
+        elif (not isinstance(self.part_size_multiplier, int)
+                or self.part_size_multiplier <= 0):
+            raise ValueError("part size multiplier must be 1 or larger")
+        # Files larger then this are uploaded in parts, smaller ones are
+        # read with the files next to them in ranges of about this size
+        self.part_size = MIN_S3_SIZE * self.part_size_multiplier
+
+        self.s3 = _create_s3_client(
+            session,
+            pool_size=self.concurrency * (self.upload_concurrency + 1),
+            max_retries=self.s3_max_retries,
+        )
+
+    def untar(self):
+        """Extract every file in the tar file to the target bucket
+
+        The files are found using the index uploaded next to the tar file
+        (see `member_index` of `S3Tar`). For `.tar` files without one, the
+        headers are read using ranged gets. The tar file is then split on
+        the files and the ranges are extracted at the same time.
+
+        Compressed tar files without an index are read as a single stream,
+        only the uploads are done at the same time.
+        """
+        members = self.list_members()
+        if members is None:
+            logger.info("No index for {}, reading it as a stream"
+                        .format(self.source_key))
+            self._extract_stream()
+            return
+
+        logger.info("Extracting {} files from {}"
+                    .format(len(members), self.source_key))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            # Get the results so any error is raised
+            list(executor.map(self._extract_members,
+                              self._group_members(members)))
+
+    def list_members(self):
+        """Get where each file is in the tar file
+
+        Returns:
+            list|None: Members like the ones in the index (see
+                `member_index.INDEX_FIELDS`). None if the tar file is
+                compressed and has no index
+        """
+        index = get_index(self.s3, self.source_bucket, self.source_key)
+        if index is not None:
+            return index['members']
+
+        if self.compression_type is not None:
+            # Where each file starts is only known once it is decompressed
+            return None
+
+        return list(walk_headers(self.s3, self.source_bucket,
+                                 self.source_key))
+
+    def _group_members(self, members):
+        """Split the members into what gets extracted together
+
+        Large files are on their own, the rest are grouped with the files
+        next to them, so each group is read using a single ranged get
+
+        Args:
+            members (list): Members like the ones in the index
+
+        Yields:
+            list: Members of the group, in the order they are in the tar
+        """
+        group = []
+        for member in sorted(members, key=lambda m: m['header_offset']):
+            if member['size'] > self.part_size:
+                if group:
+                    yield group
+                    group = []
+                yield [member]
+                continue
+
+            if group:
+                group_end = member['header_offset'] + member['length']
+                if group_end - group[0]['header_offset'] > self.part_size:
+                    yield group
+                    group = []
+            group.append(member)
+
+        if group:
+            yield group
+
+    def _extract_members(self, members):
+        """Extract a group of members from `_group_members`
+
+        Args:
+            members (list): Members like the ones in the index
+        """
+        if len(members) == 1 and members[0]['size'] > self.part_size:
+            self._extract_large_file(members[0])
+            return
+
+        start = members[0]['header_offset']
+        end = members[-1]['header_offset'] + members[-1]['length']
+        data = self._read_range(start, end)
+        for member in members:
+            offset = member['header_offset'] - start
+            member_data = data[offset:offset + member['length']]
+            self._put_file(member['name'], self._member_body(member,
+                                                             member_data))
+
+    def _member_body(self, member, member_data):
+        """Get the data of the file out of the bytes of its member
+
+        Args:
+            member (dict): Member like the ones in the index
+            member_data (bytes): Bytes of the member in the tar file
+
+        Returns:
+            bytes: The data of the file
+        """
+        if self.compression_type is None:
+            data_start = member['data_offset'] - member['header_offset']
+        else:
+            # The member is compressed on its own, in one or more streams
+            member_data = b''.join(_decompress_streams(
+                [member_data], self.compression_type,
+            ))
+            data_start = member['data_offset']
+        return member_data[data_start:data_start + member['size']]
+
+    def _extract_large_file(self, member):
+        """Extract a file that is too large for a single put
+
+        Args:
+            member (dict): Member like the ones in the index
+        """
+        if self.server_side_copy is False:
+            self._upload_large_file(member['name'],
+                                    self._large_file_chunks(member))
+            return
+
+        mpu = self._create_mpu(member['name'])
+        try:
+            start = member['data_offset']
+            end = start + member['size']
+            for part_start in range(start, end, self.part_size):
+                mpu.upload_part_copy(
+                    self.source_bucket,
+                    self.source_key,
+                    part_start,
+                    min(part_start + self.part_size, end),
+                )
+            mpu.complete()
+        except Exception:
+            mpu.abort()
+            raise
+
+    def _large_file_chunks(self, member):
+        """Read the data of a large file in chunks, using ranged gets
+
+        Args:
+            member (dict): Member like the ones in the index
+
+        Yields:
+            bytes: The next chunk of the data of the file
+        """
+        if self.compression_type is None:
+            start = member['data_offset']
+            end = start + member['size']
+            for part_start in range(start, end, self.part_size):
+                yield self._read_range(part_start,
+                                       min(part_start + self.part_size, end))
+            return
+
+        skip = member['data_offset']  # Header of the decompressed member
+        left = member['size']
+        start = member['header_offset']
+        end = start + member['length']
+        chunks = (self._read_range(part_start,
+                                   min(part_start + self.part_size, end))
+                  for part_start in range(start, end, self.part_size))
+        # Large files compressed on many threads are many streams
+        for data in _decompress_streams(chunks, self.compression_type):
+            skipped = min(skip, len(data))
+            skip -= skipped
+            data = data[skipped:skipped + left]
+            left -= len(data)
+            if data:
+                yield data
+
+    def _extract_stream(self):
+        """Extract the files of a compressed tar file that has no index, by
+        decompressing all of it in order
+        """
+        body = self.s3.get_object(
+            Bucket=self.source_bucket,
+            Key=self.source_key,
+        )['Body']
+        reader = _DecompressedReader(body, self.compression_type)
+
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                for tarinfo in tar:
+                    if not tarinfo.isreg():
+                        continue
+
+                    source = tar.extractfile(tarinfo)
+                    if tarinfo.size > self.part_size:
+                        chunks = iter(functools.partial(source.read,
+                                                        self.part_size), b'')
+                        self._upload_large_file(tarinfo.name, chunks)
+                        continue
+
+                    if len(pending) >= self.concurrency:
+                        # Limit the number of files held in memory
+                        done, pending = wait(pending,
+                                             return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    pending.add(executor.submit(self._put_file, tarinfo.name,
+                                                source.read()))
+
+            for future in pending:
+                future.result()
+
+    def _upload_large_file(self, name, chunks):
+        """Upload a file in parts of `part_size`
+
+        Args:
+            name (str): Filename and path of the file inside the tar
+            chunks (iterable): Data of the file, in order
+        """
+        mpu = self._create_mpu(name)
+        try:
+            part = bytearray()
+            for chunk in chunks:
+                part += chunk
+                while len(part) >= self.part_size:
+                    mpu.upload_part(io.BytesIO(part[:self.part_size]))
+                    del part[:self.part_size]
+            if part:
+                mpu.upload_part(io.BytesIO(part))
+            mpu.complete()
+        except Exception:
+            mpu.abort()
+            raise
+
+    def _create_mpu(self, name):
+        return S3MPU(self.s3, self.target_bucket, self._target_key(name),
+                     max_in_flight=self.upload_concurrency)
+
+    def _put_file(self, name, data):
+        """Upload a small file
+
+        Args:
+            name (str): Filename and path of the file inside the tar
+            data (bytes): Data of the file
+        """
+        logger.debug("Extracting {}".format(name))
+        self.s3.put_object(
+            Bucket=self.target_bucket,
+            Key=self._target_key(name),
+            Body=data,
+        )
+
+    def _target_key(self, name):
+        # Like tar, do not keep a leading `/` of the name
+        name = name.lstrip('/')
+        if self.folder:
+            return '{}/{}'.format(self.folder, name)
+        return name
+
+    def _read_range(self, start, end):
+        """Read part of the tar file
+
+        Args:
+            start (int): Offset of the first byte to read
+            end (int): Offset to stop reading at, exclusive
+
+        Returns:
+            bytes: The data
+        """
+        resp = self.s3.get_object(
+            Bucket=self.source_bucket,
+            Key=self.source_key,
+            Range='bytes={}-{}'.format(start, end - 1),
+        )
+        return resp['Body'].read()
@@ -0,0 +1,234 @@
+import io
+import logging
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from .planner import padded_size
+from .member_index import INDEX_SUFFIX, load_index
+from .utils import KB, MB
+
+logger = logging.getLogger(__name__)
+
+# Bytes read at a time while walking the headers of a .tar file. It grows
+# while the headers are close together, so the headers of many small
+# files come from a single request
+MIN_HEADER_READ_SIZE = 64 * KB
+MAX_HEADER_READ_SIZE = 8 * MB
+
+
+class _RangeReader(io.RawIOBase):
+    """Seekable file object over an s3 file, read using ranged gets
+
+    Reads ahead, anything that is seeked over is never downloaded. While
+    the reads are close together (small files one after another), the
+    read ahead doubles and the next ranges are read in the background
+    """
+
+    def __init__(self, read_range, size,
+                 min_read_size=MIN_HEADER_READ_SIZE,
+                 max_read_size=MAX_HEADER_READ_SIZE,
+                 prefetch=2):
+        """
+        Args:
+            read_range (function): Called with `start` & `end` offsets
+                (end is exclusive) and returns those bytes of the file
+            size (int): Size of the file
+            min_read_size (int, optional): Min number of bytes to read at
+                a time. Defaults to `MIN_HEADER_READ_SIZE`.
+            max_read_size (int, optional): Max number of bytes to read
+                ahead at a time. Defaults to `MAX_HEADER_READ_SIZE`.
+            prefetch (int, optional): Number of ranges to read in the
+                background while the reads are close together.
+                Defaults to 2.
+        """
+        self.read_range = read_range
+        self.size = size
+        self.min_read_size = min_read_size
+        self.max_read_size = max_read_size
+        self.prefetch = prefetch
+
+        self._position = 0
+        self._buffer = b''
+        self._buffer_start = 0
+        self._read_size = self.min_read_size
+        self._prefetched = {}  # Future of each range, by its start
+        self._executor = None
+        if self.prefetch > 0:
+            self._executor = ThreadPoolExecutor(max_workers=self.prefetch)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._position = offset
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self._position
+        end = min(self._position + size, self.size)
+        if end <= self._position:
+            return b''
+
+        buffer_end = self._buffer_start + len(self._buffer)
+        if not self._buffer_start <= self._position < end <= buffer_end:
+            self._fill_buffer(end, buffer_end)
+
+        data = self._buffer[self._position - self._buffer_start:
+                            end - self._buffer_start]
+        self._position = end
+        return data
+
+    def close(self):
+        for future in self._prefetched.values():
+            future.cancel()
+        self._prefetched = {}
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        super().close()
+
+    def _fill_buffer(self, end, buffer_end):
+        """Read the range from the current position up to at least `end`
+
+        Args:
+            end (int): Offset the buffer has to reach, exclusive
+            buffer_end (int): Offset the current buffer ends at
+        """
+        gap = self._position - buffer_end
+        if self._buffer and gap < self._read_size:
+            # Skipping less then what is read at a time, so the files are
+            # small. Read more of them at a time
+            self._read_size = min(self._read_size * 2, self.max_read_size)
+            close_together = True
+        else:
+            self._read_size = self.min_read_size
+            close_together = False
+
+        tail = b''
+        start = self._position
+        if self._buffer and self._buffer_start <= self._position < buffer_end:
+            # Keep what is already read, and continue from the end of it
+            tail = self._buffer[self._position - self._buffer_start:]
+            start = buffer_end
+
+        read_end = max(end, min(start + self._read_size, self.size))
+        self._buffer = tail + self._get_range(start, read_end)
+        self._buffer_start = self._position
+
+        if close_together is True and self._executor is not None:
+            self._prefetch_ranges(self._buffer_start + len(self._buffer))
+
+    def _get_range(self, start, end):
+        """Get a range, using one that was read in the background if it
+        started at the same offset
+
+        Args:
+            start (int): Offset of the first byte to read
+            end (int): Min offset to read up to, exclusive
+
+        Returns:
+            bytes: The data, at least up to `end`
+        """
+        future = self._prefetched.pop(start, None)
+        for other in self._prefetched.values():
+            other.cancel()
+        self._prefetched = {}
+
+        data = b''
+        if future is not None:
+            data = future.result()
+        if start + len(data) < end:
+            data += self.read_range(start + len(data), end)
+        return data
+
+    def _prefetch_ranges(self, start):
+        """Start reading the next ranges in the background
+
+        Args:
+            start (int): Offset the first range starts at
+        """
+        for _ in range(self.prefetch):
+            if start >= self.size:
+                return
+            end = min(start + self._read_size, self.size)
+            self._prefetched[start] = self._executor.submit(self.read_range,
+                                                            start, end)
+            start = end
+
+
+def get_index(s3, bucket, key):
+    """Get the index uploaded next to a tar file
+
+    Args:
+        s3 (botocore.client.S3): S3 client to use
+        bucket (str): Bucket the tar file is in
+        key (str): Key of the tar file
+
+    Returns:
+        dict|None: The index (see `member_index.load_index`), None if there
+            is not one
+    """
+    try:
+        resp = s3.get_object(Bucket=bucket, Key=key + INDEX_SUFFIX)
+    except s3.exceptions.NoSuchKey:
+        return None
+    return load_index(resp['Body'].read())
+
+
+def walk_headers(s3, bucket, key, prefetch=2):
+    """Find the files in a .tar file in s3 by reading only its headers
+
+    Each header has the size of the file after it, so the next header is
+    found without reading the file
+
+    Args:
+        s3 (botocore.client.S3): S3 client to use
+        bucket (str): Bucket the tar file is in
+        key (str): Key of the tar file
+        prefetch (int, optional): Number of ranges to read ahead in the
+            background while the files are small. Defaults to 2.
+
+    Yields:
+        dict: Member like the ones in the index (see
+            `member_index.INDEX_FIELDS`), `key` is None
+    """
+    size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+    def read_range(start, end):
+        return s3.get_object(
+            Bucket=bucket,
+            Key=key,
+            Range='bytes={}-{}'.format(start, end - 1),
+        )['Body'].read()
+
+    reader = _RangeReader(read_range, size, prefetch=prefetch)
+    with reader, tarfile.open(fileobj=reader, mode='r:') as tar:
+        while True:
+            tarinfo = tar.next()
+            if tarinfo is None:
+                break
+            # Do not keep every header of a large tar file in memory
+            tar.members = []
+            if not tarinfo.isreg():
+                continue
+
+            yield {
+                'name': tarinfo.name,
+                'key': None,
+                'header_offset': tarinfo.offset,
+                'data_offset': tarinfo.offset_data,
+                'length': (tarinfo.offset_data
+                           + padded_size(tarinfo.size)
+                           - tarinfo.offset),
+                'size': tarinfo.size,
+                'mtime': tarinfo.mtime,
+            }
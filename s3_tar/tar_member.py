@@ -0,0 +1,164 @@
+import tarfile
+
+
+class TarMemberStream:
+    """Build a tar member on the fly from a source that is read in ranges
+
+    The tar header is created from the known size of the source, then the
+    body is pulled in one chunk at a time as it is read, so only about one
+    chunk is ever held in memory no matter how large the source is.
+    """
+
+    def __init__(self, tarinfo, read_range, chunk_size,
+                 compressor=None, key=None):
+        """
+        Args:
+            tarinfo (tarfile.TarInfo): Info of the member, size must be set
+            read_range (function): Called with `start` & `end` offsets
+                (end is exclusive) and returns those bytes of the source
+            chunk_size (int): Max number of bytes to read from the source
+                at a time
+            compressor (object, optional): Object with `compress` & `flush`
+                methods (e.g. from `zlib.compressobj`) the member gets
+                passed through. Defaults to None.
+            key (str, optional): S3 key of the source. Defaults to None.
+        """
+        self.tarinfo = tarinfo
+        self.size = tarinfo.size
+        self.read_range = read_range
+        self.chunk_size = chunk_size
+        self.compressor = compressor
+        self.key = key
+
+        self._header = tarinfo.tobuf(tarfile.DEFAULT_FORMAT,
+                                     tarfile.ENCODING,
+                                     'surrogateescape')
+        remainder = self.size % tarfile.BLOCKSIZE
+        self._padding = b''
+        if remainder > 0:
+            self._padding = tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+        self._body_offset = 0
+        self._buffer = bytearray()
+        self._done = False
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        """Read the next bytes of the tar member
+
+        When a size is given, this may return less then that. The header,
+        each range of the body and the padding are returned separately,
+        and no more of the source is downloaded then what was asked for.
+
+        Args:
+            size (int, optional): Max number of bytes to return.
+                Defaults to -1, which reads everything that is left.
+
+        Returns:
+            bytes: The data, empty once the whole member has been read
+        """
+        if size is None or size < 0:
+            while self._done is False:
+                self._buffer += self._next_chunk(self.chunk_size)
+            size = len(self._buffer)
+        else:
+            while not self._buffer and self._done is False:
+                self._buffer += self._next_chunk(size)
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def close(self):
+        self._buffer = bytearray()
+        self._done = True
+
+    def body_range(self):
+        """Get the range of the source that is left, if that is what
+        gets read next
+
+        Only possible when not compressing, since then the bytes of the
+        source end up in the tar as is
+
+        Returns:
+            tuple|None: Start and end (exclusive) offsets of the source
+        """
+        if (self.compressor is not None
+                or self._header is not None
+                or self._buffer
+                or self._body_offset >= self.size):
+            return None
+        return self._body_offset, self.size
+
+    def skip_body(self, end):
+        """Skip over the source up to `end`, for when those bytes
+        were added to the tar some other way (e.g. a server side copy)
+
+        Args:
+            end (int): Offset of the source to continue reading from
+        """
+        self._body_offset = end
+
+    def skip(self, size):
+        """Skip over the first bytes of the member, for when they were
+        already added to a tar before
+
+        When not compressing, the skipped part of the source is not
+        downloaded. Must be called before anything is read.
+
+        Args:
+            size (int): Number of bytes of the member to skip
+        """
+        if self.compressor is not None:
+            # The compressed bytes depend on everything before them
+            while size > 0:
+                data = self.read(size)
+                if not data:
+                    break
+                size -= len(data)
+            return
+
+        header_size = min(size, len(self._header))
+        self._header = self._header[header_size:] or None
+        size -= header_size
+
+        body_size = min(size, self.size - self._body_offset)
+        self._body_offset += body_size
+        size -= body_size
+
+        self._padding = self._padding[size:]
+
+    def _next_chunk(self, size):
+        """Get the next piece of the member: header, body chunk or padding
+
+        Args:
+            size (int): Number of bytes wanted. When not compressing, no
+                more then this is read from the source
+
+        Returns:
+            bytes: Next piece, compressed if a compressor is set
+        """
+        if self._header is not None:
+            data = self._header
+            self._header = None
+
+        elif self._body_offset < self.size:
+            chunk_size = self.chunk_size
+            if self.compressor is None:
+                chunk_size = min(chunk_size, size)
+            end = min(self._body_offset + chunk_size, self.size)
+            data = self.read_range(self._body_offset, end)
+            self._body_offset = end
+
+        else:
+            data = self._padding
+            self._done = True
+
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+            if self._done is True:
+                data += self.compressor.flush()
+
+        return data
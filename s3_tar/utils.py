@@ -1,9 +1,15 @@
+import io
 import os
 import re
+import bz2
+import zlib
+import lzma
 import queue
 import logging
+import tempfile
 import botocore
 import threading
+from . import compression
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +19,37 @@ GB = KB**3
 TB = KB**4
 # S3 multi-part upload parts must be larger than 5mb (expect last part)
 MIN_S3_SIZE = 5 * MB
+# S3 multi-part upload parts can not be larger than 5gb
+MAX_S3_SIZE = 5 * GB
+
+# Most keys s3 deletes in a single request
+DELETE_BATCH_SIZE = 1000
+# Seconds to wait before retrying keys that failed to delete, doubled
+# after each try
+DELETE_RETRY_DELAY = 0.5
+
+# Min and max compression level of each compression type
+COMPRESSION_LEVELS = {
+    'gz': (1, 9),
+    'bz2': (1, 9),
+    'xz': (0, 9),
+    'zst': (1, 22),
+    'lz4': (0, 16),
+}
+# Compression type of each tar file extension
+TAR_EXTENSIONS = {
+    '.tar': None,
+    '.tar.gz': 'gz',
+    '.tar.bz2': 'bz2',
+    '.tar.xz': 'xz',
+    '.tar.zst': 'zst',
+    '.tar.lz4': 'lz4',
+}
+# Optional packages needed for some compression types
+_COMPRESSION_PACKAGES = {
+    'zst': ('zstandard', 'zstd'),
+    'lz4': ('lz4', 'lz4'),
+}
 
 
 def _create_s3_client(session, pool_size=10, max_retries=4):
@@ -29,7 +66,158 @@ def _create_s3_client(session, pool_size=10, max_retries=4):
     )
 
 
-def _threads(num_threads, data, callback, *args, **kwargs):
+def _create_buffer(spill_size=None, spill_dir=None):
+    """Create a buffer to hold data being staged
+
+    Args:
+        spill_size (int, optional): Move the data to a temp file once it is
+            larger then this. Defaults to None, which keeps it in memory.
+        spill_dir (str, optional): Directory to create the temp file in.
+            Defaults to None, which uses the system temp directory.
+
+    Returns:
+        io.BytesIO|tempfile.SpooledTemporaryFile: The empty buffer
+    """
+    if spill_size is None:
+        return io.BytesIO()
+    # A max size of 0 would never spill
+    return tempfile.SpooledTemporaryFile(max_size=max(1, spill_size),
+                                         dir=spill_dir)
+
+
+def _check_compression_type(compression_type):
+    """Make sure the package needed for the compression type is installed
+
+    Args:
+        compression_type (str): `gz`, `bz2`, `xz`, `zst` or `lz4`
+
+    Raises:
+        ImportError: If the optional package is not installed
+    """
+    if compression_type not in _COMPRESSION_PACKAGES:
+        return
+
+    package, extra = _COMPRESSION_PACKAGES[compression_type]
+    if getattr(compression, package) is None:
+        raise ImportError("{} is needed for .tar.{} files, install it with"
+                          " `pip install s3-tar[{}]`"
+                          .format(package, compression_type, extra))
+
+
+def _create_compressor(compression_type, level=None, workers=None,
+                       long_distance_matching=False):
+    """Create a streaming compressor for the compression type
+
+    Args:
+        compression_type (str): `gz`, `bz2`, `xz`, `zst` or `lz4`
+        level (int, optional): Compression level, see `COMPRESSION_LEVELS`.
+            Defaults to None, which uses 9 for gz & bz2 like `tarfile`
+            and the default of the library for the others.
+        workers (int, optional): Number of threads zstd compresses with.
+            Defaults to None, which compresses in the calling thread.
+        long_distance_matching (bool, optional): Have zstd look for
+            matches much further back. Defaults to False.
+
+    Returns:
+        object: Compressor with `compress` & `flush` methods
+    """
+    _check_compression_type(compression_type)
+
+    if compression_type == 'gz':
+        if level is None:
+            level = 9
+        # wbits of 16 + MAX_WBITS writes the gzip header and trailer
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression_type == 'bz2':
+        if level is None:
+            level = 9
+        return bz2.BZ2Compressor(level)
+    elif compression_type == 'xz':
+        return lzma.LZMACompressor(preset=level)
+    elif compression_type == 'zst':
+        if level is None:
+            level = 3
+        window_log = 0  # Let zstd pick based on the level
+        if long_distance_matching is True:
+            window_log = compression.ZSTD_LONG_WINDOW_LOG
+        params = compression.zstandard.ZstdCompressionParameters.from_level(
+            level,
+            threads=workers or 0,
+            enable_ldm=long_distance_matching,
+            window_log=window_log,
+        )
+        return compression.zstandard.ZstdCompressor(
+            compression_params=params,
+        ).compressobj()
+    elif compression_type == 'lz4':
+        return compression.LZ4Compressor(level)
+    else:
+        raise ValueError("Invalid compression type: {}"
+                         .format(compression_type))
+
+
+def _create_decompressor(compression_type):
+    """Create a streaming decompressor for the compression type
+
+    Args:
+        compression_type (str): `gz`, `bz2`, `xz`, `zst` or `lz4`
+
+    Returns:
+        object: Decompressor with a `decompress` method and `eof` &
+            `unused_data` attributes for when the stream has ended
+    """
+    _check_compression_type(compression_type)
+
+    if compression_type == 'gz':
+        # wbits of 16 + MAX_WBITS reads the gzip header and trailer
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression_type == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif compression_type == 'xz':
+        return lzma.LZMADecompressor()
+    elif compression_type == 'zst':
+        return compression.zstandard.ZstdDecompressor().decompressobj()
+    elif compression_type == 'lz4':
+        return compression.lz4.frame.LZ4FrameDecompressor()
+    else:
+        raise ValueError("Invalid compression type: {}"
+                         .format(compression_type))
+
+
+def _get_compression_type(key):
+    """Get the compression type of a tar file from its extension
+
+    Args:
+        key (str): Key of the tar file
+
+    Raises:
+        ValueError: If it is not a tar file
+
+    Returns:
+        str|None: The compression type, None for `.tar` files
+    """
+    for extension, compression_type in TAR_EXTENSIONS.items():
+        if key.endswith(extension):
+            return compression_type
+    raise ValueError("Invalid file extension: {}".format(key))
+
+
+def _get_delete_errors(resp):
+    """Get the keys a delete_objects request could not delete
+
+    Args:
+        resp (dict): The delete_objects response
+
+    Returns:
+        dict: Code & message of the error of each key, by key
+    """
+    return {
+        error['Key']: '{}: {}'.format(error.get('Code'), error.get('Message'))
+        for error in resp.get('Errors', [])
+    }
+
+
+def _threads(num_threads, data, callback, *args, on_error=None, **kwargs):
     q = queue.Queue()
     item_list = []
 
@@ -48,6 +236,8 @@ def _threads(num_threads, data, callback, *args, **kwargs):
                     # add on the last try
                     if i == 2:
                         item_list.append(None)
+                        if on_error is not None:
+                            on_error(item)
                 else:
                     item_list.append(response)
                     break
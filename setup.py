@@ -7,7 +7,7 @@ with open('README.md', 'r') as f:
 setup(
     name='s3-tar',
     packages=['s3_tar'],
-    version='0.1.13',
+    version='0.2.0',
     description='Tar (and compress) files in s3',
     long_description=long_description,
     long_description_content_type='text/markdown',
@@ -24,10 +24,16 @@ setup(
     entry_points={
         'console_scripts': [
             's3-tar=s3_tar.cli:cli',
+            's3-untar=s3_tar.cli:untar_cli',
         ],
     },
     install_requires=[
         'boto3',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'async': ['aiobotocore'],
+    },
 
 )
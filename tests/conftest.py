@@ -0,0 +1,8 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def s3_checksum_when_required(monkeypatch):
+    # Uploads with checksums get sent using aws-chunked encoding,
+    # which moto saves as is rather then decoding
+    monkeypatch.setenv('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
@@ -0,0 +1,239 @@
+import io
+import asyncio
+import threading
+import boto3
+import tarfile
+import pytest
+from moto import mock_s3
+from s3_tar import S3Tar
+from s3_tar import async_engine
+from s3_tar.utils import MIN_S3_SIZE
+
+
+class AsyncBody:
+    def __init__(self, body):
+        self.body = body
+
+    async def read(self, amt=None):
+        return self.body.read(amt)
+
+
+class AsyncClient:
+    """Awaitable client over the (moto) boto3 client, like aiobotocore's"""
+
+    def __init__(self, s3):
+        self.s3 = s3
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def __getattr__(self, name):
+        method = getattr(self.s3, name)
+
+        async def call(**kwargs):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                # Let the other tasks run, as if waiting on the network
+                await asyncio.sleep(0.01)
+                resp = method(**kwargs)
+            finally:
+                self.in_flight -= 1
+            if 'Body' in resp:
+                resp['Body'] = AsyncBody(resp['Body'])
+            return resp
+
+        return call
+
+
+def _put_files(s3):
+    s3.create_bucket(Bucket='my-bucket')
+    sources = {}
+    for i in range(20):
+        sources['thing{}.txt'.format(i)] = 'thing{}'.format(i).encode() * 100
+    # Streamed in ranges
+    sources['large.bin'] = b'abcdefgh' * (MIN_S3_SIZE // 8) + b'end'
+    for name, source in sources.items():
+        s3.put_object(
+            Bucket='my-bucket',
+            Key='some_folder/{}'.format(name),
+            Body=source,
+            Metadata={'name': name},
+        )
+    return sources
+
+
+@mock_s3
+@pytest.mark.parametrize('target_key, options', [
+    ('my-data.tar', {}),
+    ('my-data.tar.gz', {'save_metadata': True}),
+    ('my-data.tar.gz', {'single_compression_stream': True}),
+])
+def test_tar_async(target_key, options):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    sources = _put_files(s3)
+    client = AsyncClient(s3)
+
+    tar = S3Tar('my-bucket', target_key, part_size_multiplier=1,
+                remove_keys=True, session=session, **options)
+
+    async def run():
+        await tar.add_files_async('some_folder', s3=client)
+        await tar.tar_async(s3=client, concurrency=4)
+
+    asyncio.run(run())
+    assert 1 < client.max_in_flight <= 4 + tar.upload_concurrency
+
+    resp = s3.get_object(Bucket='my-bucket', Key=target_key)
+    tar_obj = tarfile.open(fileobj=io.BytesIO(resp['Body'].read()))
+    for name, source in sources.items():
+        assert tar_obj.extractfile(name).read() == source
+        if options.get('save_metadata') is True:
+            assert (tar_obj.extractfile(name + '.metadata.json').read()
+                    == '{{"name": "{}"}}'.format(name).encode())
+    # All of the files were removed
+    assert s3.list_objects_v2(Bucket='my-bucket',
+                              Prefix='some_folder')['KeyCount'] == 0
+
+
+@mock_s3
+@pytest.mark.parametrize('options', [
+    {},  # The large file is compressed as it is streamed
+    {'single_compression_stream': True},
+    {'single_compression_stream': True, 'compression_workers': 2},
+])
+def test_tar_async_compresses_off_the_loop(options):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    sources = _put_files(s3)
+    client = AsyncClient(s3)
+
+    tar = S3Tar('my-bucket', 'my-data.tar.gz', part_size_multiplier=1,
+                session=session, **options)
+    create_compressor = tar._create_compressor
+    threads = []
+
+    class Compressor:
+        def __init__(self):
+            self.compressor = create_compressor()
+
+        def compress(self, data):
+            threads.append(threading.current_thread())
+            return self.compressor.compress(data)
+
+        def flush(self):
+            threads.append(threading.current_thread())
+            return self.compressor.flush()
+
+    tar._create_compressor = Compressor
+
+    async def run():
+        await tar.add_files_async('some_folder', s3=client)
+        await tar.tar_async(s3=client, concurrency=4)
+
+    asyncio.run(run())
+    assert threads
+    assert threading.main_thread() not in threads
+
+    resp = s3.get_object(Bucket='my-bucket', Key='my-data.tar.gz')
+    tar_obj = tarfile.open(fileobj=io.BytesIO(resp['Body'].read()))
+    for name, source in sources.items():
+        assert tar_obj.extractfile(name).read() == source
+
+
+@mock_s3
+def test_tar_async_deterministic_min_file_size():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    sources = _put_files(s3)
+    client = AsyncClient(s3)
+
+    tar = S3Tar('my-bucket', 'my-data.tar', min_file_size='1KB',
+                deterministic=True, session=session)
+    tar.add_file('some_folder/large.bin')
+    for i in range(3):
+        tar.add_file('some_folder/thing{}.txt'.format(i))
+    asyncio.run(tar.tar_async(s3=client))
+
+    names = []
+    for file_number in range(1, 5):
+        resp = s3.get_object(Bucket='my-bucket',
+                             Key='my-data-{}.tar'.format(file_number))
+        tar_obj = tarfile.open(fileobj=io.BytesIO(resp['Body'].read()))
+        names += tar_obj.getnames()
+        for name in tar_obj.getnames():
+            assert tar_obj.extractfile(name).read() == sources[name]
+    # In order of their keys
+    assert names == ['large.bin', 'thing0.txt', 'thing1.txt', 'thing2.txt']
+
+
+@mock_s3
+def test_tar_async_range_retry():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    sources = _put_files(s3)
+    client = AsyncClient(s3)
+    get_object = client.get_object
+    ranges = []
+
+    async def _fail_first_tries(**kwargs):
+        if 'Range' in kwargs:
+            ranges.append(kwargs['Range'])
+            if len(ranges) <= 2:
+                raise ValueError("Connection reset")
+        return await get_object(**kwargs)
+
+    client.get_object = _fail_first_tries
+    tar = S3Tar('my-bucket', 'my-data.tar', part_size_multiplier=1,
+                session=session)
+    tar.add_file('some_folder/large.bin')
+    asyncio.run(tar.tar_async(s3=client))
+
+    assert ranges[0] == ranges[1] == ranges[2]
+    resp = s3.get_object(Bucket='my-bucket', Key='my-data.tar')
+    tar_obj = tarfile.open(fileobj=io.BytesIO(resp['Body'].read()))
+    assert tar_obj.extractfile('large.bin').read() == sources['large.bin']
+
+
+@mock_s3
+def test_tar_async_remove_keys_download_fail():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    _put_files(s3)
+    client = AsyncClient(s3)
+    get_object = client.get_object
+
+    async def _fail_thing1(**kwargs):
+        if kwargs['Key'] == 'some_folder/thing1.txt':
+            raise ValueError("Download failed")
+        return await get_object(**kwargs)
+
+    client.get_object = _fail_thing1
+    tar = S3Tar('my-bucket', 'my-data.tar', remove_keys=True,
+                session=session)
+
+    async def run():
+        await tar.add_files_async('some_folder', s3=client)
+        await tar.tar_async(s3=client)
+
+    asyncio.run(run())
+
+    # It is in no archive, so it is kept and reported
+    resp = s3.list_objects_v2(Bucket='my-bucket', Prefix='some_folder')
+    assert [obj['Key'] for obj in resp['Contents']] == [
+        'some_folder/thing1.txt',
+    ]
+    assert tar.kept_keys == {'some_folder/thing1.txt'}
+
+
+def test_tar_async_unsupported_options():
+    tar = S3Tar('my-bucket', 'my-data.tar', server_side_copy=True)
+    with pytest.raises(ValueError):
+        asyncio.run(tar.tar_async(s3=AsyncClient(None)))
+
+
+def test_tar_async_needs_aiobotocore(monkeypatch):
+    monkeypatch.setattr(async_engine, 'aiobotocore', None)
+    tar = S3Tar('my-bucket', 'my-data.tar')
+    with pytest.raises(ImportError):
+        asyncio.run(tar.tar_async())
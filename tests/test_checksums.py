@@ -0,0 +1,56 @@
+import io
+import zlib
+import hashlib
+from s3_tar.checksums import (Checksum, md5_of, etag_matches, multipart_etag,
+                              dump_manifest)
+
+
+def test_checksum():
+    checksum = Checksum()
+    checksum.update(b'hello ')
+    checksum.update(b'world')
+    assert checksum.size == 11
+    assert checksum.md5 == hashlib.md5(b'hello world').hexdigest()
+    assert checksum.crc32 == '{:08x}'.format(zlib.crc32(b'hello world'))
+
+
+def test_md5_of():
+    source_io = io.BytesIO(b'hello world')
+    source_io.seek(5)
+    assert md5_of(source_io) == hashlib.md5(b'hello world').hexdigest()
+    assert source_io.tell() == 0
+
+
+def test_etag_matches():
+    md5 = hashlib.md5(b'hello world').hexdigest()
+    assert etag_matches('"{}"'.format(md5), md5) is True
+    assert etag_matches(md5, md5) is True
+    assert etag_matches('"{}"'.format('0' * 32), md5) is False
+    # Multipart ETags can not be checked without the part sizes
+    assert etag_matches('"{}-2"'.format('0' * 32), md5) is None
+    assert etag_matches(None, md5) is None
+
+
+def test_etag_matches_encrypted():
+    md5 = hashlib.md5(b'hello world').hexdigest()
+    etag = '"{}"'.format('0' * 32)
+    # SSE-S3 ETags are still the md5
+    assert etag_matches(etag, md5, {'ServerSideEncryption': 'AES256'}) is False
+    # SSE-KMS and SSE-C ETags are not
+    assert etag_matches(etag, md5, {'ServerSideEncryption': 'aws:kms'}) is None
+    assert etag_matches(etag, md5,
+                        {'ServerSideEncryption': 'aws:kms:dsse'}) is None
+    assert etag_matches(etag, md5, {'SSECustomerAlgorithm': 'AES256'}) is None
+
+
+def test_multipart_etag():
+    part_md5s = [hashlib.md5(b'a').digest(), hashlib.md5(b'b').digest()]
+    expected = hashlib.md5(b''.join(part_md5s)).hexdigest()
+    assert multipart_etag(['"{}"'.format(md5.hex())
+                           for md5 in part_md5s]) == '"{}-2"'.format(expected)
+
+
+def test_dump_manifest():
+    manifest = dump_manifest('my-data.tar', '"abc-1"', ['"def"'], [])
+    assert manifest == (b'{"archive":"my-data.tar","etag":"\\"abc-1\\"",'
+                        b'"parts":["\\"def\\""],"files":[]}')
@@ -1,5 +1,5 @@
 import pytest
-from s3_tar.cli import create_parser
+from s3_tar.cli import create_parser, create_untar_parser
 
 
 def test_parser_no_args():
@@ -17,12 +17,94 @@ def test_parser_check_all_inputs():
         '--filename', 'same_me.tar.gz',
         '--save-metadata',
         '--min-filesize', '2MB',
+        '--max-filesize', '1GB',
+        '--plan',
+        '--list',
+        '--archive-concurrency', '3',
         '--cache-size', '7',
+        '--max-memory', '4GB',
+        '--spill-size', '8MB',
+        '--spill-dir', '/mnt/nvme',
+        '--upload-concurrency', '4',
+        '--compression-level', '6',
+        '--single-compression-stream',
+        '--compression-workers', '8',
+        '--long-distance-matching',
+        '--deterministic',
+        '--member-index',
+        '--verify',
+        '--remove',
+        '--incremental-remove',
+        '--progress',
+        '--metrics-file', 'metrics.prom',
+        '--progress-interval', '0.5',
     ])
     assert args.source_bucket == 'my-bucket'
     assert args.target_bucket == 'other-bucket'
     assert args.folder == 'mydata/is_here'
     assert args.filename == 'same_me.tar.gz'
     assert args.save_metadata is True
+    assert args.list is True
     assert args.min_filesize == '2MB'
     assert args.cache_size == 7
+    assert args.max_memory == '4GB'
+    assert args.spill_size == '8MB'
+    assert args.spill_dir == '/mnt/nvme'
+    assert args.upload_concurrency == 4
+    assert args.compression_level == 6
+    assert args.single_compression_stream is True
+    assert args.compression_workers == 8
+    assert args.long_distance_matching is True
+    assert args.deterministic is True
+    assert args.member_index is True
+    assert args.verify is True
+    assert args.remove is True
+    assert args.incremental_remove is True
+    assert args.progress is True
+    assert args.metrics_file == 'metrics.prom'
+    assert args.progress_interval == 0.5
+    assert args.max_filesize == '1GB'
+    assert args.plan is True
+    assert args.archive_concurrency == 3
+
+
+def test_untar_parser_no_args():
+    parser = create_untar_parser()
+    with pytest.raises(SystemExit):
+        parser.parse_args('')
+
+
+def test_untar_parser_check_all_inputs():
+    parser = create_untar_parser()
+    args = parser.parse_args([
+        '--source-bucket', 'my-bucket',
+        '--filename', 'same_me.tar.gz',
+        '--folder', 'restored',
+        '--target-bucket', 'other-bucket',
+        '--concurrency', '8',
+        '--server-side-copy',
+        '--s3-max-retries', '6',
+        '--part-size-multiplier', '3',
+        '--upload-concurrency', '4',
+    ])
+    assert args.source_bucket == 'my-bucket'
+    assert args.filename == 'same_me.tar.gz'
+    assert args.folder == 'restored'
+    assert args.target_bucket == 'other-bucket'
+    assert args.concurrency == 8
+    assert args.server_side_copy is True
+    assert args.s3_max_retries == 6
+    assert args.part_size_multiplier == 3
+    assert args.upload_concurrency == 4
+
+
+def test_untar_parser_defaults():
+    parser = create_untar_parser()
+    args = parser.parse_args([
+        '--source-bucket', 'my-bucket',
+        '--filename', 'same_me.tar',
+    ])
+    assert args.folder == ''
+    assert args.target_bucket is None
+    assert args.concurrency == 5
+    assert args.server_side_copy is False
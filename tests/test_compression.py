@@ -0,0 +1,81 @@
+import zlib
+import gzip
+import random
+from concurrent.futures import ThreadPoolExecutor
+from s3_tar.compression import ParallelGzipCompressor, ParallelBz2Compressor
+
+
+def _random_text(size):
+    words = [b'beep', b'boop', b'foo', b'bar', b'baz', b'\n']
+    rand = random.Random(42)
+    return b' '.join(rand.choice(words) for _ in range(size // 4))[:size]
+
+
+def _compress(compressor, data, write_size):
+    output = b''
+    for i in range(0, len(data), write_size):
+        output += compressor.compress(data[i:i + write_size])
+    return output + compressor.flush()
+
+
+###
+# ParallelGzipCompressor
+###
+def test_parallel_gzip_single_stream():
+    data = _random_text(1024 * 1024)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        compressor = ParallelGzipCompressor(executor, block_size=64 * 1024,
+                                            max_pending=4)
+        output = _compress(compressor, data, 10000)
+
+    # gzip checks the crc and size in the trailer
+    assert gzip.decompress(output) == data
+
+    # A single gzip stream, not one per block
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    decompressor.decompress(output)
+    assert decompressor.eof is True
+    assert decompressor.unused_data == b''
+
+
+def test_parallel_gzip_ratio():
+    data = _random_text(1024 * 1024)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        compressor = ParallelGzipCompressor(executor, block_size=64 * 1024)
+        output = _compress(compressor, data, 10000)
+
+    # Each block is primed with the one before it, so the ratio stays close
+    serial_size = len(gzip.compress(data))
+    assert len(output) < serial_size * 1.02
+
+
+def test_parallel_gzip_empty():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        compressor = ParallelGzipCompressor(executor)
+        output = compressor.flush()
+
+    assert gzip.decompress(output) == b''
+
+
+###
+# ParallelBz2Compressor
+###
+def test_parallel_bz2_concatenated_streams():
+    import bz2
+    data = _random_text(1024 * 1024)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        compressor = ParallelBz2Compressor(executor, level=1, max_pending=4)
+        output = _compress(compressor, data, 10000)
+
+    assert bz2.decompress(output) == data
+    # A 100KB block per stream at level 1
+    assert output.count(b'BZh1') >= len(data) // (100 * 1000)
+
+
+def test_parallel_bz2_empty():
+    import bz2
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        compressor = ParallelBz2Compressor(executor)
+        output = compressor.flush()
+
+    assert bz2.decompress(output) == b''
@@ -0,0 +1,50 @@
+from s3_tar.journal import Journal
+
+
+def test_journal_reload(tmp_path):
+    path = str(tmp_path / 'job.journal')
+    journal = Journal(path)
+    journal.save_plan([('a.txt', 'data/a.txt'), ('b.txt', 'data/b.txt')])
+    journal.start_archive(1, 'my-data.tar', 'upload-1')
+    journal.save_part(1, 1, '"etag1"', 100, [('a.txt', 'data/a.txt')], True,
+                      partial=('b.txt', 'data/b.txt', 10))
+    journal.complete_archive(1)
+    journal.close()
+
+    journal = Journal(path)
+    assert journal.plan == {('a.txt', 'data/a.txt'), ('b.txt', 'data/b.txt')}
+    archive = journal.archives[1]
+    assert archive['upload_id'] == 'upload-1'
+    assert archive['complete'] is True
+    assert archive['parts'][1]['partial'] == ['b.txt', 'data/b.txt', 10]
+    assert journal.archive_items(1) == {('a.txt', 'data/a.txt')}
+
+
+def test_journal_resume_drops_later_parts(tmp_path):
+    path = str(tmp_path / 'job.journal')
+    journal = Journal(path)
+    journal.start_archive(1, 'my-data.tar', 'upload-1')
+    for part_number in range(1, 4):
+        journal.save_part(1, part_number, '"etag"', 100,
+                          [(str(part_number), str(part_number))], True)
+    journal.resume_archive(1, 1)
+
+    assert list(journal.archives[1]['parts']) == [1]
+    assert journal.archive_items(1) == {('1', '1')}
+
+
+def test_journal_partly_written_line(tmp_path):
+    path = str(tmp_path / 'job.journal')
+    journal = Journal(path)
+    journal.start_archive(1, 'my-data.tar', 'upload-1')
+    journal.close()
+    with open(path, 'a') as f:
+        f.write('{"event": "comp')
+
+    journal = Journal(path)
+    assert journal.archives[1]['complete'] is False
+    journal.complete_archive(1)
+    journal.close()
+
+    journal = Journal(path)
+    assert journal.archives[1]['complete'] is True
@@ -0,0 +1,29 @@
+from s3_tar.member_index import index_entry, dump_index, load_index
+
+
+def test_index_entry():
+    # 512 byte header, 1000 bytes of data padded to 1024
+    assert index_entry('a.txt', 'folder/a.txt', 100, 1636, 1000, 10) == [
+        'a.txt', 'folder/a.txt', 100, 612, 1536, 1000, 10,
+    ]
+    # The data starts after the header, once decompressed
+    assert index_entry('a.txt', 'folder/a.txt', 100, 400, 1000, 10,
+                       compressed=True)[2:5] == [100, 512, 300]
+
+
+def test_dump_load_index():
+    members = [index_entry('a.txt', 'folder/a.txt', 0, 1536, 1000, 10.0)]
+    index = load_index(dump_index('my-data.tar', None, members))
+    assert index == {
+        'archive': 'my-data.tar',
+        'compression': None,
+        'members': [{
+            'name': 'a.txt',
+            'key': 'folder/a.txt',
+            'header_offset': 0,
+            'data_offset': 512,
+            'length': 1536,
+            'size': 1000,
+            'mtime': 10,
+        }],
+    }
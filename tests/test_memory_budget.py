@@ -0,0 +1,37 @@
+import time
+import threading
+from s3_tar.memory_budget import MemoryBudget
+
+
+def test_memory_budget_waits_for_space():
+    memory_budget = MemoryBudget(100)
+    memory_budget.reserve(60)
+    memory_budget.reserve(40)
+
+    reserved = []
+    t = threading.Thread(
+        target=lambda: reserved.append(memory_budget.reserve(30)),
+    )
+    t.start()
+    time.sleep(0.1)
+    assert reserved == []
+
+    memory_budget.release(60)
+    t.join(1)
+    assert reserved == [None]
+    assert memory_budget.used == 70
+
+
+def test_memory_budget_larger_then_limit():
+    memory_budget = MemoryBudget(100)
+    memory_budget.reserve(10)
+
+    t = threading.Thread(target=memory_budget.reserve, args=(500,))
+    t.start()
+    time.sleep(0.1)
+    assert memory_budget.used == 10
+
+    # Gets it once nothing else is reserved
+    memory_budget.release(10)
+    t.join(1)
+    assert memory_budget.used == 500
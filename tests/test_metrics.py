@@ -0,0 +1,90 @@
+import json
+from s3_tar.metrics import Histogram, Metrics, TimedCompressor
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+    assert histogram.to_dict() == {
+        'count': 4,
+        'sum': 2.65,
+        'buckets': {'0.1': 2, '1': 3, '+Inf': 4},  # Cumulative
+    }
+
+
+def test_metrics_snapshot():
+    metrics = Metrics()
+    metrics.add('bytes_in', 1024**2)
+    metrics.add('files_added')
+    metrics.add('files_added')
+    metrics.set('cache_files', 4)
+    metrics.set('cache_files', 2)
+    with metrics.time('get'):
+        pass
+
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {'bytes_in': 1024**2, 'files_added': 2}
+    assert snapshot['gauges'] == {'cache_files': 2, 'cache_files_max': 4}
+    assert snapshot['latency']['get']['count'] == 1
+    assert snapshot['latency']['upload_part']['count'] == 0
+    assert snapshot['throughput']['mb_per_sec_in'] > 0
+    assert json.loads(metrics.to_json())['counters']['files_added'] == 2
+
+
+def test_metrics_to_prometheus():
+    metrics = Metrics()
+    metrics.add('parts_uploaded', 3)
+    metrics.set('files_total', 10)
+    metrics.observe('upload_part', 0.2)
+
+    lines = metrics.to_prometheus().splitlines()
+    assert 's3_tar_parts_uploaded_total 3' in lines
+    assert 's3_tar_files_total 10' in lines
+    assert ('s3_tar_latency_seconds_bucket{stage="upload_part",le="0.1"} 0'
+            in lines)
+    assert ('s3_tar_latency_seconds_bucket{stage="upload_part",le="0.25"} 1'
+            in lines)
+    assert 's3_tar_latency_seconds_count{stage="upload_part"} 1' in lines
+
+
+def test_metrics_write(tmp_path):
+    metrics = Metrics()
+    metrics.add('files_added', 5)
+
+    metrics.write(str(tmp_path / 'metrics.prom'))
+    assert ('s3_tar_files_added_total 5'
+            in (tmp_path / 'metrics.prom').read_text())
+    metrics.write(str(tmp_path / 'metrics.json'))
+    assert json.loads((tmp_path / 'metrics.json').read_text())[
+        'counters'] == {'files_added': 5}
+    # Nothing is left behind from the writes
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_metrics_report():
+    reports = []
+    metrics = Metrics(progress_callback=reports.append, progress_interval=60)
+    metrics.set('files_total', 4)
+    metrics.add('files_added')
+    metrics.report()
+    metrics.report()  # Too soon after the last one
+    assert reports == [metrics]
+    assert metrics.progress_line().startswith('1/4 files (25.0%)')
+
+    metrics.report(force=True)
+    assert len(reports) == 2
+
+
+def test_timed_compressor():
+    class Compressor:
+        def compress(self, data):
+            return data.upper()
+
+        def flush(self):
+            return b'!'
+
+    metrics = Metrics()
+    compressor = TimedCompressor(Compressor(), metrics)
+    assert compressor.compress(b'abc') + compressor.flush() == b'ABC!'
+    assert metrics.snapshot()['latency']['compress']['count'] == 2
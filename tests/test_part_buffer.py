@@ -0,0 +1,39 @@
+import io
+import pytest
+from s3_tar.part_buffer import PartBuffer
+
+
+def test_part_buffer_read_across_chunks():
+    part_io = PartBuffer()
+    part_io.write(b'abc')
+    part_io.write(bytearray(b'de'))
+    part_io.write(b'')
+    part_io.write(memoryview(b'fghi'))
+    assert part_io.tell() == 9
+
+    part_io.seek(0)
+    assert part_io.read(2) == b'ab'
+    assert part_io.read(4) == b'cdef'
+    assert part_io.read() == b'ghi'
+    assert part_io.read() == b''
+
+    part_io.seek(-4, io.SEEK_END)
+    assert part_io.tell() == 5
+    assert part_io.read(100) == b'fghi'
+    assert part_io.getvalue() == b'abcdefghi'
+
+
+def test_part_buffer_does_not_copy_chunks():
+    chunk = b'x' * 1024
+    part_io = PartBuffer()
+    part_io.write(chunk)
+    part_io.seek(0)
+    assert part_io.read() is chunk
+
+
+def test_part_buffer_closed():
+    part_io = PartBuffer()
+    part_io.write(b'abc')
+    part_io.close()
+    with pytest.raises(ValueError):
+        part_io.read()
@@ -0,0 +1,77 @@
+import io
+import random
+import tarfile
+from s3_tar.planner import member_size, plan_archives
+
+
+###
+# member_size
+###
+def test_member_size_matches_tarfile():
+    for name, size, mtime in (('a.txt', 0, 0), ('a.txt', 513, 1600000000),
+                              ('b' * 150, 10, 0), ('ünïcode.txt', 1024, 0),
+                              ('a.txt', 10, 1600000000.0)):
+        tar_io = io.BytesIO()
+        tar = tarfile.open(fileobj=tar_io, mode='w')
+        info = tarfile.TarInfo(name=name)
+        info.size = size
+        info.mtime = mtime
+        tar.addfile(tarinfo=info, fileobj=io.BytesIO(b'x' * size))
+        # Leave off the end of archive blocks tarfile adds on close
+        assert member_size(name, size, mtime) == tar_io.tell()
+
+
+###
+# plan_archives
+###
+def test_plan_archives_even_split():
+    sizes = [10] * 10
+    ranges = plan_archives(sizes, 35)
+    assert len(ranges) == 4
+    assert ranges[0][0] == 0 and ranges[-1][1] == 10
+    for start, end in ranges:
+        assert sum(sizes[start:end]) <= 35
+    # No tiny last archive
+    assert sum(sizes[ranges[-1][0]:]) >= 20
+
+
+def test_plan_archives_large_file():
+    assert plan_archives([5, 100, 5], 20) == [(0, 1), (1, 2), (2, 3)]
+
+
+def test_plan_archives_merge_small_last():
+    assert plan_archives([10, 10, 1], 25, min_size=5) == [(0, 3)]
+    assert plan_archives([20, 3], 20, min_size=5) == [(0, 1), (1, 2)]
+
+
+def test_plan_archives_fewest_archives():
+    rand = random.Random(0)
+    for _ in range(500):
+        sizes = [rand.randint(1, 50) for _ in range(rand.randint(1, 40))]
+        max_size = rand.randint(20, 200)
+
+        # Filling each archive up to the max size before the next
+        greedy = 1
+        archive_size = 0
+        for i, size in enumerate(sizes):
+            if i > 0 and archive_size + size > max_size:
+                greedy += 1
+                archive_size = 0
+            archive_size += size
+
+        ranges = plan_archives(sizes, max_size)
+        assert len(ranges) == greedy
+        assert ranges[0][0] == 0 and ranges[-1][1] == len(sizes)
+        for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+            assert end == next_start
+        for start, end in ranges:
+            assert end - start == 1 or sum(sizes[start:end]) <= max_size
+
+
+def test_plan_archives_uneven_files():
+    # Cutting near even shares of 15 would take 4 archives
+    assert plan_archives([10, 10, 15, 10], 20) == [(0, 2), (2, 3), (3, 4)]
+
+
+def test_plan_archives_empty():
+    assert plan_archives([], 10) == []
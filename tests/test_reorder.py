@@ -0,0 +1,46 @@
+import time
+import random
+import threading
+from s3_tar.reorder import ReorderBuffer
+
+
+def test_reorder_buffer_in_order():
+    released = []
+    reorder_buffer = ReorderBuffer(released.append, 2)
+    reorder_buffer.add(1, ['b1', 'b2'])
+    assert released == []
+    reorder_buffer.skip(2)
+    reorder_buffer.add(0, ['a'])
+    assert released == ['a', 'b1', 'b2']
+    reorder_buffer.add(3, ['d'])
+    assert released == ['a', 'b1', 'b2', 'd']
+
+
+def test_reorder_buffer_window():
+    released = []
+    reorder_buffer = ReorderBuffer(released.append, 2)
+
+    def _add(index):
+        reorder_buffer.wait_turn(index)
+        time.sleep(random.random() / 100)
+        reorder_buffer.add(index, [index])
+
+    threads = [threading.Thread(target=_add, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert released == list(range(20))
+
+
+def test_reorder_buffer_wait_turn_blocks():
+    reorder_buffer = ReorderBuffer(lambda value: None, 2)
+    waiting = threading.Thread(target=reorder_buffer.wait_turn, args=(2,))
+    waiting.start()
+    waiting.join(0.1)
+    assert waiting.is_alive() is True
+
+    reorder_buffer.add(0, [])
+    waiting.join(1)
+    assert waiting.is_alive() is False
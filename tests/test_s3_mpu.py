@@ -1,9 +1,11 @@
 import io
+import time
 import boto3
 import pytest
 from moto import mock_s3
 import botocore.exceptions
 from s3_tar.s3_mpu import S3MPU
+from s3_tar.utils import MIN_S3_SIZE
 
 
 @mock_s3()
@@ -56,3 +58,151 @@ def test_s3_multipart_upload_fail_complete():
         # Will cause the s3 upload to cause `EntityTooSmall`
         # since the first part is <5MB
         mpu.complete()
+
+
+class _SlowFirstPartS3:
+    """Delay the first part so the parts finish uploading out of order"""
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def __getattr__(self, name):
+        return getattr(self.s3, name)
+
+    def upload_part(self, **kwargs):
+        if kwargs['PartNumber'] == 1:
+            time.sleep(0.5)
+        return self.s3.upload_part(**kwargs)
+
+
+@mock_s3()
+def test_s3_multipart_upload_in_flight_out_of_order():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-archive')
+
+    mpu = S3MPU(_SlowFirstPartS3(s3), 'my-archive', 'archive.txt',
+                max_in_flight=2)
+    parts = [b'a' * MIN_S3_SIZE, b'b' * MIN_S3_SIZE, b'c']
+    for part in parts:
+        assert mpu.upload_part(io.BytesIO(part)) is True
+
+    assert mpu.complete() is True
+    assert [p['PartNumber'] for p in mpu.parts_mapping] == [1, 2, 3]
+
+    resp = s3.get_object(Bucket='my-archive', Key='archive.txt')
+    assert resp['Body'].read() == b''.join(parts)
+
+
+class _FailingPartS3(_SlowFirstPartS3):
+
+    def upload_part(self, **kwargs):
+        raise ConnectionError("Upload failed")
+
+
+@mock_s3()
+def test_s3_multipart_upload_in_flight_fail_complete():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-archive')
+
+    mpu = S3MPU(_FailingPartS3(s3), 'my-archive', 'archive.txt',
+                max_in_flight=2)
+    # The upload error is raised once the upload is completed
+    assert mpu.upload_part(io.BytesIO(b'hello World!')) is True
+    with pytest.raises(ConnectionError):
+        mpu.complete()
+
+
+@mock_s3()
+def test_s3_multipart_upload_resume():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-archive')
+
+    saved = []
+    mpu = S3MPU(s3, 'my-archive', 'archive.txt',
+                on_part_saved=lambda *part: saved.append(part))
+    mpu.upload_part(io.BytesIO(b'a' * MIN_S3_SIZE))
+    mpu.upload_part(io.BytesIO(b'b' * MIN_S3_SIZE))
+    assert [part_num for part_num, etag in saved] == [1, 2]
+
+    # Continue it after the first part, as if it was a new run
+    resumed_mpu = S3MPU(s3, 'my-archive', 'archive.txt',
+                        upload_id=mpu.upload_id)
+    parts = resumed_mpu.list_parts()
+    assert sorted(parts) == [1, 2]
+    assert parts[1]['ETag'] == saved[0][1]
+    assert parts[1]['Size'] == MIN_S3_SIZE
+
+    resumed_mpu.keep_parts([{'ETag': saved[0][1], 'PartNumber': 1}])
+    assert resumed_mpu.next_part_number == 2
+    resumed_mpu.upload_part(io.BytesIO(b'c'))
+    assert resumed_mpu.complete() is True
+
+    resp = s3.get_object(Bucket='my-archive', Key='archive.txt')
+    assert resp['Body'].read() == b'a' * MIN_S3_SIZE + b'c'
+
+
+class _WrongETagClient:
+    """Pass calls to the s3 client, but give each part the wrong ETag"""
+
+    def __init__(self, s3, encryption=None):
+        self.s3 = s3
+        # Headers added to each part's response
+        self.encryption = encryption or {}
+
+    def __getattr__(self, name):
+        return getattr(self.s3, name)
+
+    def upload_part(self, **kwargs):
+        resp = self.s3.upload_part(**kwargs)
+        resp['ETag'] = '"{}"'.format('0' * 32)
+        resp.update(self.encryption)
+        return resp
+
+
+@mock_s3()
+def test_s3_multipart_upload_verify():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-archive')
+
+    mpu = S3MPU(s3, 'my-archive', 'archive.txt', verify=True)
+    assert mpu.upload_part(io.BytesIO(b'a' * MIN_S3_SIZE)) is True
+    assert mpu.upload_part(io.BytesIO(b'hello World!')) is True
+    assert mpu.complete() is True
+    assert mpu.etag == s3.head_object(Bucket='my-archive',
+                                      Key='archive.txt')['ETag']
+
+
+@mock_s3()
+def test_s3_multipart_upload_verify_fail():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-archive')
+
+    mpu = S3MPU(_WrongETagClient(s3), 'my-archive', 'archive.txt',
+                verify=True)
+    with pytest.raises(ValueError):
+        mpu.upload_part(io.BytesIO(b'hello World!'))
+
+
+@mock_s3()
+@pytest.mark.parametrize('encryption', [
+    {'ServerSideEncryption': 'aws:kms'},
+    {'ServerSideEncryption': 'aws:kms:dsse'},
+    {'SSECustomerAlgorithm': 'AES256'},
+])
+def test_s3_multipart_upload_verify_encrypted(encryption):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-archive')
+
+    # The ETag of the part is not its md5, so it can not be checked
+    mpu = S3MPU(_WrongETagClient(s3, encryption=encryption), 'my-archive',
+                'archive.txt', verify=True)
+    assert mpu.upload_part(io.BytesIO(b'hello World!')) is True
@@ -1,9 +1,19 @@
 import io
+import gzip
+import json
+import zlib
+import hashlib
 import time
 import boto3
+import tarfile
 import pytest
 from s3_tar import S3Tar
 from moto import mock_s3
+from s3_tar.utils import MIN_S3_SIZE
+from s3_tar.member_index import load_index
+
+# Python 3.8+ adds a pax header for the float mtime of each file
+PAX_MTIME = tarfile.DEFAULT_FORMAT == tarfile.PAX_FORMAT
 
 
 ###
@@ -109,6 +119,33 @@ def test_add_files_dedup_fail():
         tar.add_files('different_folder')
 
 
+@mock_s3
+def test_add_files_dedup_fail_same_page():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+    s3.put_object(
+        Bucket='my-bucket',
+        Key='some_folder/a/thing1.txt',
+        Body=b'Test File Contents',
+    )
+    s3.put_object(
+        Bucket='my-bucket',
+        Key='some_folder/b/thing1.txt',
+        Body=b'Test File Contents',
+    )
+
+    tar = S3Tar('my-bucket', 'my-data.tar',
+                allow_dups=False, session=session)
+    with pytest.raises(ValueError):
+        tar.add_files('some_folder')
+
+    # Nothing from the failed page was added
+    assert tar.all_keys == set()
+    assert tar.member_names == {}
+
+
 @mock_s3
 def test_add_files_folders():
     session = boto3.session.Session()
@@ -233,7 +270,7 @@ def test_add_key_to_cache_with_metadata():
                 save_metadata=True, session=session)
     tar._add_key_to_cache('thing1.txt', 'thing1.txt')
 
-    assert len(tar.file_cache) == 2
+    assert tar.file_cache.qsize() == 2
 
 
 @mock_s3
@@ -252,7 +289,7 @@ def test_add_key_to_cache_no_metadata():
                 save_metadata=False, session=session)
     tar._add_key_to_cache('thing1.txt', 'thing1.txt')
 
-    assert len(tar.file_cache) == 1
+    assert tar.file_cache.qsize() == 1
 
 
 ###
@@ -348,7 +385,27 @@ def test_bytes_to_tar_output_tar_compression():
     )
     output_size = output.tell()
     # Ci and local machine compression differs by a few bytes
-    assert output_size >= 98 and output_size <= 102
+    assert output_size >= 95 and output_size <= 99
+
+    output.seek(0)
+    tar_obj = tarfile.open(fileobj=output, mode='r:gz')
+    assert tar_obj.extractfile('test.tar.gz').read() == b'Beep boop'
+
+
+def test_bytes_to_tar_output_tar_compression_level():
+    tar = S3Tar('my-bucket', 'my-data.tar')
+    source_io = io.BytesIO()
+    source_io.write(b'Beep boop' * 1000)
+    fast_output = tar._save_bytes_to_tar(
+        'test.txt', source_io, 1593457982, 'w|bz2', compression_level=1
+    )
+    best_output = tar._save_bytes_to_tar(
+        'test.txt', source_io, 1593457982, 'w|bz2', compression_level=9
+    )
+    assert fast_output.getvalue() != best_output.getvalue()
+    fast_output.seek(0)
+    tar_obj = tarfile.open(fileobj=fast_output, mode='r:bz2')
+    assert tar_obj.extractfile('test.txt').read() == b'Beep boop' * 1000
 
 
 def test_bytes_to_tar_save_timestamp_tar():
@@ -384,23 +441,1392 @@ def test_add_file_number_with_min_tar_compressed():
     assert tar._add_file_number(2) == 'my-data-2.tar.gz'
 
 
+def test_add_file_number_with_min_tar_zst():
+    tar = S3Tar('my-bucket', 'my-data.tar.zst', min_file_size='10MB')
+    assert tar._add_file_number(2) == 'my-data-2.tar.zst'
+
+
 ###
 # _is_complete
 ###
 def test_is_complete_empty():
     tar = S3Tar('my-bucket', 'my-data.tar')
-    tar.all_keys = set()
-    tar.file_cache = []
+    tar._pre_fetch_files()
     assert tar._is_complete() is True
 
 
-def test_is_complete_has_keys():
+def test_is_complete_has_cache():
     tar = S3Tar('my-bucket', 'my-data.tar')
-    tar.all_keys = ['key1', 'key2']
+    tar.file_cache.put(io.BytesIO(b'obj1'))
     assert tar._is_complete() is False
 
 
-def test_is_complete_has_cache():
+def test_is_complete_waits_for_cache():
+    import threading
     tar = S3Tar('my-bucket', 'my-data.tar')
-    tar.file_cache = ['obj1']
+
+    def _add_later():
+        time.sleep(0.2)
+        tar.file_cache.put(io.BytesIO(b'obj1'))
+
+    threading.Thread(target=_add_later).start()
+    assert tar._is_complete() is False
+    assert tar._state.current_source.read() == b'obj1'
+
+
+###
+# _get_file_from_cache
+###
+def test_get_file_from_cache_end():
+    tar = S3Tar('my-bucket', 'my-data.tar')
+    tar.file_cache.put(io.BytesIO(b'obj1'))
+    tar._pre_fetch_files()
+
+    assert tar._get_file_from_cache().read() == b'obj1'
+    assert tar._get_file_from_cache() is None
+    # Stays at the end once reached
+    assert tar._get_file_from_cache() is None
+
+
+###
+# _get_tar_source_stream
+###
+@mock_s3
+def test_get_tar_source_data_streams_large_files():
+    import tarfile
+    from s3_tar.tar_member import TarMemberStream
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+    source = b'0123456789' * (MIN_S3_SIZE // 10 + 1)
+    s3.put_object(
+        Bucket='my-bucket',
+        Key='thing1.txt',
+        Body=source,
+    )
+    tar = S3Tar('my-bucket', 'my-data.tar',
+                part_size_multiplier=1, session=session)
+    source_stream = tar._get_tar_source_data('mydata/thing1.txt', 'thing1.txt')
+    assert isinstance(source_stream, TarMemberStream)
+
+    tar_obj = tarfile.open(fileobj=io.BytesIO(source_stream.read()), mode='r')
+    assert tar_obj.extractfile('mydata/thing1.txt').read() == source
+
+
+@mock_s3
+@pytest.mark.parametrize('failures', [2, 3])
+def test_download_source_range_retry(failures):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    source = b'0123456789' * (MIN_S3_SIZE // 5)
+    s3.put_object(Bucket='my-bucket', Key='thing1.txt', Body=source)
+
+    tar = S3Tar('my-bucket', 'my-data.tar', part_size_multiplier=1,
+                session=session)
+    tar.add_file('thing1.txt')
+    get_object = tar.s3.get_object
+    calls = []
+
+    def _fail_later_range(**kwargs):
+        # Fails once the first part has been uploaded
+        if not kwargs.get('Range', 'bytes=0-').startswith('bytes=0-'):
+            calls.append(kwargs['Range'])
+            if len(calls) <= failures:
+                raise ValueError("Connection reset")
+        return get_object(**kwargs)
+
+    tar.s3.get_object = _fail_later_range
+    if failures == 3:
+        # Still fails on the last try, so the upload is aborted
+        with pytest.raises(ValueError):
+            tar.tar()
+        assert 'Uploads' not in s3.list_multipart_uploads(Bucket='my-bucket')
+        assert 'Contents' not in s3.list_objects_v2(Bucket='my-bucket',
+                                                    Prefix='my-data')
+        return
+
+    tar.tar()
+    assert calls[0] == calls[failures]
+    resp = s3.get_object(Bucket='my-bucket', Key='my-data.tar')
+    tar_obj = tarfile.open(fileobj=io.BytesIO(resp['Body'].read()))
+    assert tar_obj.extractfile('thing1.txt').read() == source
+
+
+###
+# _get_part_contents
+###
+def test_get_part_contents_splits_large_files():
+    tar = S3Tar('my-bucket', 'my-data.tar', part_size_multiplier=1)
+    tar.file_cache.put(io.BytesIO(b'a' * (MIN_S3_SIZE + 10)))
+    tar.file_cache.put(io.BytesIO(b'b'))
+    tar._pre_fetch_files()
+
+    part_io = tar._get_part_contents()
+    assert part_io.tell() == MIN_S3_SIZE
+    assert tar._is_complete() is False
+
+    part_io = tar._get_part_contents()
+    assert part_io.getvalue() == b'a' * 10 + b'b'
+    assert tar._is_complete() is True
+
+
+###
+# _new_file_upload
+###
+@mock_s3
+def test_new_file_upload_does_not_split_files():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+
+    tar = S3Tar('my-bucket', 'my-data.tar', min_file_size='1MB',
+                part_size_multiplier=1, session=session)
+    tar.file_cache.put(io.BytesIO(b'a' * (MIN_S3_SIZE + 10)))
+    tar.file_cache.put(io.BytesIO(b'b'))
+    tar._pre_fetch_files()
+
+    # Min size is met after the first part, but the rest of the
+    # file still needs to be added. The next file starts a new tar file
+    tar._new_file_upload(1)
+    resp = s3.get_object(Bucket='my-bucket', Key='my-data-1.tar')
+    assert resp['Body'].read() == b'a' * (MIN_S3_SIZE + 10)
     assert tar._is_complete() is False
+
+    tar._new_file_upload(2)
+    resp = s3.get_object(Bucket='my-bucket', Key='my-data-2.tar')
+    assert resp['Body'].read() == b'b'
+    assert tar._is_complete() is True
+
+
+@mock_s3
+def test_min_file_size_many_small_files():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    for i in range(50):
+        s3.put_object(
+            Bucket='my-bucket',
+            Key='some_folder/thing{:02d}.txt'.format(i),
+            Body='{:02d}'.format(i).encode() * 150 * 1024,
+        )
+
+    # Parts are 5MB, so each tar file spans two of them
+    tar = S3Tar('my-bucket', 'my-data.tar', min_file_size='6MB',
+                part_size_multiplier=1, deterministic=True, session=session)
+    tar.add_files('some_folder')
+    tar.tar()
+
+    # Each tar file is done at the first file boundary past 6MB,
+    # 21 files of 300KB
+    names = []
+    for file_number, num_files in enumerate([21, 21, 8], 1):
+        resp = s3.get_object(Bucket='my-bucket',
+                             Key='my-data-{}.tar'.format(file_number))
+        body = resp['Body'].read()
+        if file_number < 3:
+            assert len(body) >= 6 * 1024**2
+        tar_obj = tarfile.open(fileobj=io.BytesIO(body))
+        members = tar_obj.getmembers()
+        assert len(members) == num_files
+        for member in members:
+            i = int(member.name[5:7])
+            assert (tar_obj.extractfile(member).read()
+                    == '{:02d}'.format(i).encode() * 150 * 1024)
+        names.extend(member.name for member in members)
+    assert names == ['thing{:02d}.txt'.format(i) for i in range(50)]
+    assert 'my-data-4.tar' not in [
+        obj['Key']
+        for obj in s3.list_objects_v2(Bucket='my-bucket')['Contents']
+    ]
+
+
+###
+# server_side_copy
+###
+def test_server_side_copy_compressed_fail():
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar.gz', server_side_copy=True)
+
+
+@mock_s3
+def test_server_side_copy_large_files(monkeypatch):
+    import tarfile
+    from s3_tar.s3_mpu import S3MPU
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+    files = {
+        'small1.txt': b'Test File Contents',
+        'big.bin': b'0123456789' * (MIN_S3_SIZE // 4),
+        'small2.txt': b'More Test File Contents',
+    }
+    for name, body in files.items():
+        s3.put_object(Bucket='my-bucket', Key='data/' + name, Body=body)
+
+    copies = []
+    upload_part_copy = S3MPU.upload_part_copy
+
+    def _upload_part_copy(self, *args):
+        copies.append(args)
+        return upload_part_copy(self, *args)
+
+    monkeypatch.setattr(S3MPU, 'upload_part_copy', _upload_part_copy)
+
+    tar = S3Tar('my-bucket', 'my-data.tar', server_side_copy=True,
+                part_size_multiplier=1, session=session)
+    tar.add_files('data/')
+    tar.tar()
+
+    # Only what was needed to fill the part before it was downloaded
+    assert len(copies) == 1
+    bucket, key, start, end = copies[0]
+    assert key == 'data/big.bin'
+    assert start > 0 and end == len(files['big.bin'])
+
+    resp = s3.get_object(Bucket='my-bucket', Key='my-data.tar')
+    tar_obj = tarfile.open(fileobj=io.BytesIO(resp['Body'].read()))
+    for name, body in files.items():
+        assert tar_obj.extractfile(name).read() == body
+
+
+###
+# source_info
+###
+@mock_s3
+def test_add_files_saves_source_info():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+    s3.put_object(
+        Bucket='my-bucket',
+        Key='some_folder/thing1.txt',
+        Body=b'Test File Contents',
+    )
+    tar = S3Tar('my-bucket', 'my-data.tar', session=session)
+    tar.add_files('some_folder')
+
+    source_info = tar.source_info['some_folder/thing1.txt']
+    assert source_info.size == 18
+    assert source_info.mtime != 0
+    assert source_info.metadata is None
+
+
+@mock_s3
+def test_add_key_to_cache_single_request():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+    s3.put_object(
+        Bucket='my-bucket',
+        Key='some_folder/thing1.txt',
+        Body=b'Test File Contents',
+        Metadata={'foo': 'bar'},
+    )
+    tar = S3Tar('my-bucket', 'my-data.tar',
+                save_metadata=True, session=session)
+    tar.add_files('some_folder')
+
+    calls = []
+    tar.s3.meta.events.register(
+        'before-call.s3.*',
+        lambda model, **kwargs: calls.append(model.name),
+    )
+    tar._add_key_to_cache('thing1.txt', 'some_folder/thing1.txt')
+
+    # The size & mtime are known from the listing,
+    # and the metadata is in the response of getting the file
+    assert calls == ['GetObject']
+    assert tar.file_cache.qsize() == 2
+
+
+###
+# single_compression_stream
+###
+def test_single_compression_stream_uncompressed_fail():
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar', single_compression_stream=True)
+
+
+def test_compression_level_fail():
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar', compression_level=5)
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar.gz', compression_level=10)
+
+
+@mock_s3
+def test_single_compression_stream():
+    import zlib
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+    for i in range(10):
+        s3.put_object(
+            Bucket='my-bucket',
+            Key='some_folder/thing{}.txt'.format(i),
+            Body=b'Test File Contents',
+        )
+
+    tar = S3Tar('my-bucket', 'my-data.tar.gz', single_compression_stream=True,
+                compression_level=6, session=session)
+    tar.add_files('some_folder')
+    tar.tar()
+
+    resp = s3.get_object(Bucket='my-bucket', Key='my-data.tar.gz')
+    output = resp['Body'].read()
+
+    # One gzip stream for the whole file, not one per file
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    tar_data = decompressor.decompress(output)
+    assert decompressor.eof is True
+    assert decompressor.unused_data == b''
+
+    tar_obj = tarfile.open(fileobj=io.BytesIO(tar_data))
+    assert len(tar_obj.getmembers()) == 10
+    assert tar_obj.extractfile('thing3.txt').read() == b'Test File Contents'
+
+
+###
+# compression_workers
+###
+@mock_s3
+def test_compression_workers_large_file():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+    source = b'0123456789' * (MIN_S3_SIZE // 10 + 1)
+    s3.put_object(Bucket='my-bucket', Key='data/big.bin', Body=source)
+    s3.put_object(Bucket='my-bucket', Key='data/small.txt', Body=b'Test')
+
+    tar = S3Tar('my-bucket', 'my-data.tar.gz', compression_workers=4,
+                part_size_multiplier=1, session=session)
+    tar.add_files('data/')
+    tar.tar()
+
+    resp = s3.get_object(Bucket='my-bucket', Key='my-data.tar.gz')
+    tar_obj = tarfile.open(fileobj=io.BytesIO(resp['Body'].read()))
+    assert tar_obj.extractfile('big.bin').read() == source
+    assert tar_obj.extractfile('small.txt').read() == b'Test'
+
+
+@mock_s3
+def test_compression_workers_large_file_bz2():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+    source = b'0123456789' * (MIN_S3_SIZE // 10 + 1)
+    s3.put_object(Bucket='my-bucket', Key='data/big.bin', Body=source)
+    s3.put_object(Bucket='my-bucket', Key='data/small.txt', Body=b'Test')
+
+    tar = S3Tar('my-bucket', 'my-data.tar.bz2', compression_workers=4,
+                part_size_multiplier=1, session=session)
+    tar.add_files('data/')
+    tar.tar()
+
+    resp = s3.get_object(Bucket='my-bucket', Key='my-data.tar.bz2')
+    tar_obj = tarfile.open(fileobj=io.BytesIO(resp['Body'].read()))
+    assert tar_obj.extractfile('big.bin').read() == source
+    assert tar_obj.extractfile('small.txt').read() == b'Test'
+
+
+###
+# xz, zstd & lz4
+###
+def _decompress(compression_type, data):
+    """Decompress all of the streams/frames in the data"""
+    import lzma
+    import zstandard
+    import lz4.frame
+    if compression_type == 'xz':
+        return lzma.decompress(data)
+    if compression_type == 'zst':
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            io.BytesIO(data), read_across_frames=True,
+        )
+        return reader.read()
+
+    output = b''
+    while data:
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        output += decompressor.decompress(data)
+        data = decompressor.unused_data
+    return output
+
+
+@mock_s3
+def test_xz_zst_lz4_output():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+    for i in range(3):
+        s3.put_object(
+            Bucket='my-bucket',
+            Key='some_folder/thing{}.txt'.format(i),
+            Body=b'Test File Contents',
+        )
+
+    for compression_type in ('xz', 'zst', 'lz4'):
+        target_key = 'my-data.tar.' + compression_type
+        tar = S3Tar('my-bucket', target_key, session=session)
+        assert tar.compression_type == compression_type
+        tar.add_files('some_folder')
+        tar.tar()
+
+        resp = s3.get_object(Bucket='my-bucket', Key=target_key)
+        tar_data = _decompress(compression_type, resp['Body'].read())
+        tar_obj = tarfile.open(fileobj=io.BytesIO(tar_data))
+        assert len(tar_obj.getmembers()) == 3
+        assert tar_obj.extractfile('thing1.txt').read() == b'Test File Contents'
+
+
+@mock_s3
+def test_zst_single_stream_threads_ldm():
+    import zstandard
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+    for i in range(10):
+        s3.put_object(
+            Bucket='my-bucket',
+            Key='some_folder/thing{}.txt'.format(i),
+            Body=b'Test File Contents',
+        )
+
+    tar = S3Tar('my-bucket', 'my-data.tar.zst', single_compression_stream=True,
+                compression_level=19, compression_workers=2,
+                long_distance_matching=True, session=session)
+    tar.add_files('some_folder')
+    tar.tar()
+
+    resp = s3.get_object(Bucket='my-bucket', Key='my-data.tar.zst')
+    output = resp['Body'].read()
+
+    # One zstd frame for the whole file
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    tar_data = decompressor.decompress(output)
+    assert decompressor.eof is True
+    assert decompressor.unused_data == b''
+
+    tar_obj = tarfile.open(fileobj=io.BytesIO(tar_data))
+    assert len(tar_obj.getmembers()) == 10
+
+
+def test_zst_lz4_compression_level():
+    assert S3Tar('my-bucket', 'my-data.tar.zst',
+                 compression_level=22).compression_level == 22
+    assert S3Tar('my-bucket', 'my-data.tar.lz4',
+                 compression_level=16).compression_level == 16
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar.zst', compression_level=23)
+
+
+def test_long_distance_matching_fail():
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar.gz', long_distance_matching=True)
+
+
+def test_missing_compression_package(monkeypatch):
+    from s3_tar import compression
+    monkeypatch.setattr(compression, 'zstandard', None)
+    with pytest.raises(ImportError):
+        S3Tar('my-bucket', 'my-data.tar.zst')
+
+
+###
+# journal_path
+###
+def _put_journal_files(s3):
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+    sources = {}
+    for i in range(6):
+        key = 'some_folder/thing{}.bin'.format(i)
+        sources['thing{}.bin'.format(i)] = bytes([i]) * (2 * 1024**2)
+        s3.put_object(Bucket='my-bucket', Key=key,
+                      Body=sources['thing{}.bin'.format(i)])
+    return sources
+
+
+@mock_s3
+def test_journal_resume(tmp_path, monkeypatch):
+    from s3_tar.s3_mpu import S3MPU
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    sources = _put_journal_files(s3)
+    journal_path = str(tmp_path / 'job.journal')
+
+    # Crash before the 3rd part is uploaded
+    upload_part = S3MPU.upload_part
+
+    def crashing_upload_part(self, source_io):
+        if self.next_part_number == 3:
+            raise RuntimeError("Crash")
+        return upload_part(self, source_io)
+
+    monkeypatch.setattr(S3MPU, 'upload_part', crashing_upload_part)
+    tar = S3Tar('my-bucket', 'my-data.tar', part_size_multiplier=1,
+                upload_concurrency=1, journal_path=journal_path,
+                member_index=True, session=session)
+    tar.add_files('some_folder')
+    with pytest.raises(RuntimeError):
+        tar.tar()
+    time.sleep(1)  # Let the part that is still uploading finish
+    monkeypatch.setattr(S3MPU, 'upload_part', upload_part)
+
+    tar = S3Tar('my-bucket', 'my-data.tar', part_size_multiplier=1,
+                journal_path=journal_path, member_index=True,
+                session=session)
+    tar.add_files('some_folder')
+    downloads = []
+    tar.s3.meta.events.register(
+        'before-call.s3.GetObject',
+        lambda params, **kwargs: downloads.append(params['url_path']),
+    )
+    tar.tar()
+
+    # Only the files in the part that was never uploaded are downloaded
+    assert 0 < len(downloads) < 6
+
+    resp = s3.get_object(Bucket='my-bucket', Key='my-data.tar')
+    tar_obj = tarfile.open(fileobj=io.BytesIO(resp['Body'].read()))
+    assert sorted(tar_obj.getnames()) == sorted(sources)
+    for name, source in sources.items():
+        assert tar_obj.extractfile(name).read() == source
+    # Files in the parts from before the crash are in the index as well
+    _check_member_index(s3, 'my-data.tar', sources)
+
+
+@mock_s3
+def test_journal_finished_job(tmp_path):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    _put_journal_files(s3)
+    journal_path = str(tmp_path / 'job.journal')
+
+    tar = S3Tar('my-bucket', 'my-data.tar', part_size_multiplier=1,
+                journal_path=journal_path, session=session)
+    tar.add_files('some_folder')
+    tar.tar()
+
+    tar = S3Tar('my-bucket', 'my-data.tar', part_size_multiplier=1,
+                journal_path=journal_path, session=session)
+    tar.add_files('some_folder')
+    calls = []
+    tar.s3.meta.events.register(
+        'before-call.s3.*',
+        lambda model, **kwargs: calls.append(model.name),
+    )
+    tar.tar()
+    assert calls == []
+
+
+@mock_s3
+def test_journal_different_keys(tmp_path):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    _put_journal_files(s3)
+    journal_path = str(tmp_path / 'job.journal')
+
+    tar = S3Tar('my-bucket', 'my-data.tar', journal_path=journal_path,
+                session=session)
+    tar.add_file('some_folder/thing1.bin')
+    tar.tar()
+
+    tar = S3Tar('my-bucket', 'my-data.tar', journal_path=journal_path,
+                session=session)
+    tar.add_file('some_folder/thing2.bin')
+    with pytest.raises(ValueError):
+        tar.tar()
+
+
+###
+# deterministic
+###
+@mock_s3
+def test_deterministic(monkeypatch):
+    import random
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+    for i in range(20):
+        s3.put_object(
+            Bucket='my-bucket',
+            Key='some_folder/thing{:02d}.txt'.format(i),
+            Body=b'Test File Contents',
+            Metadata={'number': str(i)},
+        )
+
+    # Make the files finish downloading in a random order
+    download_source_file = S3Tar._download_source_file
+
+    def slow_download_source_file(self, key):
+        time.sleep(random.random() / 50)
+        return download_source_file(self, key)
+
+    monkeypatch.setattr(S3Tar, '_download_source_file',
+                        slow_download_source_file)
+
+    outputs = []
+    for target_key in ('my-data-a.tar.gz', 'my-data-b.tar.gz'):
+        tar = S3Tar('my-bucket', target_key, deterministic=True,
+                    save_metadata=True, cache_size=4, session=session)
+        tar.add_files('some_folder')
+        tar.tar()
+        resp = s3.get_object(Bucket='my-bucket', Key=target_key)
+        outputs.append(resp['Body'].read())
+
+    assert outputs[0] == outputs[1]
+    tar_obj = tarfile.open(fileobj=io.BytesIO(outputs[0]))
+    expected_names = []
+    for i in range(20):
+        expected_names.append('thing{:02d}.txt.metadata.json'.format(i))
+        expected_names.append('thing{:02d}.txt'.format(i))
+    assert tar_obj.getnames() == expected_names
+
+
+###
+# max_file_size & plan
+###
+@mock_s3
+def test_plan():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    # Need to create the bucket since this is in Moto's 'virtual' AWS account
+    s3.create_bucket(Bucket='my-bucket')
+    for i in range(10):
+        s3.put_object(
+            Bucket='my-bucket',
+            Key='some_folder/thing{}.txt'.format(i),
+            Body=b'x' * 1000,
+        )
+
+    tar = S3Tar('my-bucket', 'my-data.tar', max_file_size='8KB',
+                session=session)
+    tar.add_files('some_folder')
+    tar.add_file('some_folder/thing1.txt', folder='again')
+    plan = tar.plan()
+
+    # 11 files of 1.5KB each in the tar, or 2.5KB with the pax header of
+    # their mtime
+    if PAX_MTIME is True:
+        assert [len(archive['keys']) for archive in plan] == [3, 2, 3, 3]
+    else:
+        assert [len(archive['keys']) for archive in plan] == [4, 3, 4]
+    assert [archive['target_key'] for archive in plan] == [
+        'my-data-{}.tar'.format(i) for i in range(1, len(plan) + 1)
+    ]
+    assert all(archive['size'] <= 8 * 1024 for archive in plan)
+    assert plan[0]['keys'][0] == ('thing0.txt', 'some_folder/thing0.txt')
+
+    tar.tar()
+    for archive in plan:
+        resp = s3.get_object(Bucket='my-bucket', Key=archive['target_key'])
+        body = resp['Body'].read()
+        tar_obj = tarfile.open(fileobj=io.BytesIO(body))
+        assert tar_obj.getnames() == [name for name, key in archive['keys']]
+        assert len(body) == archive['size']
+
+
+def test_plan_fail():
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar').plan()
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar', min_file_size='2MB',
+              max_file_size='1MB')
+
+
+@mock_s3
+def test_archive_concurrency_plan():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    for i in range(10):
+        s3.put_object(
+            Bucket='my-bucket',
+            Key='some_folder/thing{}.txt'.format(i),
+            Body='thing{}'.format(i).encode() * 100,
+        )
+
+    tar = S3Tar('my-bucket', 'my-data.tar', max_file_size='8KB',
+                archive_concurrency=3, session=session)
+    tar.add_files('some_folder')
+    plan = tar.plan()
+    tar.tar()
+
+    assert len(plan) == (4 if PAX_MTIME is True else 2)
+    for archive in plan:
+        resp = s3.get_object(Bucket='my-bucket', Key=archive['target_key'])
+        tar_obj = tarfile.open(fileobj=io.BytesIO(resp['Body'].read()))
+        assert tar_obj.getnames() == [name for name, key in archive['keys']]
+        for name, key in archive['keys']:
+            assert (tar_obj.extractfile(name).read()
+                    == name[:-4].encode() * 100)
+
+
+@mock_s3
+def test_archive_concurrency_min_file_size():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    for i in range(10):
+        s3.put_object(
+            Bucket='my-bucket',
+            Key='some_folder/thing{}.txt'.format(i),
+            Body=b'x' * 1000,
+        )
+
+    tar = S3Tar('my-bucket', 'my-data.tar', min_file_size='3KB',
+                archive_concurrency=2, session=session)
+    tar.add_files('some_folder')
+    tar.tar()
+
+    names = []
+    keys = sorted(
+        obj['Key']
+        for obj in s3.list_objects_v2(Bucket='my-bucket')['Contents']
+        if obj['Key'].startswith('my-data')
+    )
+    assert len(keys) > 1
+    for key in keys:
+        resp = s3.get_object(Bucket='my-bucket', Key=key)
+        tar_obj = tarfile.open(fileobj=io.BytesIO(resp['Body'].read()))
+        names.extend(tar_obj.getnames())
+    assert sorted(names) == ['thing{}.txt'.format(i) for i in range(10)]
+
+
+@mock_s3
+def test_archive_concurrency_stops_on_error():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    # Larger than the max size, so it is in an archive on its own
+    s3.put_object(Bucket='my-bucket', Key='some_folder/large.bin',
+                  Body=b'0' * (2 * MIN_S3_SIZE))
+    for i in range(10):
+        s3.put_object(
+            Bucket='my-bucket',
+            Key='some_folder/thing{}.txt'.format(i),
+            Body=b'x' * 1000,
+        )
+
+    tar = S3Tar('my-bucket', 'my-data.tar', max_file_size='5MB',
+                part_size_multiplier=1, archive_concurrency=2,
+                session=session)
+    tar.add_files('some_folder')
+    get_object = tar.s3.get_object
+
+    def _fail_large_file(**kwargs):
+        if not kwargs.get('Range', 'bytes=0-').startswith('bytes=0-'):
+            raise ValueError("Connection reset")
+        if kwargs['Key'].endswith('.txt'):
+            # Still building the other archive when the large file fails
+            time.sleep(0.2)
+        return get_object(**kwargs)
+
+    tar.s3.get_object = _fail_large_file
+    with pytest.raises(ValueError):
+        tar.tar()
+
+    # The other archive was stopped and its upload aborted
+    assert 'Uploads' not in s3.list_multipart_uploads(Bucket='my-bucket')
+    assert 'Contents' not in s3.list_objects_v2(Bucket='my-bucket',
+                                                Prefix='my-data')
+
+
+def test_archive_concurrency_fail():
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar', archive_concurrency=0)
+    with pytest.raises(ValueError):
+        # Without a min or max size there is only one archive
+        S3Tar('my-bucket', 'my-data.tar', archive_concurrency=2)
+
+
+@mock_s3
+def test_max_memory():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    for i in range(6):
+        s3.put_object(
+            Bucket='my-bucket',
+            Key='some_folder/thing{}.txt'.format(i),
+            Body=b'x' * 3 * 1024**2,
+        )
+
+    # 10MB is set aside for the parts, leaving 10MB for 3 files at a time
+    tar = S3Tar('my-bucket', 'my-data.tar', max_memory='20MB',
+                part_size_multiplier=1, upload_concurrency=1,
+                session=session)
+    tar.add_files('some_folder')
+    assert tar._memory_budget.limit == 10 * 1024**2
+    assert tar.file_cache.maxsize == 0
+
+    peak = []
+    reserve = tar._memory_budget.reserve
+
+    def tracked_reserve(size):
+        reserve(size)
+        peak.append(tar._memory_budget.used)
+
+    tar._memory_budget.reserve = tracked_reserve
+    tar.tar()
+
+    assert 0 < max(peak) <= 10 * 1024**2
+    assert tar._memory_budget.used == 0
+    resp = s3.get_object(Bucket='my-bucket', Key='my-data.tar')
+    tar_obj = tarfile.open(fileobj=io.BytesIO(resp['Body'].read()))
+    assert len(tar_obj.getnames()) == 6
+
+
+def test_max_memory_fail():
+    with pytest.raises(ValueError):
+        # Not enough for the parts being built and uploaded
+        S3Tar('my-bucket', 'my-data.tar', max_memory='100MB')
+
+
+@mock_s3
+def test_spill_to_disk(tmp_path, monkeypatch):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    sources = {}
+    for i in range(3):
+        sources['thing{}.txt'.format(i)] = 'thing{}'.format(i).encode() * 1000
+        s3.put_object(
+            Bucket='my-bucket',
+            Key='some_folder/thing{}.txt'.format(i),
+            Body=sources['thing{}.txt'.format(i)],
+        )
+
+    buffers = []
+    create_buffer = S3Tar._create_buffer
+
+    def tracked_create_buffer(self):
+        buffers.append(create_buffer(self))
+        return buffers[-1]
+
+    monkeypatch.setattr(S3Tar, '_create_buffer', tracked_create_buffer)
+    tar = S3Tar('my-bucket', 'my-data.tar', spill_size='1KB',
+                spill_dir=str(tmp_path), session=session)
+    tar.add_files('some_folder')
+    tar.tar()
+
+    # Downloads, tar'd files & the part all went over 1KB
+    assert len(buffers) == 3 * 2 + 1
+    assert all(buffer._rolled is True for buffer in buffers)
+
+    resp = s3.get_object(Bucket='my-bucket', Key='my-data.tar')
+    tar_obj = tarfile.open(fileobj=io.BytesIO(resp['Body'].read()))
+    for name, source in sources.items():
+        assert tar_obj.extractfile(name).read() == source
+
+
+def test_spill_fail(tmp_path):
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar', spill_dir=str(tmp_path))
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar', spill_size='1MB',
+              spill_dir=str(tmp_path / 'not_here'))
+
+
+def _check_member_index(s3, target_key, sources):
+    resp = s3.get_object(Bucket='my-bucket', Key=target_key + '.index')
+    index = load_index(resp['Body'].read())
+    assert index['archive'] == target_key
+
+    for member in index['members']:
+        source = sources[member['name']]
+        # Metadata files have the key they are the metadata of
+        assert member['key'] == 'some_folder/' + member['name'].replace(
+            '.metadata.json', '')
+        assert member['size'] == len(source)
+        if index['compression'] is None and member['size'] == 0:
+            continue
+        if index['compression'] is None:
+            # A single ranged get for the data
+            start = member['data_offset']
+        else:
+            start = member['header_offset']
+        end = start + member['length'] - 1
+        if index['compression'] is None:
+            end = start + member['size'] - 1
+        resp = s3.get_object(Bucket='my-bucket', Key=target_key,
+                             Range='bytes={}-{}'.format(start, end))
+        data = resp['Body'].read()
+        if index['compression'] is not None:
+            # Each member is a tar of its own once decompressed
+            data = gzip.decompress(data)
+            member_tar = tarfile.open(fileobj=io.BytesIO(data))
+            assert member_tar.getnames() == [member['name']]
+            data = data[member['data_offset']:][:member['size']]
+        assert data == source
+    return index
+
+
+@mock_s3
+@pytest.mark.parametrize('target_key', ['my-data.tar', 'my-data.tar.gz'])
+def test_member_index(target_key):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    sources = {
+        'small.txt': b'small' * 100,
+        'empty.txt': b'',
+        'b' * 150 + '.txt': b'long name',
+        # Streamed in ranges
+        'large.bin': b'abcdefgh' * (MIN_S3_SIZE // 8) + b'end',
+    }
+    for name, source in sources.items():
+        s3.put_object(Bucket='my-bucket', Key='some_folder/' + name,
+                      Body=source, Metadata={'a': 'b'})
+
+    tar = S3Tar('my-bucket', target_key, min_file_size='4MB',
+                part_size_multiplier=1, save_metadata=True,
+                member_index=True, session=session)
+    tar.add_files('some_folder')
+    tar.tar()
+    for name in list(sources):
+        sources[name + '.metadata.json'] = b'{"a": "b"}'
+
+    names = []
+    index_keys = [
+        obj['Key']
+        for obj in s3.list_objects_v2(Bucket='my-bucket')['Contents']
+        if obj['Key'].endswith('.index')
+    ]
+    assert len(index_keys) >= 1
+    for index_key in index_keys:
+        index = _check_member_index(s3, index_key[:-len('.index')], sources)
+        names += [member['name'] for member in index['members']]
+    # Metadata files are in the index as well
+    assert sorted(names) == sorted(sources)
+
+
+def test_member_index_single_compression_stream_fail():
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar.gz', single_compression_stream=True,
+              member_index=True)
+
+
+###
+# list_archive
+###
+@mock_s3
+@pytest.mark.parametrize('member_index', [False, True])
+def test_list_archive(member_index):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    sources = {
+        'small.txt': b'small' * 100,
+        'empty.txt': b'',
+        'large.bin': b'abcdefgh' * (MIN_S3_SIZE // 8) + b'end',
+    }
+    for name, source in sources.items():
+        s3.put_object(Bucket='my-bucket', Key='some_folder/' + name,
+                      Body=source)
+
+    tar = S3Tar('my-bucket', 'my-data.tar', part_size_multiplier=1,
+                member_index=member_index, session=session)
+    tar.add_files('some_folder')
+    tar.tar()
+
+    # A job can only be used once
+    members = list(S3Tar('my-bucket', 'my-data.tar',
+                         session=session).list_archive())
+    assert sorted(m['name'] for m in members) == sorted(sources)
+    body = s3.get_object(Bucket='my-bucket', Key='my-data.tar')['Body'].read()
+    for member in members:
+        start = member['data_offset']
+        assert body[start:start + member['size']] == sources[member['name']]
+
+
+@mock_s3
+def test_list_archive_compressed():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    s3.put_object(Bucket='my-bucket', Key='some_folder/a.txt', Body=b'a')
+
+    tar = S3Tar('my-bucket', 'my-data.tar.gz', member_index=True,
+                session=session)
+    tar.add_files('some_folder')
+    tar.tar()
+
+    tar = S3Tar('my-bucket', 'my-data.tar.gz', session=session)
+    assert [m['name'] for m in tar.list_archive()] == ['a.txt']
+
+    s3.delete_object(Bucket='my-bucket', Key='my-data.tar.gz.index')
+    # Where each file is, is only known once it is decompressed
+    with pytest.raises(ValueError):
+        list(tar.list_archive())
+
+
+###
+# verify
+###
+@mock_s3
+@pytest.mark.parametrize('target_key,server_side_copy', [
+    ('my-data.tar', False),
+    ('my-data.tar', True),
+    ('my-data.tar.gz', False),
+])
+def test_verify(target_key, server_side_copy):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    sources = {
+        'small.txt': b'small' * 100,
+        'empty.txt': b'',
+        # Streamed in ranges, or copied by s3
+        'large.bin': b'abcdefgh' * (MIN_S3_SIZE // 4) + b'end',
+    }
+    for name, source in sources.items():
+        s3.put_object(Bucket='my-bucket', Key='some_folder/' + name,
+                      Body=source)
+
+    tar = S3Tar('my-bucket', target_key, part_size_multiplier=1,
+                server_side_copy=server_side_copy, verify=True,
+                session=session)
+    tar.add_files('some_folder')
+    tar.tar()
+
+    manifest = json.loads(s3.get_object(
+        Bucket='my-bucket', Key=target_key + '.manifest',
+    )['Body'].read())
+    assert manifest['archive'] == target_key
+    assert manifest['etag'] == s3.head_object(Bucket='my-bucket',
+                                              Key=target_key)['ETag']
+    assert len(manifest['parts']) == int(manifest['etag'].split('-')[1][:-1])
+
+    assert sorted(f['name'] for f in manifest['files']) == sorted(sources)
+    for manifest_file in manifest['files']:
+        source = sources[manifest_file['name']]
+        assert manifest_file['key'] == 'some_folder/' + manifest_file['name']
+        assert manifest_file['size'] == len(source)
+        if server_side_copy is True and manifest_file['name'] == 'large.bin':
+            # The data was copied by s3, so it was never downloaded
+            assert manifest_file['md5'] is None
+            continue
+        assert manifest_file['md5'] == hashlib.md5(source).hexdigest()
+        assert manifest_file['crc32'] == '{:08x}'.format(zlib.crc32(source))
+
+
+@mock_s3
+def test_verify_source_fail():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    s3.put_object(Bucket='my-bucket', Key='some_folder/large.bin',
+                  Body=b'a' * (MIN_S3_SIZE + 1))
+
+    tar = S3Tar('my-bucket', 'my-data.tar', part_size_multiplier=1,
+                verify=True, session=session)
+    tar.add_files('some_folder')
+
+    get_source_range = tar._get_source_range
+
+    def _corrupt_range(key, start, end):
+        data, resp = get_source_range(key, start, end)
+        return b'b' + data[1:], resp
+
+    tar._get_source_range = _corrupt_range
+    with pytest.raises(ValueError):
+        tar.tar()
+
+
+@mock_s3
+def test_verify_source_file_fail():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    s3.put_object(Bucket='my-bucket', Key='some_folder/good.txt',
+                  Body=b'good')
+    s3.put_object(Bucket='my-bucket', Key='some_folder/bad.txt',
+                  Body=b'bad')
+
+    tar = S3Tar('my-bucket', 'my-data.tar', verify=True, remove_keys=True,
+                session=session)
+    tar.add_files('some_folder')
+
+    get_object = tar.s3.get_object
+
+    def _bad_etag(**kwargs):
+        resp = get_object(**kwargs)
+        if kwargs['Key'] == 'some_folder/bad.txt':
+            resp['ETag'] = '"{}"'.format('0' * 32)
+        return resp
+
+    tar.s3.get_object = _bad_etag
+    with pytest.raises(ValueError):
+        tar.tar()
+
+    assert list(tar.failed_verifies) == ['some_folder/bad.txt']
+    # Only the file that was in the archive was removed
+    assert _source_keys(s3) == ['some_folder/bad.txt']
+    tar_file = tarfile.open(fileobj=io.BytesIO(s3.get_object(
+        Bucket='my-bucket', Key='my-data.tar',
+    )['Body'].read()))
+    assert tar_file.getnames() == ['good.txt']
+
+
+@mock_s3
+@pytest.mark.parametrize('encryption', [
+    {'ServerSideEncryption': 'aws:kms'},
+    {'SSECustomerAlgorithm': 'AES256'},
+])
+def test_verify_encrypted_sources(encryption):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    sources = {
+        'small.txt': b'small' * 100,
+        # Streamed in ranges
+        'large.bin': b'abcdefgh' * (MIN_S3_SIZE // 4) + b'end',
+    }
+    for name, source in sources.items():
+        s3.put_object(Bucket='my-bucket', Key='some_folder/' + name,
+                      Body=source)
+
+    tar = S3Tar('my-bucket', 'my-data.tar', part_size_multiplier=1,
+                verify=True, session=session)
+    tar.add_files('some_folder')
+    get_object = tar.s3.get_object
+
+    def _encrypted(**kwargs):
+        # The ETag of an encrypted file is not its md5
+        resp = get_object(**kwargs)
+        resp['ETag'] = '"{}"'.format('0' * 32)
+        resp.update(encryption)
+        return resp
+
+    tar.s3.get_object = _encrypted
+    tar.tar()
+
+    assert tar.failed_verifies == {}
+    manifest = json.loads(s3.get_object(
+        Bucket='my-bucket', Key='my-data.tar.manifest',
+    )['Body'].read())
+    for manifest_file in manifest['files']:
+        assert (manifest_file['md5']
+                == hashlib.md5(sources[manifest_file['name']]).hexdigest())
+
+
+def test_verify_journal_fail(tmp_path):
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar', verify=True,
+              journal_path=str(tmp_path / 'journal'))
+
+
+###
+# remove_keys
+###
+def _put_sources(s3, count):
+    s3.create_bucket(Bucket='my-bucket')
+    for i in range(count):
+        s3.put_object(Bucket='my-bucket', Key='some_folder/{}.txt'.format(i),
+                      Body=b'a' * 100)
+
+
+def _source_keys(s3):
+    return [obj['Key'] for obj in s3.list_objects_v2(
+        Bucket='my-bucket', Prefix='some_folder/',
+    ).get('Contents', [])]
+
+
+@mock_s3
+def test_remove_keys(monkeypatch):
+    monkeypatch.setattr('s3_tar.s3_tar.DELETE_BATCH_SIZE', 3)
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    _put_sources(s3, 10)
+
+    tar = S3Tar('my-bucket', 'my-data.tar', remove_keys=True,
+                session=session)
+    tar.add_files('some_folder')
+    delete_objects = tar.s3.delete_objects
+    batches = []
+
+    def _delete_objects(**kwargs):
+        batches.append(len(kwargs['Delete']['Objects']))
+        return delete_objects(**kwargs)
+
+    tar.s3.delete_objects = _delete_objects
+    tar.tar()
+
+    assert sorted(batches) == [1, 3, 3, 3]
+    assert _source_keys(s3) == []
+    assert tar.failed_deletes == {}
+
+
+@mock_s3
+def test_remove_keys_retry(monkeypatch):
+    monkeypatch.setattr('s3_tar.s3_tar.DELETE_RETRY_DELAY', 0)
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    _put_sources(s3, 3)
+
+    tar = S3Tar('my-bucket', 'my-data.tar', remove_keys=True,
+                session=session)
+    tar.add_files('some_folder')
+    delete_objects = tar.s3.delete_objects
+    calls = []
+
+    def _delete_objects(**kwargs):
+        calls.append([obj['Key'] for obj in kwargs['Delete']['Objects']])
+        # 0.txt fails once, 1.txt always fails
+        failing = ['some_folder/1.txt']
+        if len(calls) == 1:
+            failing.append('some_folder/0.txt')
+        kwargs['Delete']['Objects'] = [
+            obj for obj in kwargs['Delete']['Objects']
+            if obj['Key'] not in failing
+        ]
+        resp = {}
+        if kwargs['Delete']['Objects']:
+            resp = delete_objects(**kwargs)
+        resp['Errors'] = [{'Key': key, 'Code': 'InternalError',
+                           'Message': 'Try again'} for key in failing]
+        return resp
+
+    tar.s3.delete_objects = _delete_objects
+    tar.tar()
+
+    assert calls[0] == ['some_folder/0.txt', 'some_folder/1.txt',
+                        'some_folder/2.txt']
+    assert calls[1] == ['some_folder/0.txt', 'some_folder/1.txt']
+    assert len(calls) == tar.s3_max_retries
+    # Keys that could not be deleted are kept and reported
+    assert _source_keys(s3) == ['some_folder/1.txt']
+    assert tar.failed_deletes == {
+        'some_folder/1.txt': 'InternalError: Try again',
+    }
+
+
+@mock_s3
+def test_incremental_remove():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    for i in range(4):
+        s3.put_object(Bucket='my-bucket', Key='some_folder/{}.txt'.format(i),
+                      Body=b'a' * 3000)
+
+    tar = S3Tar('my-bucket', 'my-data.tar', remove_keys=True,
+                incremental_remove=True, max_file_size='6KB',
+                session=session)
+    tar.add_files('some_folder')
+    removed = []
+    delete_keys = tar._delete_keys
+
+    def _delete_keys(keys):
+        removed.append(sorted(keys))
+        delete_keys(keys)
+
+    tar._delete_keys = _delete_keys
+    tar.tar()
+
+    # The keys of each archive once it was done, then nothing left at the end
+    assert removed == [
+        ['some_folder/0.txt'],
+        ['some_folder/1.txt'],
+        ['some_folder/2.txt'],
+        ['some_folder/3.txt'],
+        [],
+    ]
+    assert _source_keys(s3) == []
+
+
+@mock_s3
+@pytest.mark.parametrize('incremental_remove', [False, True])
+def test_remove_keys_download_fail(incremental_remove):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    for name in ('good.txt', 'bad.txt'):
+        s3.put_object(Bucket='my-bucket', Key='some_folder/' + name,
+                      Body=b'a' * 3000)
+
+    tar = S3Tar('my-bucket', 'my-data.tar', remove_keys=True,
+                incremental_remove=incremental_remove, session=session)
+    tar.add_files('some_folder')
+    get_object = tar.s3.get_object
+
+    def _fail_bad(**kwargs):
+        if kwargs['Key'] == 'some_folder/bad.txt':
+            raise ValueError("Download failed")
+        return get_object(**kwargs)
+
+    tar.s3.get_object = _fail_bad
+    tar.tar()
+
+    # It is in no archive, so it is kept and reported
+    assert _source_keys(s3) == ['some_folder/bad.txt']
+    assert tar.kept_keys == {'some_folder/bad.txt'}
+
+
+def test_incremental_remove_fail():
+    with pytest.raises(ValueError):
+        S3Tar('my-bucket', 'my-data.tar', incremental_remove=True)
+
+
+###
+# Metrics
+###
+@mock_s3
+@pytest.mark.parametrize('target_key', ['my-data.tar', 'my-data.tar.gz'])
+def test_metrics(target_key):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    sources = {
+        'small.txt': b'small' * 100,
+        'empty.txt': b'',
+        # Streamed in ranges
+        'large.bin': b'abcdefgh' * (MIN_S3_SIZE // 4) + b'end',
+    }
+    for name, source in sources.items():
+        s3.put_object(Bucket='my-bucket', Key='some_folder/' + name,
+                      Body=source)
+
+    reports = []
+    tar = S3Tar('my-bucket', target_key, part_size_multiplier=1,
+                progress_callback=reports.append, progress_interval=60,
+                session=session)
+    tar.add_files('some_folder')
+    tar.tar()
+
+    snapshot = tar.metrics.snapshot()
+    counters = snapshot['counters']
+    assert counters['files_listed'] == 3
+    assert counters['files_added'] == 3
+    assert counters['archives_completed'] == 1
+    assert counters['bytes_in'] == sum(len(s) for s in sources.values())
+    assert counters['bytes_out'] == s3.head_object(
+        Bucket='my-bucket', Key=target_key,
+    )['ContentLength']
+    assert counters['parts_uploaded'] == snapshot['latency'][
+        'upload_part']['count']
+    assert snapshot['gauges']['files_total'] == 3
+
+    latency = snapshot['latency']
+    assert latency['list']['count'] == 1
+    assert latency['get']['count'] > 3  # The large file is read in ranges
+    assert latency['pack']['count'] == 2
+    assert (latency['compress']['count'] > 0) is target_key.endswith('.gz')
+    assert latency['cache_get_wait']['count'] >= 3
+
+    # Once at the start and once at the end
+    assert reports == [tar.metrics, tar.metrics]
@@ -0,0 +1,178 @@
+import os
+import boto3
+import pytest
+from s3_tar import S3Tar, S3Untar
+from moto import mock_s3
+from s3_tar.utils import MIN_S3_SIZE
+from s3_tar.tar_listing import walk_headers
+
+SOURCES = {
+    'small.txt': b'small' * 100,
+    'empty.txt': b'',
+    'sub/folder/nested.txt': b'nested',
+    'b' * 150 + '.txt': b'long name',
+    # Larger then a part, so it is uploaded in parts
+    'large.bin': b'abcdefgh' * (MIN_S3_SIZE // 8) + b'end',
+}
+
+
+def _create_tar(s3, session, target_key, member_index, save_metadata=False):
+    s3.create_bucket(Bucket='my-bucket')
+    for name, source in SOURCES.items():
+        s3.put_object(Bucket='my-bucket', Key='some_folder/' + name,
+                      Body=source, Metadata={'name': name})
+
+    tar = S3Tar('my-bucket', target_key, part_size_multiplier=1,
+                member_index=member_index, save_metadata=save_metadata,
+                session=session)
+    tar.add_files('some_folder', preserve_paths=True)
+    tar.tar()
+
+
+def _check_files(s3, folder, save_metadata=False):
+    for name, source in SOURCES.items():
+        body = s3.get_object(
+            Bucket='my-bucket',
+            Key='{}/{}'.format(folder, name),
+        )['Body'].read()
+        assert body == source
+        if save_metadata is True:
+            metadata = s3.get_object(
+                Bucket='my-bucket',
+                Key='{}/{}.metadata.json'.format(folder, name),
+            )['Body'].read()
+            assert metadata == '{{"name": "{}"}}'.format(name).encode()
+
+
+@mock_s3
+@pytest.mark.parametrize('target_key,member_index', [
+    ('my-data.tar', False),
+    ('my-data.tar', True),
+    ('my-data.tar.gz', True),
+    ('my-data.tar.zst', True),
+    # Read as a single stream
+    ('my-data.tar.gz', False),
+    ('my-data.tar.lz4', False),
+])
+def test_untar(target_key, member_index):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    _create_tar(s3, session, target_key, member_index)
+
+    untar = S3Untar('my-bucket', target_key, folder='restored/',
+                    part_size_multiplier=1, session=session)
+    untar.untar()
+
+    _check_files(s3, 'restored')
+
+
+@mock_s3
+@pytest.mark.parametrize('untar_part_size_multiplier', [1, 10])
+def test_untar_parallel_bz2(untar_part_size_multiplier):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    # Compressed in blocks on many threads, so it is many bz2 streams
+    source = os.urandom(6 * 1024**2)
+    s3.put_object(Bucket='my-bucket', Key='some_folder/large.bin',
+                  Body=source)
+
+    tar = S3Tar('my-bucket', 'my-data.tar.bz2', part_size_multiplier=1,
+                compression_workers=2, member_index=True, session=session)
+    tar.add_files('some_folder')
+    tar.tar()
+
+    untar = S3Untar('my-bucket', 'my-data.tar.bz2', folder='restored',
+                    part_size_multiplier=untar_part_size_multiplier,
+                    session=session)
+    untar.untar()
+
+    assert s3.get_object(
+        Bucket='my-bucket', Key='restored/large.bin',
+    )['Body'].read() == source
+
+
+@mock_s3
+def test_untar_server_side_copy():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    _create_tar(s3, session, 'my-data.tar', False)
+
+    untar = S3Untar('my-bucket', 'my-data.tar', folder='restored',
+                    part_size_multiplier=1, server_side_copy=True,
+                    session=session)
+    untar.untar()
+
+    _check_files(s3, 'restored')
+
+
+@mock_s3
+@pytest.mark.parametrize('target_key', ['my-data.tar', 'my-data.tar.gz'])
+def test_untar_metadata(target_key):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    _create_tar(s3, session, target_key, True, save_metadata=True)
+
+    # The metadata files are found with the index too
+    untar = S3Untar('my-bucket', target_key, folder='restored',
+                    part_size_multiplier=1, session=session)
+    untar.untar()
+
+    _check_files(s3, 'restored', save_metadata=True)
+
+
+@mock_s3
+@pytest.mark.parametrize('save_metadata', [False, True])
+def test_untar_list_members(save_metadata):
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    _create_tar(s3, session, 'my-data.tar', True, save_metadata=save_metadata)
+
+    untar = S3Untar('my-bucket', 'my-data.tar', session=session)
+    indexed = untar.list_members()
+    walked = list(walk_headers(s3, 'my-bucket', 'my-data.tar'))
+
+    # Reading the headers finds the same files the index has
+    for member in indexed:
+        member['key'] = None
+    assert walked == indexed
+    names = list(SOURCES)
+    if save_metadata is True:
+        names += [name + '.metadata.json' for name in SOURCES]
+    assert (sorted(m['name'].lstrip('/') for m in walked)
+            == sorted(names))
+
+
+def test_untar_group_members():
+    untar = S3Untar('my-bucket', 'my-data.tar', part_size_multiplier=1)
+    members = [
+        {'header_offset': 0, 'length': 1024, 'size': 10},
+        {'header_offset': 1024, 'length': MIN_S3_SIZE + 1024,
+         'size': MIN_S3_SIZE + 1},
+        {'header_offset': MIN_S3_SIZE + 2048, 'length': 1024, 'size': 10},
+        {'header_offset': MIN_S3_SIZE + 3072, 'length': MIN_S3_SIZE - 512,
+         'size': MIN_S3_SIZE - 1024},
+    ]
+    groups = list(untar._group_members(members))
+    assert groups == [[members[0]], [members[1]], [members[2]], [members[3]]]
+
+    members = [
+        {'header_offset': 0, 'length': 1024, 'size': 10},
+        {'header_offset': 1024, 'length': 1024, 'size': 10},
+    ]
+    assert list(untar._group_members(members)) == [members]
+
+
+def test_untar_server_side_copy_fail():
+    with pytest.raises(ValueError):
+        S3Untar('my-bucket', 'my-data.tar.gz', server_side_copy=True)
+
+
+def test_untar_invalid_extension_fail():
+    with pytest.raises(ValueError):
+        S3Untar('my-bucket', 'my-data.zip')
+
+
+def test_untar_concurrency_fail():
+    with pytest.raises(ValueError):
+        S3Untar('my-bucket', 'my-data.tar', concurrency=0)
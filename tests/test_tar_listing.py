@@ -0,0 +1,113 @@
+import io
+import boto3
+import tarfile
+from moto import mock_s3
+from s3_tar.tar_listing import _RangeReader, get_index, walk_headers
+
+DATA = bytes(range(256)) * 1024  # 256KB
+
+
+def _create_reader(**kwargs):
+    calls = []
+
+    def read_range(start, end):
+        calls.append((start, end))
+        return DATA[start:end]
+
+    kwargs.setdefault('prefetch', 0)
+    return _RangeReader(read_range, len(DATA), **kwargs), calls
+
+
+def test_range_reader_read():
+    reader, calls = _create_reader(min_read_size=1024)
+    assert reader.read(10) == DATA[:10]
+    assert reader.read(10) == DATA[10:20]
+    assert calls == [(0, 1024)]  # Read ahead
+
+    reader.seek(100000)
+    assert reader.read(2000) == DATA[100000:102000]
+    assert calls[-1] == (100000, 102000)
+
+    reader.seek(-5, io.SEEK_END)
+    assert reader.read() == DATA[-5:]
+    assert reader.read() == b''
+
+
+def test_range_reader_grows_when_close_together():
+    reader, calls = _create_reader(min_read_size=1024, max_read_size=4096)
+    reader.read(1000)
+    # Keeps what was already read, and continues from the end of it
+    assert reader.read(100) == DATA[1000:1100]
+    assert calls == [(0, 1024), (1024, 3072)]
+
+    reader.seek(3500)
+    assert reader.read(10) == DATA[3500:3510]
+    assert calls[-1] == (3500, 7596)
+
+    # A large skip starts over with small reads
+    reader.seek(200000)
+    assert reader.read(10) == DATA[200000:200010]
+    assert calls[-1] == (200000, 201024)
+
+
+def test_range_reader_prefetch():
+    reader, calls = _create_reader(min_read_size=1024, prefetch=2)
+    reader.read(1024)
+    reader.read(1024)
+    reader.read(2048)
+    reader.read(4096)
+    assert reader.tell() == 8192
+    reader.close()
+    # Ranges after the second read were read in the background
+    assert sorted(calls)[:4] == [(0, 1024), (1024, 3072), (3072, 5120),
+                                 (5120, 7168)]
+
+
+@mock_s3
+def test_walk_headers():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+
+    tar_io = io.BytesIO()
+    sources = {'file-{}.txt'.format(i): b'a' * i for i in range(200)}
+    sources['large.bin'] = b'b' * (3 * 1024**2)
+    sources['c' * 150 + '.txt'] = b'long name'
+    with tarfile.open(fileobj=tar_io, mode='w') as tar:
+        for name, source in sources.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(source)
+            tar.addfile(info, io.BytesIO(source))
+        info = tarfile.TarInfo('folder')
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+    s3.put_object(Bucket='my-bucket', Key='my-data.tar',
+                  Body=tar_io.getvalue())
+
+    gets = []
+    s3.meta.events.register('before-call.s3.GetObject',
+                            lambda **kwargs: gets.append(kwargs))
+    members = list(walk_headers(s3, 'my-bucket', 'my-data.tar', prefetch=0))
+
+    # Only files, none of the data of the large file was read
+    assert [m['name'] for m in members] == list(sources)
+    assert len(gets) < 10
+    body = tar_io.getvalue()
+    for member in members:
+        start = member['data_offset']
+        assert body[start:start + member['size']] == sources[member['name']]
+
+
+@mock_s3
+def test_get_index():
+    session = boto3.session.Session()
+    s3 = session.client('s3')
+    s3.create_bucket(Bucket='my-bucket')
+    assert get_index(s3, 'my-bucket', 'my-data.tar') is None
+
+    s3.put_object(Bucket='my-bucket', Key='my-data.tar.index',
+                  Body=b'{"archive":"my-data.tar","compression":null,'
+                       b'"fields":["name"],"members":[["a.txt"]]}')
+    assert get_index(s3, 'my-bucket', 'my-data.tar')['members'] == [
+        {'name': 'a.txt'},
+    ]
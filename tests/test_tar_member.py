@@ -0,0 +1,122 @@
+import io
+import gzip
+import tarfile
+from s3_tar.tar_member import TarMemberStream
+from s3_tar.utils import _create_compressor
+
+
+def _member_stream(source, chunk_size, compressor=None):
+    info = tarfile.TarInfo(name='foo/bar.txt')
+    info.size = len(source)
+    info.mtime = 1593457982
+    return TarMemberStream(
+        info,
+        lambda start, end: source[start:end],
+        chunk_size,
+        compressor=compressor,
+    )
+
+
+def test_tar_member_stream_matches_tarfile():
+    source = b'Beep boop' * 100
+    member_stream = _member_stream(source, 64)
+
+    expected_io = io.BytesIO()
+    tar = tarfile.open(fileobj=expected_io, mode='w')
+    info = tarfile.TarInfo(name='foo/bar.txt')
+    info.size = len(source)
+    info.mtime = 1593457982
+    tar.addfile(tarinfo=info, fileobj=io.BytesIO(source))
+
+    assert member_stream.read() == expected_io.getvalue()
+    assert member_stream.read() == b''
+
+
+def test_tar_member_stream_reads_in_chunks():
+    reads = []
+    source = b'x' * 1000
+
+    def _read_range(start, end):
+        reads.append((start, end))
+        return source[start:end]
+
+    info = tarfile.TarInfo(name='bar.txt')
+    info.size = len(source)
+    member_stream = TarMemberStream(info, _read_range, 400)
+
+    output = b''
+    data = member_stream.read(300)
+    while data:
+        assert len(data) <= 300
+        output += data
+        data = member_stream.read(300)
+
+    # Only what is asked for gets downloaded
+    assert reads == [(0, 300), (300, 600), (600, 900), (900, 1000)]
+    assert len(output) == 512 + 1024
+
+    member_stream = TarMemberStream(info, _read_range, 400)
+    member_stream.read()
+    assert reads[4:] == [(0, 400), (400, 800), (800, 1000)]
+
+
+def test_tar_member_stream_compressed():
+    source = b'Beep boop' * 100
+    member_stream = _member_stream(source, 64,
+                                   compressor=_create_compressor('gz'))
+
+    tar_io = io.BytesIO(gzip.decompress(member_stream.read()))
+    tar = tarfile.open(fileobj=tar_io, mode='r')
+    assert tar.extractfile('foo/bar.txt').read() == source
+
+
+def test_tar_member_stream_skip_body():
+    source = b'x' * 1000
+    member_stream = _member_stream(source, 400)
+    assert member_stream.body_range() is None
+
+    header = member_stream.read(2048)
+    assert len(header) == 512
+    assert member_stream.body_range() == (0, 1000)
+
+    assert member_stream.read(100) == b'x' * 100
+    assert member_stream.body_range() == (100, 1000)
+
+    member_stream.skip_body(1000)
+    assert member_stream.body_range() is None
+    # Only the padding is left
+    assert member_stream.read(2048) == b'\0' * 24
+    assert member_stream.read(2048) == b''
+
+
+def test_tar_member_stream_compressed_no_body_range():
+    member_stream = _member_stream(b'x' * 1000, 400,
+                                   compressor=_create_compressor('gz'))
+    member_stream.read(10)
+    assert member_stream.body_range() is None
+
+
+def test_tar_member_stream_skip():
+    source = b'Beep boop' * 100
+    expected = _member_stream(source, 64).read()
+
+    for offset in (0, 100, 512, 700, len(expected) - 3, len(expected)):
+        reads = []
+        member_stream = TarMemberStream(
+            _member_stream(source, 64).tarinfo,
+            lambda start, end: reads.append(start) or source[start:end],
+            64,
+        )
+        member_stream.skip(offset)
+        assert member_stream.read() == expected[offset:]
+        # The skipped part of the body is not read
+        assert all(start >= offset - 512 for start in reads)
+
+
+def test_tar_member_stream_skip_compressed():
+    source = b'Beep boop' * 100
+    expected = _member_stream(source, 64, _create_compressor('gz')).read()
+
+    member_stream = _member_stream(source, 64, _create_compressor('gz'))
+    member_stream.skip(20)
+    assert member_stream.read() == expected[20:]
@@ -1,5 +1,8 @@
 import pytest
-from s3_tar.utils import _convert_to_bytes, _threads, MIN_S3_SIZE
+import io
+from s3_tar.utils import (_convert_to_bytes, _create_buffer, _threads,
+                          _create_compressor, _create_decompressor,
+                          _get_compression_type, MIN_S3_SIZE)
 
 
 ###
@@ -67,3 +70,62 @@ def test_threads_failing():
 
     output = _threads(1, [1, '2', 3], _callback, 1, static_num=3)
     assert output == [5, None, 7]
+
+
+def test_threads_on_error():
+    def _callback(num):
+        return num + 1
+
+    failed = []
+    output = _threads(1, [1, '2', 3], _callback, on_error=failed.append)
+    assert output == [2, None, 4]
+    assert failed == ['2']
+
+
+###
+# _create_buffer
+###
+def test_create_buffer_in_memory():
+    assert isinstance(_create_buffer(), io.BytesIO)
+
+
+def test_create_buffer_spills(tmp_path):
+    buffer = _create_buffer(spill_size=10, spill_dir=str(tmp_path))
+    buffer.write(b'a' * 10)
+    assert buffer._rolled is False
+    buffer.write(b'b')
+    assert buffer._rolled is True
+
+    buffer.seek(0)
+    assert buffer.read() == b'a' * 10 + b'b'
+    buffer.close()
+
+
+###
+# _create_decompressor
+###
+@pytest.mark.parametrize('compression_type', ['gz', 'bz2', 'xz', 'zst', 'lz4'])
+def test_create_decompressor(compression_type):
+    compressor = _create_compressor(compression_type)
+    data = compressor.compress(b'abc' * 100) + compressor.flush()
+
+    decompressor = _create_decompressor(compression_type)
+    assert decompressor.decompress(data + b'next') == b'abc' * 100
+    assert decompressor.eof is True
+    assert decompressor.unused_data == b'next'
+
+
+def test_create_decompressor_fail():
+    with pytest.raises(ValueError):
+        _create_decompressor('zip')
+
+
+###
+# _get_compression_type
+###
+def test_get_compression_type():
+    assert _get_compression_type('my-data.tar') is None
+    assert _get_compression_type('my-data.tar.gz') == 'gz'
+    assert _get_compression_type('folder/my-data.tar.zst') == 'zst'
+    with pytest.raises(ValueError):
+        _get_compression_type('my-data.zip')